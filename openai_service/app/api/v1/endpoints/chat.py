@@ -1,11 +1,26 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, HTTPException, Header, Depends, File, Form, UploadFile
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional
 from datetime import datetime
-from app.db.database import ChatHistory, delete_table, save_chat_history, add_to_table, get_chat_data
-from app.models.chat import ChatCreate, ChatRename, ChatCompletion, ChatRequest
-from app.services.openai import OpenAIService
+import asyncio
+import json
+import time
+from app.db.database import ChatHistory, delete_table, save_chat_history, update_by_key, get_chat_data, upsert_many
+from app.db.writer import writer
+from app.db.rollups import record_completion
+from app.core.security import Tenant, get_tenant
+from app.core.errors import UpstreamError
+from app.core.config import VISION_MAX_IMAGE_BYTES, VISION_MODEL, CHAT_BATCH_CONCURRENCY, CHAT_BATCH_FLUSH_SIZE, RATE_LIMIT_MAX_WAIT
+from app.core.logging import logs_bot
+from app.core.rate_limit import RateLimitExceeded, Reservation, rate_limiter
+from app.core.sse import sse_event
+from app.models.chat import ChatCreate, ChatRename, ChatCompletion, ChatRequest, ChatBatchRequest
+from app.services.batch import bounded_map, error_fields
+from app.services.openai import OpenAIService, get_openai_service
+from app.services.tokens import count_messages_tokens, count_text_tokens
+from app.services.vision import InvalidImage
 
 router = APIRouter()
-openai_service = OpenAIService()
 
 
 """
@@ -49,8 +64,101 @@ curl -X DELETE http://localhost:8000/api/v1/chat/delete/"5205f8e1-c4c5-4592-8c46
     }'
 """
 
+"""
+    curl -N -X POST 'http://localhost:8000/api/v1/chat/completions' \
+    -H 'Content-Type: application/json' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw' \
+    -d '{
+        "chat_id": "11bc9119-4c13-4144-8c20-16a24aa2c833",
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": "2+2=?!"}],
+        "stream": true
+    }'
+"""
+
+def _streamed_tokens(chat_request: ChatRequest, parts: list, usage: dict, reservation: Reservation) -> int:
+    """
+    Фактический расход токенов потока для Reservation.reconcile.
+
+    Возвращает usage, если поток дошел до конца. Если поток прервался после части
+    ответа, возвращает оценку промпта из резервирования плюс токены отправленных
+    фрагментов, а если до клиента не дошло ни одного фрагмента - 0.
+    """
+    if "prompt_tokens" in usage and "completion_tokens" in usage:
+        return usage["prompt_tokens"] + usage["completion_tokens"]
+    if not parts:
+        return 0
+    return reservation.tokens + count_text_tokens("".join(parts), chat_request.model)
+
+async def _stream_completion(
+    openai_service: OpenAIService,
+    chat_request: ChatRequest,
+    api_key_id: str = "",
+    reservation: Optional[Reservation] = None
+) -> AsyncIterator[str]:
+    """
+    Ретранслирует дельты ответа OpenAI клиенту в формате SSE.
+
+    Каждый фрагмент отправляется сразу после получения от upstream, а собранный
+    ответ ставится в очередь на запись в ChatHistory только после успешного завершения
+    потока. При ошибке клиент получает событие "error", и неполный ответ не сохраняется.
+    Списание с лимитов уточняется при любом завершении потока, в том числе при
+    отключении клиента (см. _streamed_tokens).
+
+    Параметры:
+        openai_service: OpenAIService - Общий сервис OpenAI приложения
+        chat_request: ChatRequest - Запрос на завершение чата
+        api_key_id: str - Отпечаток API-ключа клиента для статистики
+        reservation: Reservation - Списание с лимитов ключа, уточняется по usage потока
+
+    Возвращает:
+        AsyncIterator[str]: События text/event-stream
+    """
+    parts = []
+    usage = {}
+    started = time.perf_counter()
+    try:
+        try:
+            async for delta in openai_service.stream_chat_completion(chat_request, usage=usage):
+                parts.append(delta)
+                yield sse_event({"chat_id": chat_request.chat_id, "delta": delta})
+        except UpstreamError as e:
+            yield sse_event({
+                "chat_id": chat_request.chat_id,
+                "detail": str(e),
+                "status_code": e.status_code,
+                "retry_after": e.retry_after
+            }, event="error")
+            return
+        except Exception as e:
+            yield sse_event({"chat_id": chat_request.chat_id, "detail": str(e)}, event="error")
+            return
+
+        response_text = "".join(parts)
+        response_time_ms = int((time.perf_counter() - started) * 1000)
+        await writer.upsert(ChatHistory, "chat_id", {
+            "chat_id": chat_request.chat_id,
+            "answer": response_text,
+            "model_gpt": chat_request.model,
+            "token": usage["prompt_tokens"] + usage["completion_tokens"],
+            "prompt_tokens": usage["prompt_tokens"],
+            "completion_tokens": usage["completion_tokens"],
+            "response_time_ms": response_time_ms,
+            "api_key_id": api_key_id,
+        }, owner_key="api_key_id")
+        await record_completion(
+            chat_request.model, api_key_id, usage["prompt_tokens"], usage["completion_tokens"], response_time_ms
+        )
+
+        yield sse_event({"chat_id": chat_request.chat_id, "usage": usage}, event="usage")
+        yield "data: [DONE]\n\n"
+    finally:
+        # Лимиты уточняются на любом выходе: успех, ошибка upstream или сервиса, отключение клиента
+        if reservation is not None:
+            await asyncio.shield(reservation.reconcile(_streamed_tokens(chat_request, parts, usage, reservation)))
+
 @router.post("/create")
-async def create_chat(chat: ChatCreate):
+async def create_chat(chat: ChatCreate, tenant: Tenant = Depends(get_tenant)):
     """
     Создает новый чат и сохраняет его в базе данных.
     
@@ -75,16 +183,17 @@ async def create_chat(chat: ChatCreate):
         "created_at": datetime.utcnow(),  # Записываем текущее время
         "context": chat.context, 
         "token": chat.token,
-        "answer": chat.answer
+        "answer": chat.answer,
+        "api_key_id": tenant.api_key_id
     }
 
     await save_chat_history(chat_data) 
     return {"chat_id": chat_data["chat_name"]}
 
 @router.delete("/delete/{chat_id}")
-async def delete_chat_endpoint(chat_id: str):
+async def delete_chat_endpoint(chat_id: str, tenant: Tenant = Depends(get_tenant)):
     """
-    Удаляет указанный чат из базы данных.
+    Удаляет указанный чат из базы данных (только чат API-ключа запроса).
     
     Параметры:
         chat_id: str - Уникальный идентификатор чата для удаления
@@ -95,11 +204,11 @@ async def delete_chat_endpoint(chat_id: str):
             - message: сообщение о результате
         
     Вызывает:
-        HTTPException: Если чат не найден (404)
+        HTTPException: Если чат не найден или принадлежит другому ключу (404)
     """
 
     # Вызываем функцию удаления чата
-    success = await delete_table(ChatHistory, chat_id)
+    success = await delete_table(ChatHistory, chat_id, tenant.api_key_id)
     
     # Если чат не найден, выбрасываем исключение
     if not success:
@@ -108,9 +217,10 @@ async def delete_chat_endpoint(chat_id: str):
     return {"status": "success", "message": "Chat successfully deleted"}
 
 @router.put("/rename")
-async def rename_chat(chat: ChatRename):
+async def rename_chat(chat: ChatRename, tenant: Tenant = Depends(get_tenant)):
     """
-    Обновляет название существующего чата в базе данных.
+    Обновляет название существующего чата в базе данных одним запросом UPDATE ... RETURNING.
+    Переименовать можно только чат API-ключа запроса.
     
     Параметры:
         chat: ChatRename - Модель с данными для переименования:
@@ -123,27 +233,37 @@ async def rename_chat(chat: ChatRename):
             - new_name: новое название чата
             
     Вызывает:
-        HTTPException: Если чат не найден (404)
+        HTTPException: Если чат не найден или принадлежит другому ключу (404)
     """
 
     
-    # Обновляем данные чата
-    chat_data = {
-        "chat_id": chat.chat_id,
-        "chat_name": chat.new_name,
-    }
-    
-    success = await add_to_table(ChatHistory, chat_data)  # Используем функцию для обновления данных
+    # Обновляем только название: ответ, сохраняемый параллельно, не затирается
+    try:
+        updated = await update_by_key(
+            ChatHistory, "chat_id", chat.chat_id, {"chat_name": chat.new_name},
+            where={"api_key_id": tenant.api_key_id}
+        )
+    except ValueError:
+        updated = None  # chat_id не является UUID
 
-    if not success:
+    if updated is None:
         raise HTTPException(status_code=404, detail="Chat not found")
     
     return {"chat_id": chat.chat_id, "new_name": chat.new_name}
 
 @router.post("/completions", response_model=dict)
-async def generate_completion(completion: ChatCompletion):
+async def generate_completion(
+    completion: ChatCompletion,
+    x_cache_bypass: Optional[str] = Header(None),
+    tenant: Tenant = Depends(get_tenant),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
     """
     Генерирует ответ с помощью OpenAI API и сохраняет его в истории чата.
+
+    Ответ возвращается сразу после получения от OpenAI API, а запись в историю
+    чата и в почасовые агрегаты статистики (app.db.rollups) выполняется
+    фоновым писателем (см. app.db.writer).
     
     Параметры:
         completion: ChatCompletion - Модель с данными для генерации:
@@ -152,18 +272,31 @@ async def generate_completion(completion: ChatCompletion):
             - messages: список сообщений для контекста (опционально)
             - image_url: URL изображения (опционально)
             - audio_file: путь к аудиофайлу (опционально)
+            - stream: отдавать ответ потоком Server-Sent Events (опционально)
+        x_cache_bypass: str - Заголовок X-Cache-Bypass; значения "1"/"true"/"yes"
+            отключают чтение кэша ответов для этого запроса (опционально)
     
     Возвращает:
         dict: Сгенерированный ответ:
             - chat_id: идентификатор чата
             - response: текст ответа от модели или результат обработки изображения/аудио
+            - usage: prompt_tokens, completion_tokens и total_tokens
+        StreamingResponse: При stream=true - поток text/event-stream с событиями
+            {"chat_id", "delta"}, событием "usage" и завершающим "data: [DONE]"
             
     Вызывает:
         HTTPException: 
-            - 500: При ошибке получения ответа от OpenAI
-            - 404: При ошибке сохранения истории чата
+            - 400: Не передано ни сообщений, ни изображения, ни аудио
             - 500: При других ошибках
+        UpstreamError: Ответ OpenAI не получен (429, 502, 503 или 504, при необходимости
+            с Retry-After); ошибка не сохраняется в историю чата
+        RateLimitExceeded: 429 - превышен лимит запросов или токенов ключа (app.core.rate_limit)
     """
+    api_key_id = tenant.api_key_id
+    started = time.perf_counter()
+    reservation = None
+    # Резервирование уточнено (или передано потоку): иначе в finally оценка возвращается в лимит
+    settled = False
     try:
         if completion.messages:
             # Обработка текстовых сообщений
@@ -172,37 +305,269 @@ async def generate_completion(completion: ChatCompletion):
                 model=completion.model,
                 messages=completion.messages
             )
-            response_text = await openai_service.create_chat_completion(chat_request)
+            reservation = await rate_limiter.acquire(
+                tenant, "chat", completion.model,
+                tokens=count_messages_tokens(chat_request.messages, completion.model)
+            )
+            if completion.stream:
+                # Уточнение по usage выполняет _stream_completion при завершении потока
+                settled = True
+                return StreamingResponse(
+                    _stream_completion(openai_service, chat_request, api_key_id, reservation),
+                    media_type="text/event-stream",
+                    headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+                )
+
+            bypass_cache = (x_cache_bypass or "").lower() in ("1", "true", "yes")
+            result = await openai_service.create_chat_completion(chat_request, bypass_cache=bypass_cache)
 
         elif completion.image_url:
             # Обработка изображений
-            response_text = await openai_service.process_image(completion.image_url)
+            reservation = await rate_limiter.acquire(
+                tenant, "vision", VISION_MODEL, tokens=count_text_tokens("What's in this image?", VISION_MODEL)
+            )
+            result = await openai_service.process_image(completion.image_url)
 
         elif completion.audio_file:
             # Обработка аудио
-            response_text = await openai_service.process_audio(completion.audio_file)
+            reservation = await rate_limiter.acquire(tenant, "transcription", "whisper-1")
+            result = await openai_service.process_audio(completion.audio_file)
 
         else:
             raise HTTPException(status_code=400, detail="No valid input provided")
 
-        if response_text is None or response_text == "Error occurred":
-            raise HTTPException(status_code=500, detail="Failed to get response from OpenAI")
+        await reservation.reconcile(result.tokens_used)
+        settled = True
 
-        # Сохраняем историю чата
+        # Ставим сохранение истории чата и агрегатов статистики в очередь фонового писателя
+        response_time_ms = int((time.perf_counter() - started) * 1000)
         chat_history_data = {
             "chat_id": completion.chat_id,
-            "answer": response_text,
+            "answer": result.response,
+            "model_gpt": result.model,
+            "token": result.tokens_used,
+            "prompt_tokens": result.prompt_tokens,
+            "completion_tokens": result.completion_tokens,
+            "response_time_ms": response_time_ms,
+            "api_key_id": api_key_id,
         }
 
-        success = await add_to_table(ChatHistory, chat_history_data)
-        
-        if not success:
-            raise HTTPException(status_code=404, detail="Failed to save chat history")
+        # Чат другого ключа с тем же chat_id не перезаписывается
+        await writer.upsert(ChatHistory, "chat_id", chat_history_data, owner_key="api_key_id")
+        await record_completion(result.model, api_key_id, result.prompt_tokens, result.completion_tokens, response_time_ms)
         
         return {
             "chat_id": completion.chat_id,
-            "response": response_text,
+            "response": result.response,
+            "usage": {
+                "prompt_tokens": result.prompt_tokens,
+                "completion_tokens": result.completion_tokens,
+                "total_tokens": result.tokens_used,
+            },
         }
 
+    except (UpstreamError, HTTPException, RateLimitExceeded):
+        raise
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # Ответ модели не получен (ошибка upstream, изображения, сервиса): оценка токенов
+        # возвращается в лимит ключа
+        if reservation is not None and not settled:
+            await asyncio.shield(reservation.reconcile(0))
+
+"""
+    curl -N -X POST 'http://localhost:8000/api/v1/chat/completions/batch' \
+    -H 'Content-Type: application/json' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw' \
+    -d '{
+        "items": [
+            {"chat_id": "11bc9119-4c13-4144-8c20-16a24aa2c833", "model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "2+2=?"}]},
+            {"chat_id": "2d0c8a5e-7d1f-4f0e-9a51-3c1b1b6f2a10", "model": "gpt-3.5-turbo", "messages": [{"role": "user", "content": "3+3=?"}]}
+        ],
+        "concurrency": 8
+    }'
+"""
+
+async def _stream_chat_batch(
+    openai_service: OpenAIService,
+    batch: ChatBatchRequest,
+    concurrency: int,
+    tenant: Tenant,
+    bypass_cache: bool
+) -> AsyncIterator[str]:
+    """
+    Выполняет пакет chat completions и отдает результаты в формате NDJSON
+    в порядке завершения.
+
+    История ответов пишется в базу пачками по CHAT_BATCH_FLUSH_SIZE строк одним
+    INSERT ... ON CONFLICT (upsert_many), остаток - по завершении или обрыве потока.
+    Запросы списываются с лимитов клиента tenant.
+    """
+    api_key_id = tenant.api_key_id
+    history = []
+
+    async def _flush() -> None:
+        rows = history[:]
+        history.clear()
+        if not rows:
+            return
+        try:
+            await upsert_many(ChatHistory, rows, owner_key="api_key_id")
+        except Exception as e:
+            await logs_bot("error", f"Ошибка записи истории пакета: {str(e)}")
+
+    async def _complete(chat_request: ChatRequest):
+        # Элемент пакета ждет лимита ключа до RATE_LIMIT_MAX_WAIT секунд, а не получает 429 сразу
+        reservation = await rate_limiter.acquire(
+            tenant, "chat_batch", chat_request.model,
+            tokens=count_messages_tokens(chat_request.messages, chat_request.model),
+            max_wait=RATE_LIMIT_MAX_WAIT
+        )
+        started = time.perf_counter()
+        settled = False
+        try:
+            result = await openai_service.create_chat_completion(chat_request, bypass_cache=bypass_cache)
+            await reservation.reconcile(result.tokens_used)
+            settled = True
+        finally:
+            if not settled:
+                await asyncio.shield(reservation.reconcile(0))
+        return result, int((time.perf_counter() - started) * 1000)
+
+    succeeded = 0
+    try:
+        async for index, outcome, error in bounded_map(batch.items, _complete, min(concurrency, len(batch.items))):
+            chat_request = batch.items[index]
+            line = {"index": index, "chat_id": chat_request.chat_id}
+            if error is None:
+                result, response_time_ms = outcome
+                succeeded += 1
+                history.append({
+                    "chat_id": chat_request.chat_id,
+                    "answer": result.response,
+                    "model_gpt": result.model,
+                    "token": result.tokens_used,
+                    "prompt_tokens": result.prompt_tokens,
+                    "completion_tokens": result.completion_tokens,
+                    "response_time_ms": response_time_ms,
+                    "api_key_id": api_key_id,
+                })
+                await record_completion(result.model, api_key_id, result.prompt_tokens, result.completion_tokens, response_time_ms)
+                if len(history) >= CHAT_BATCH_FLUSH_SIZE:
+                    await _flush()
+                line.update(
+                    status="ok",
+                    response=result.response,
+                    usage={
+                        "prompt_tokens": result.prompt_tokens,
+                        "completion_tokens": result.completion_tokens,
+                        "total_tokens": result.tokens_used,
+                    }
+                )
+            else:
+                line.update(status="error", **error_fields(error))
+            yield json.dumps(line, ensure_ascii=False) + "\n"
+
+        total = len(batch.items)
+        yield json.dumps({"done": True, "total": total, "succeeded": succeeded, "failed": total - succeeded}) + "\n"
+    finally:
+        # Записываем уже полученные ответы, даже если клиент отключился
+        await asyncio.shield(_flush())
+
+@router.post("/completions/batch")
+async def generate_completion_batch(
+    batch: ChatBatchRequest,
+    x_cache_bypass: Optional[str] = Header(None),
+    tenant: Tenant = Depends(get_tenant),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
+    """
+    Выполняет пакет запросов chat completions.
+
+    Параметры:
+        batch: ChatBatchRequest - Пакет:
+            - items: запросы (chat_id, model, messages - как в ChatRequest)
+            - concurrency: сколько запросов выполнять одновременно
+              (опционально, не больше CHAT_BATCH_CONCURRENCY)
+        x_cache_bypass: str - Заголовок X-Cache-Bypass; значения "1"/"true"/"yes"
+            отключают чтение кэша ответов для всего пакета (опционально)
+
+    Возвращает:
+        StreamingResponse: Поток application/x-ndjson. Каждая строка - результат одного
+            запроса в порядке завершения: {"index", "chat_id", "status": "ok", "response", "usage"}
+            или {"index", "chat_id", "status": "error", "error", "detail", "status_code", "retry_after"}.
+            Последняя строка - итоги {"done": true, "total", "succeeded", "failed"}.
+
+    Описание:
+        Запросы выполняются ограниченным числом воркеров через OpenAIService (кэш ответов,
+        планировщик и повторы работают как для одиночных запросов). Ошибка одного запроса
+        не прерывает пакет. Успешные ответы сохраняются в историю чатов пачками.
+        Лимит ключа (app.core.rate_limit) проверяется для каждого запроса: запрос ждет
+        освобождения лимита до RATE_LIMIT_MAX_WAIT секунд, затем получает ошибку 429.
+    """
+    bypass_cache = (x_cache_bypass or "").lower() in ("1", "true", "yes")
+    concurrency = min(batch.concurrency or CHAT_BATCH_CONCURRENCY, CHAT_BATCH_CONCURRENCY)
+    return StreamingResponse(
+        _stream_chat_batch(openai_service, batch, concurrency, tenant, bypass_cache),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
+@router.post("/vision", response_model=dict)
+async def describe_image(
+    file: UploadFile = File(...),
+    prompt: str = Form("What's in this image?"),
+    tenant: Tenant = Depends(get_tenant),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
+    """
+    Отвечает на вопрос о загруженном изображении.
+
+    Параметры (multipart/form-data):
+        file: UploadFile - Изображение (JPEG, PNG, WebP, GIF и другие форматы, понятные Pillow)
+        prompt: str - Вопрос к изображению (опционально)
+
+    Возвращает:
+        dict: response - ответ модели, usage - prompt_tokens, completion_tokens и total_tokens
+
+    Вызывает:
+        HTTPException:
+            - 400: Файл не является изображением или больше VISION_MAX_IMAGE_BYTES
+            - 500: При других ошибках
+        UpstreamError: Ответ OpenAI не получен
+        RateLimitExceeded: 429 - превышен лимит ключа
+
+    Описание:
+        Изображение уменьшается под модель и пережимается в пуле процессов перед отправкой,
+        повторные изображения получают сохраненный ответ (см. OpenAIService.process_image).
+    """
+    reservation = await rate_limiter.acquire(
+        tenant, "vision", VISION_MODEL, tokens=count_text_tokens(prompt, VISION_MODEL)
+    )
+    settled = False
+    try:
+        data = await file.read(VISION_MAX_IMAGE_BYTES + 1)
+        result = await openai_service.process_image_data(data, prompt)
+        await reservation.reconcile(result.tokens_used)
+        settled = True
+        return {
+            "response": result.response,
+            "usage": {
+                "prompt_tokens": result.prompt_tokens,
+                "completion_tokens": result.completion_tokens,
+                "total_tokens": result.tokens_used,
+            },
+        }
+    except (UpstreamError, HTTPException):
+        raise
+    except InvalidImage as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        # Ответ модели не получен: оценка токенов возвращается в лимит ключа
+        if not settled:
+            await asyncio.shield(reservation.reconcile(0))
@@ -1,39 +1,70 @@
-from fastapi import APIRouter, HTTPException, Query
-from typing import List, Optional
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Literal, Optional
 from datetime import datetime
-from app.models.history import HistoryResponse
-from app.db.database import get_history
+from app.models.history import HistoryResponse, HistoryPage
+from app.db.database import get_history, get_history_page
+from app.db.models import ChatHistory
 from app.core.logging import logs_bot
+from app.core.security import Tenant, get_tenant
 
 router = APIRouter()
-@router.get("", response_model=List[HistoryResponse])
+
+def _history_item(row: ChatHistory) -> HistoryResponse:
+    """Преобразует запись chat_history в элемент ответа."""
+    return HistoryResponse(
+        id=str(row.chat_id),
+        model=row.model_gpt or "",
+        request=row.question or "",
+        response=row.answer or "",
+        tokens_used=row.token or 0,
+        created_at=row.created_at
+    )
+
+@router.get("", response_model=HistoryPage)
 async def get_chat_history(
     model: Optional[str] = Query(None),
     start_date: Optional[datetime] = Query(None),
     end_date: Optional[datetime] = Query(None),
-    page: int = Query(1, ge=1),
-    page_size: int = Query(10, ge=1, le=100)
+    cursor: Optional[str] = Query(None),
+    page_size: int = Query(10, ge=1, le=100),
+    total: Literal["none", "exact", "estimate"] = Query("none"),
+    page: Optional[int] = Query(None, ge=1, deprecated=True),
+    tenant: Tenant = Depends(get_tenant)
 ):
     """
     Получает историю чата на основе заданных параметров.
 
     Эта функция извлекает историю чата из базы данных, используя параметры
-    фильтрации, такие как модель, дата начала и дата окончания. Она также
-    поддерживает пагинацию через параметры страницы и размера страницы.
+    фильтрации, такие как модель, дата начала и дата окончания. Записи отдаются
+    от новых к старым с keyset-пагинацией: следующую (предыдущую) страницу
+    запрашивают, передав next_cursor (prev_cursor) из ответа в параметр cursor.
+    Возвращаются только чаты API-ключа запроса.
 
     Параметры:
         model (Optional[str]): Модель, по которой будет фильтроваться история.
-        start_date (Optional[datetime]): Дата начала для фильтрации истории.
-        end_date (Optional[datetime]): Дата окончания для фильтрации истории.
-        page (int): Номер страницы для пагинации (по умолчанию 1).
+        start_date (Optional[datetime]): Дата начала для фильтрации истории (UTC).
+        end_date (Optional[datetime]): Дата окончания для фильтрации истории (UTC).
+        cursor (Optional[str]): Курсор страницы из предыдущего ответа.
         page_size (int): Количество записей на странице (по умолчанию 10, максимум 100).
+        total (str): Подсчет общего количества записей: none (по умолчанию),
+                     exact (точный count) или estimate (приблизительная оценка).
+        page (Optional[int]): Номер страницы для пагинации через OFFSET (устарело,
+                              медленно на глубоких страницах; курсоры не возвращаются).
 
     Возвращает:
-        List[HistoryResponse]: Список объектов истории чата.
+        HistoryPage: Записи истории чата, курсоры соседних страниц и количество записей.
     """
+    api_key_id = tenant.api_key_id
     try:
-        history, total = await get_history(model, start_date, end_date, page, page_size)
-        return history
+        if page is not None:
+            history, count = await get_history(model, start_date, end_date, page, page_size, api_key_id)
+            return HistoryPage(items=[_history_item(row) for row in history], total=count)
+
+        result = await get_history_page(model, start_date, end_date, page_size, cursor, total, api_key_id)
+        result["items"] = [_history_item(row) for row in result["items"]]
+        return HistoryPage(**result)
+    except ValueError as e:
+        raise HTTPException(status_code=400, detail=str(e))
     except Exception as e:
         await logs_bot("error", f"Ошибка получения истории: {str(e)}")
         raise HTTPException(status_code=500, detail=str(e))
@@ -1,15 +1,26 @@
-from fastapi import APIRouter, Depends, File, UploadFile, HTTPException
-from typing import Optional
-from app.core.security import get_api_key
-from app.models.image import ImageGeneration
+from fastapi import APIRouter, Depends, File, UploadFile, HTTPException, Query
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional
+import json
+from app.core.config import IMAGE_BATCH_CONCURRENCY, IMAGE_MODEL
+from app.core.rate_limit import rate_limiter
+from app.core.security import Tenant, get_tenant
+from app.core.errors import UpstreamError
+from app.models.image import ImageGeneration, ImageBatchRequest
 from app.models.chat import ImageGenerationRequest, ImageGenerationResponse
-from app.services.openai import OpenAIService
+from app.services.jobs import JobQueueFull, job_manager
+from app.services.openai import OpenAIService, get_openai_service
+from app.api.v1.endpoints.jobs import job_accepted, queue_full_error
 
 router = APIRouter()
-openai_service = OpenAIService()
 
 @router.post("/generate", response_model=ImageGenerationResponse)
-async def generate_image(request: ImageGenerationRequest):
+async def generate_image(
+    request: ImageGenerationRequest,
+    async_job: bool = Query(False, alias="async"),
+    tenant: Tenant = Depends(get_tenant),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
     """
     Генерирует изображение по описанию.
     
@@ -17,25 +28,110 @@ async def generate_image(request: ImageGenerationRequest):
         request: ImageGenerationRequest - Модель с данными для генерации изображения:
             - prompt: описание для генерации изображения
             - size: размер изображения (опционально)
+        async_job: bool - Параметр ?async=true: не ждать генерации, а поставить
+            фоновую задачу (опционально)
     
     Возвращает:
         ImageGenerationResponse: URL сгенерированного изображения.
+        JSONResponse: При async=true - 202 с JobAccepted; результат задачи
+            ({"image_url"}) получают через GET /api/v1/jobs/{job_id}
     
     Вызывает:
-        HTTPException: При ошибках генерации изображения.
+        HTTPException: При ошибках генерации изображения (503 - очередь фоновых задач заполнена).
+        RateLimitExceeded: 429 - превышен лимит ключа (проверяется и при постановке фоновой задачи)
     """
+    api_key_id = tenant.api_key_id
+    reservation = await rate_limiter.acquire(tenant, "images", IMAGE_MODEL)
+    if async_job:
+        try:
+            job = await job_manager.submit(
+                "image",
+                {"prompt": request.prompt, "size": request.size},
+                api_key_id
+            )
+        except JobQueueFull as e:
+            raise queue_full_error(str(e))
+        return job_accepted(job)
+
     try:
         image_url = await openai_service.generate_image(request.prompt, request.size)
         return ImageGenerationResponse(image_url=image_url)
+    except UpstreamError:
+        await reservation.reconcile(0)
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=str(e))
 
+"""
+    curl -N -X POST 'http://localhost:8000/api/v1/images/generate/batch' \
+    -H 'Content-Type: application/json' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw' \
+    -d '{
+        "items": [
+            {"id": "sku-1", "prompt": "red sneakers on white background"},
+            {"id": "sku-2", "prompt": "blue backpack on white background", "n": 2}
+        ],
+        "concurrency": 4
+    }'
+"""
+
+async def _stream_image_batch(
+    openai_service: OpenAIService,
+    batch: ImageBatchRequest,
+    concurrency: int,
+    tenant: Tenant
+) -> AsyncIterator[str]:
+    """
+    Отдает результаты пакетной генерации в формате NDJSON (одна JSON-строка на элемент)
+    в порядке завершения, а в конце - строку с итогами {"done", "total", "succeeded", "failed"}.
+    """
+    succeeded = 0
+    async for result in openai_service.generate_image_batch(batch.items, concurrency, tenant):
+        succeeded += result["status"] == "ok"
+        yield json.dumps(result, ensure_ascii=False) + "\n"
+    total = len(batch.items)
+    yield json.dumps({"done": True, "total": total, "succeeded": succeeded, "failed": total - succeeded}) + "\n"
+
+@router.post("/generate/batch")
+async def generate_image_batch(
+    batch: ImageBatchRequest,
+    tenant: Tenant = Depends(get_tenant),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
+    """
+    Генерирует изображения для пакета описаний.
+
+    Параметры:
+        batch: ImageBatchRequest - Пакет:
+            - items: элементы (prompt, а также необязательные id, size, quality и n)
+            - concurrency: сколько элементов генерировать одновременно
+              (опционально, не больше IMAGE_BATCH_CONCURRENCY)
+
+    Возвращает:
+        StreamingResponse: Поток application/x-ndjson. Каждая строка - результат одного
+            элемента в порядке завершения: {"index", "id", "status": "ok", "image_urls"}
+            или {"index", "id", "status": "error", "error", "detail", "status_code", "retry_after"}.
+            Последняя строка - итоги {"done": true, "total", "succeeded", "failed"}.
+
+    Описание:
+        Ошибка одного элемента не прерывает и не задерживает пакет: она возвращается
+        в строке этого элемента, остальные элементы продолжают генерироваться.
+        Элемент ждет освобождения лимита ключа до RATE_LIMIT_MAX_WAIT секунд, затем
+        получает ошибку 429 в своей строке.
+    """
+    concurrency = min(batch.concurrency or IMAGE_BATCH_CONCURRENCY, IMAGE_BATCH_CONCURRENCY)
+    return StreamingResponse(
+        _stream_image_batch(openai_service, batch, concurrency, tenant),
+        media_type="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+    )
+
 @router.post("/edit")
 async def edit_image(
     image: UploadFile = File(...),
     mask: Optional[UploadFile] = File(None),
     prompt: str = None,
-    api_key: str = Depends(get_api_key)
+    tenant: Tenant = Depends(get_tenant)
 ):
     """Редактирует изображение (заглушка)"""
     return {"status": "not implemented"} 
\ No newline at end of file
@@ -0,0 +1,105 @@
+from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi.responses import JSONResponse
+import uuid
+from app.core.config import JOBS_LONG_POLL_MAX
+from app.core.security import Tenant, get_tenant
+from app.db.database import get_job
+from app.db.models import Job
+from app.models.job import JobAccepted, JobInfo
+from app.services.jobs import ACTIVE_STATUSES, job_manager
+
+router = APIRouter()
+
+# Через сколько секунд клиенту стоит повторить запрос, если очередь задач заполнена
+QUEUE_FULL_RETRY_AFTER = 5
+
+
+def job_accepted(job: Job) -> JSONResponse:
+    """
+    Ответ 202 Accepted на постановку фоновой задачи.
+
+    Возвращает:
+        JSONResponse: JobAccepted и заголовок Location с адресом для опроса
+    """
+    status_url = f"/api/v1/jobs/{job.id}"
+    body = JobAccepted(job_id=str(job.id), status=job.status, status_url=status_url)
+    return JSONResponse(status_code=202, content=body.model_dump(), headers={"Location": status_url})
+
+def queue_full_error(detail: str) -> HTTPException:
+    """Ошибка 503 для заполненной очереди фоновых задач (JobQueueFull)."""
+    return HTTPException(status_code=503, detail=detail, headers={"Retry-After": str(QUEUE_FULL_RETRY_AFTER)})
+
+def _job_info(job: Job) -> JobInfo:
+    """Преобразует запись jobs в ответ (параметры задачи клиенту не отдаются)."""
+    return JobInfo(
+        job_id=str(job.id),
+        kind=job.kind,
+        status=job.status,
+        created_at=job.created_at,
+        started_at=job.started_at,
+        finished_at=job.finished_at,
+        expires_at=job.expires_at,
+        result=job.result,
+        error=job.error
+    )
+
+def _check_owner(job: Job, tenant: Tenant) -> None:
+    # Чужая задача неотличима от несуществующей
+    if job is None or job.api_key_id != tenant.api_key_id:
+        raise HTTPException(status_code=404, detail="Job not found")
+
+
+"""
+    curl -X POST 'http://localhost:8000/api/v1/images/generate?async=true' \
+    -H 'Content-Type: application/json' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw' \
+    -d '{"prompt": "red sneakers on white background"}'
+
+    curl 'http://localhost:8000/api/v1/jobs/0b5c3f0e-8f0a-4c55-9a43-6b1d8a3c2f11?wait=30' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw'
+"""
+
+@router.get("/{job_id}", response_model=JobInfo)
+async def get_job_status(
+    job_id: uuid.UUID,
+    wait: float = Query(0, ge=0, le=JOBS_LONG_POLL_MAX),
+    tenant: Tenant = Depends(get_tenant)
+):
+    """
+    Возвращает состояние фоновой задачи.
+
+    Параметры:
+        job_id: UUID - Идентификатор задачи (из ответа 202 на постановку)
+        wait: float - Long-poll: сколько секунд ждать завершения задачи,
+            прежде чем ответить (0 - ответить сразу, максимум JOBS_LONG_POLL_MAX)
+
+    Возвращает:
+        JobInfo: Статус (queued, running, succeeded, failed, cancelled), время
+            создания, начала, завершения и удаления задачи, результат или ошибка.
+            Результат: для image - {"image_url"}, для transcription - TranscriptionResult.
+
+    Вызывает:
+        HTTPException: 404 - задачи нет, она удалена по сроку хранения или принадлежит другому ключу.
+    """
+    job = await job_manager.wait(job_id, wait)
+    _check_owner(job, tenant)
+    return _job_info(job)
+
+@router.post("/{job_id}/cancel", response_model=JobInfo)
+async def cancel_job(job_id: uuid.UUID, tenant: Tenant = Depends(get_tenant)):
+    """
+    Отменяет фоновую задачу в статусе queued или running.
+
+    Возвращает:
+        JobInfo: Состояние задачи после отмены.
+
+    Вызывает:
+        HTTPException:
+            - 404: Задачи нет или она принадлежит другому ключу
+            - 409: Задача уже завершена
+    """
+    job = await get_job(job_id)
+    _check_owner(job, tenant)
+    if job.status not in ACTIVE_STATUSES or not await job_manager.cancel(job):
+        raise HTTPException(status_code=409, detail="Job is already finished")
+    return _job_info(await get_job(job_id))
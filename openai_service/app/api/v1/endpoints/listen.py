@@ -1,12 +1,157 @@
-from fastapi import APIRouter, Depends, File, UploadFile
-from typing import Optional
-from app.core.security import get_api_key
-from app.models.transcription import TranscriptionOptions
+from fastapi import APIRouter, Depends, File, Form, Header, HTTPException, UploadFile
+from fastapi.responses import StreamingResponse
+from typing import AsyncIterator, Optional
+from app.core.errors import UpstreamError
+from app.core.rate_limit import rate_limiter
+from app.core.sse import sse_event
+from app.core.security import Tenant, get_tenant
+from app.models.transcription import TranscriptionResult
+from app.services.audio import UploadTooLarge, make_workdir, remove_workdir, spool_upload
+from app.services.jobs import JobQueueFull, job_manager
+from app.services.openai import OpenAIService, get_openai_service
+from app.api.v1.endpoints.jobs import job_accepted, queue_full_error
+import hashlib
 
 router = APIRouter()
 
 
-@router.post("/transcription")
-async def create_transcription(transcription: TranscriptionOptions, api_key: str = Depends(get_api_key)):
-    """Преобразует аудио в текст"""
-    return {"text": "transcribed_text"} 
\ No newline at end of file
+"""
+    curl -N -X POST 'http://localhost:8000/api/v1/listen/transcription' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw' \
+    -F 'file=@meeting.mp3' \
+    -F 'language=ru' \
+    -F 'stream=true'
+"""
+
+async def _stream_transcription(
+    openai_service: OpenAIService,
+    path: str,
+    workdir: str,
+    language: Optional[str],
+    audio_sha256: str,
+    bypass_cache: bool
+) -> AsyncIterator[str]:
+    """
+    Отдает сегменты транскрипции клиенту в формате SSE по мере готовности.
+
+    События: сегменты {"index", "start", "end", "text"}, затем "done" с полным текстом
+    или "error". Временный каталог с загруженным файлом удаляется по завершении потока.
+    """
+    parts = []
+    duration = None
+    try:
+        async for segment in openai_service.stream_transcription(path, language, audio_sha256=audio_sha256, bypass_cache=bypass_cache):
+            if segment["text"]:
+                parts.append(segment["text"])
+            duration = segment["end"]
+            yield sse_event(segment)
+    except UpstreamError as e:
+        yield sse_event({"detail": str(e), "status_code": e.status_code, "retry_after": e.retry_after}, event="error")
+        return
+    except Exception as e:
+        yield sse_event({"detail": str(e)}, event="error")
+        return
+    finally:
+        await remove_workdir(workdir)
+
+    yield sse_event({"text": " ".join(parts), "duration": duration}, event="done")
+    yield "data: [DONE]\n\n"
+
+@router.post("/transcription", response_model=TranscriptionResult)
+async def create_transcription(
+    file: UploadFile = File(...),
+    language: Optional[str] = Form(None),
+    stream: bool = Form(False),
+    async_job: bool = Form(False, alias="async"),
+    x_cache_bypass: Optional[str] = Header(None),
+    tenant: Tenant = Depends(get_tenant),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
+    """
+    Преобразует загруженную аудиозапись в текст.
+
+    Параметры (multipart/form-data):
+        file: UploadFile - Аудиофайл (mp3, wav, m4a, ogg, webm и другие форматы, понятные ffmpeg)
+        language: str - Язык записи в формате ISO-639-1 (опционально)
+        stream: bool - Отдавать сегменты потоком Server-Sent Events по мере готовности (опционально)
+        async: bool - Не ждать транскрипции, а поставить фоновую задачу (опционально,
+            несовместимо со stream)
+        x_cache_bypass: str - Заголовок X-Cache-Bypass; значения "1"/"true"/"yes"
+            отключают чтение кэша транскрипций для этого запроса (опционально)
+
+    Возвращает:
+        TranscriptionResult: Полный текст, длительность записи и сегменты.
+        StreamingResponse: При stream=true - поток text/event-stream с сегментами,
+            событием "done" ({"text", "duration"}) и завершающим "data: [DONE]"
+        JSONResponse: При async=true - 202 с JobAccepted; результат задачи
+            (TranscriptionResult) получают через GET /api/v1/jobs/{job_id}
+
+    Вызывает:
+        HTTPException:
+            - 400: Одновременно заданы stream и async
+            - 413: Файл больше AUDIO_MAX_UPLOAD_BYTES
+            - 503: Очередь фоновых задач заполнена
+            - 500: При других ошибках
+        UpstreamError: Транскрипция не получена от OpenAI API
+        RateLimitExceeded: 429 - превышен лимит ключа (проверяется до загрузки файла)
+
+    Описание:
+        Файл сохраняется во временный каталог кусками, без чтения в память целиком
+        и без блокирующего ввода-вывода в event loop. Длинные записи делятся на
+        перекрывающиеся сегменты, которые транскрибируются параллельно
+        и склеиваются по порядку (см. OpenAIService.stream_transcription).
+
+        SHA-256 файла считается по ходу загрузки: по нему (вместе с моделью и языком)
+        повторно присланная запись находится в кэше транскрипций без обращения к Whisper.
+    """
+    if stream and async_job:
+        raise HTTPException(status_code=400, detail="stream and async cannot be combined")
+
+    api_key_id = tenant.api_key_id
+    await rate_limiter.acquire(tenant, "transcription", "whisper-1")
+
+    bypass_cache = (x_cache_bypass or "").lower() in ("1", "true", "yes")
+    hasher = hashlib.sha256()
+    workdir = await make_workdir()
+    try:
+        path = await spool_upload(file, workdir, hasher=hasher)
+    except UploadTooLarge as e:
+        await remove_workdir(workdir)
+        raise HTTPException(status_code=413, detail=str(e))
+    except Exception:
+        await remove_workdir(workdir)
+        raise
+
+    if async_job:
+        # Загруженный файл остается во временном каталоге до завершения задачи
+        params = {"path": path, "language": language, "audio_sha256": hasher.hexdigest(), "bypass_cache": bypass_cache}
+        try:
+            job = await job_manager.submit(
+                "transcription",
+                params,
+                api_key_id,
+                cleanup=lambda: remove_workdir(workdir)
+            )
+        except JobQueueFull as e:
+            await remove_workdir(workdir)
+            raise queue_full_error(str(e))
+        except Exception:
+            await remove_workdir(workdir)
+            raise
+        return job_accepted(job)
+
+    if stream:
+        return StreamingResponse(
+            _stream_transcription(openai_service, path, workdir, language, hasher.hexdigest(), bypass_cache),
+            media_type="text/event-stream",
+            headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"}
+        )
+
+    try:
+        return await openai_service.transcribe_file(path, language, hasher.hexdigest(), bypass_cache)
+    except UpstreamError:
+        raise
+    except Exception as e:
+        raise HTTPException(status_code=500, detail=str(e))
+    finally:
+        await remove_workdir(workdir)
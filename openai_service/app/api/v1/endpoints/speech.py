@@ -1,20 +1,123 @@
-from fastapi import APIRouter, Depends, HTTPException
+from fastapi import APIRouter, Depends, Header, HTTPException
+from fastapi.responses import FileResponse, StreamingResponse
+from typing import AsyncIterator, Optional
 from app.models.speech import SpeechCreate
-from app.core.security import get_api_key
+from app.core.security import Tenant, get_tenant
+from app.core.errors import UpstreamError
+from app.core.rate_limit import rate_limiter
 from app.models.chat import SpeechRequest, TranscriptionResponse
-from app.services.openai import OpenAIService
+from app.services.audio import speech_cache_key
+from app.services.disk_cache import DiskCacheWriter, speech_cache
+from app.services.openai import OpenAIService, get_openai_service
 
 router = APIRouter()
-openai_service = OpenAIService()
 
+# Форматы синтеза речи OpenAI API и их MIME-типы
+SPEECH_MEDIA_TYPES = {
+    "mp3": "audio/mpeg",
+    "opus": "audio/ogg",
+    "aac": "audio/aac",
+    "flac": "audio/flac",
+    "wav": "audio/wav",
+    "pcm": "audio/pcm",
+}
+
+
+"""
+    curl -X POST 'http://localhost:8000/api/v1/speech/create' \
+    -H 'Content-Type: application/json' \
+    -H 'X-API-Key: asdfa33945asdf2awfasdfaw' \
+    -d '{"chat_id": "ivr", "text": "Здравствуйте! Оставайтесь на линии.", "voice": "alloy"}' \
+    --output greeting.mp3
+"""
+
+async def _tee_speech(first: bytes, stream: AsyncIterator[bytes], cache_writer: DiskCacheWriter) -> AsyncIterator[bytes]:
+    """
+    Отдает аудио клиенту по мере получения и параллельно пишет его в кэш.
+
+    Запись в кэше публикуется только после полного ответа upstream; при обрыве
+    потока или отключении клиента временный файл удаляется.
+    """
+    try:
+        chunk = first
+        while chunk is not None:
+            await cache_writer.write(chunk)
+            yield chunk
+            chunk = await stream.__anext__()
+    except StopAsyncIteration:
+        await cache_writer.commit()
+    finally:
+        await cache_writer.abort()
+        await stream.aclose()
 
 @router.post("/create")
-async def create_speech(speech: SpeechCreate, api_key: str = Depends(get_api_key)):
-    """Создает аудио из текста"""
-    return {"audio_url": "generated_audio_url"}
+async def create_speech(
+    speech: SpeechCreate,
+    tenant: Tenant = Depends(get_tenant),
+    x_cache_bypass: Optional[str] = Header(None),
+    openai_service: OpenAIService = Depends(get_openai_service)
+):
+    """
+    Создает аудио из текста.
+
+    Параметры:
+        speech: SpeechCreate - Модель с данными для синтеза:
+            - text: текст для озвучивания
+            - voice: голос (опционально, по умолчанию alloy)
+            - model: модель (опционально, по умолчанию tts-1)
+            - response_format: формат аудио mp3, opus, aac, flac, wav или pcm (опционально)
+        x_cache_bypass: str - Заголовок X-Cache-Bypass; значения "1"/"true"/"yes"
+            отключают чтение кэша аудио для этого запроса (опционально)
+
+    Возвращает:
+        FileResponse: Аудио из кэша на диске (поддерживает Range-запросы).
+        StreamingResponse: Аудио, ретранслируемое из OpenAI API фрагментами
+            (chunked transfer) по мере синтеза.
+
+    Вызывает:
+        HTTPException: 400 - неизвестный формат аудио
+        UpstreamError: Синтез не удалось начать
+        RateLimitExceeded: 429 - превышен лимит ключа (ответы из кэша лимит не расходуют)
+
+    Описание:
+        Готовое аудио кэшируется на диске по (text, voice, model, response_format)
+        с вытеснением давно не запрашиваемых записей по лимиту SPEECH_CACHE_MAX_BYTES.
+        Повторные запросы одного и того же текста отдаются файлом без обращения к OpenAI API.
+        Ответ upstream не буферизуется: фрагменты одновременно уходят клиенту и в файл кэша.
+    """
+    response_format = (speech.response_format or "mp3").lower()
+    media_type = SPEECH_MEDIA_TYPES.get(response_format)
+    if media_type is None:
+        raise HTTPException(status_code=400, detail=f"Unsupported response_format: {speech.response_format}")
+    voice = speech.voice or "alloy"
+    model = speech.model or "tts-1"
+
+    key = speech_cache_key(speech.text, voice, model, response_format)
+    if (x_cache_bypass or "").lower() in ("1", "true", "yes"):
+        speech_cache.bypass()
+    else:
+        path = await speech_cache.lookup(key)
+        if path is not None:
+            return FileResponse(path, media_type=media_type, headers={"X-Cache": "hit"})
+
+    await rate_limiter.acquire(tenant, "speech", model)
+
+    # Первый фрагмент получаем до начала ответа: ошибки upstream превращаются
+    # в обычный ответ с кодом ошибки, а не в оборванный поток со статусом 200
+    stream = openai_service.stream_speech(speech.text, voice, model, response_format)
+    try:
+        first = await stream.__anext__()
+    except StopAsyncIteration:
+        raise UpstreamError("tts", model, "Empty response from OpenAI API")
+
+    return StreamingResponse(
+        _tee_speech(first, stream, speech_cache.writer(key)),
+        media_type=media_type,
+        headers={"X-Cache": "miss"}
+    )
 
 @router.post("/transcribe", response_model=TranscriptionResponse)
-async def transcribe_audio(request: SpeechRequest):
+async def transcribe_audio(request: SpeechRequest, openai_service: OpenAIService = Depends(get_openai_service)):
     """
     Транскрибирует аудиофайл в текст.
     
@@ -31,5 +134,7 @@ async def transcribe_audio(request: SpeechRequest):
     try:
         transcription = await openai_service.transcribe_audio(request.audio_file)
         return TranscriptionResponse(transcription=transcription)
+    except UpstreamError:
+        raise
     except Exception as e:
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e))
@@ -1,25 +1,157 @@
-from fastapi import APIRouter, HTTPException
+from fastapi import APIRouter, Depends, HTTPException, Query
+from typing import Optional
+from datetime import datetime
 from app.models.history import StatisticsResponse
-from app.db.database import get_statistics
+from app.db.database import get_pool_stats
+from app.db.rollups import get_statistics
 from app.core.logging import logs_bot
+from app.core.rate_limit import rate_limiter
+from app.core.security import Tenant, api_key_store, get_tenant
+from app.services.cache import chat_cache
+from app.services.disk_cache import speech_cache, transcription_cache
+from app.services.jobs import job_manager
+from app.services.scheduler import upstream_scheduler
+from app.services.resilience import resilience
+from app.services.vision import image_preprocessor, vision_answers
 
 router = APIRouter()
+# Счетчики всего процесса (кэши, пулы, лимиты, проверка ключей всех клиентов) -
+# только для оператора сервиса (app.core.security.require_admin)
+admin_router = APIRouter()
 
 @router.get("", response_model=StatisticsResponse)
-async def get_usage_statistics():
+async def get_usage_statistics(
+    start: Optional[datetime] = Query(None),
+    end: Optional[datetime] = Query(None),
+    model: Optional[str] = Query(None),
+    api_key_id: Optional[str] = Query(None),
+    series: bool = Query(False),
+    tenant: Tenant = Depends(get_tenant)
+):
     """
-    Получает статистику использования из базы данных.
+    Получает статистику использования из почасовых агрегатов.
 
-    Эта функция вызывает метод `get_statistics`, чтобы получить текущую
-    статистику. Если запрос успешен, она возвращает статистику. В случае
-    ошибки функция записывает сообщение об ошибке и вызывает исключение HTTP 500.
+    Эта функция вызывает метод `get_statistics`, чтобы получить статистику
+    за указанный диапазон. Читаются только агрегаты (app.db.rollups), поэтому
+    стоимость запроса зависит от количества часов в диапазоне, а не от размера
+    истории. Статистика считается только по API-ключу запроса. В случае ошибки
+    функция записывает сообщение об ошибке и вызывает исключение HTTP 500.
+
+    Parameters:
+        start (Optional[datetime]): Начало диапазона в UTC (округляется вниз до часа).
+        end (Optional[datetime]): Конец диапазона в UTC, не включительно.
+        model (Optional[str]): Фильтр по модели.
+        api_key_id (Optional[str]): Отпечаток API-ключа; допускается только отпечаток
+            ключа запроса (403 для чужого), по умолчанию - он же.
+        series (bool): Добавить разбивку по часам.
 
     Returns:
-        StatisticsResponse: Данные статистики, полученные из базы данных.
+        StatisticsResponse: Количество запросов и токенов, среднее время ответа
+            и его перцентили (в миллисекундах).
     """
+    caller_id = tenant.api_key_id
+    if api_key_id is not None and api_key_id != caller_id:
+        raise HTTPException(status_code=403, detail="Statistics of other API keys are not available")
     try:
-        stats = await get_statistics()
+        stats = await get_statistics(start, end, model, caller_id, series)
         return stats
     except Exception as e:
         await logs_bot("error", f"Ошибка получения статистики: {str(e)}")
-        raise HTTPException(status_code=500, detail=str(e)) 
\ No newline at end of file
+        raise HTTPException(status_code=500, detail=str(e)) 
+
+@admin_router.get("/cache")
+async def get_cache_statistics():
+    """
+    Возвращает счетчики кэша ответов chat completions.
+
+    Returns:
+        dict: hits, misses, coalesced (запросы, объединенные с уже выполняющимся),
+              bypassed (запросы с X-Cache-Bypass), size и inflight.
+    """
+    return chat_cache.stats()
+
+
+@admin_router.get("/cache/disk")
+async def get_disk_cache_statistics():
+    """
+    Возвращает счетчики кэшей на диске.
+
+    Returns:
+        dict: Для каждого кэша (transcriptions, speech) - hits, misses, bypassed (запросы
+              с X-Cache-Bypass), evictions, entries, bytes и max_bytes.
+    """
+    return {"transcriptions": transcription_cache.stats(), "speech": speech_cache.stats()}
+
+
+@admin_router.get("/pool")
+async def get_pool_statistics():
+    """
+    Возвращает текущее состояние пула соединений с базой данных.
+
+    Returns:
+        dict: Профиль движка, размер пула, занятые/свободные соединения, overflow,
+              среднее и максимальное время ожидания соединения, события overflow и таймауты.
+    """
+    return get_pool_stats()
+
+
+@admin_router.get("/upstream")
+async def get_upstream_statistics():
+    """
+    Возвращает состояние планировщика и слоя устойчивости вызовов OpenAI API.
+
+    Returns:
+        dict: limiters - для каждой пары "операция:модель" текущий адаптивный лимит,
+              выполняющиеся и ожидающие запросы, сглаженная и базовая задержка;
+              breakers - состояние предохранителей моделей;
+              hedge_delay_ms - задержка хеджирующего запроса.
+    """
+    return {"limiters": upstream_scheduler.stats(), **resilience.stats()}
+
+
+@admin_router.get("/vision")
+async def get_vision_statistics():
+    """
+    Возвращает счетчики предобработки изображений для vision-моделей.
+
+    Returns:
+        dict: enabled (установлен ли Pillow), processed и reused (обработанные и взятые
+              из кэша изображения), bytes_in и bytes_out (объем до и после обработки),
+              cached (изображения в кэше), answers (ответы в кэше по SHA-256 изображения).
+    """
+    return {**image_preprocessor.stats(), "answers": len(vision_answers)}
+
+@admin_router.get("/jobs")
+async def get_jobs_statistics():
+    """
+    Возвращает состояние воркеров фоновых задач этого процесса.
+
+    Returns:
+        dict: workers (число воркеров), queued (задачи в очереди процесса),
+              running (выполняющиеся задачи).
+    """
+    return job_manager.stats()
+
+@admin_router.get("/rate-limit")
+async def get_rate_limit_statistics():
+    """
+    Возвращает настройки и счетчики лимитов запросов этого процесса.
+
+    Returns:
+        dict: enabled, backend (MemoryBackend или LimitsBackend), rpm и tpm (лимиты
+              по умолчанию), admitted и rejected (пропущенные и отклоненные запросы).
+    """
+    return rate_limiter.stats()
+
+@admin_router.get("/auth")
+async def get_auth_statistics():
+    """
+    Возвращает счетчики проверки API-ключей этого процесса.
+
+    Returns:
+        dict: tenants (ключи клиентов в памяти), legacy_key (задан ли API_KEY),
+              refreshes (загрузки ключей из базы), database_lookups (поиски неизвестных
+              ключей в базе), lookups_throttled (неизвестные ключи, отклоненные без поиска
+              сверх API_KEYS_LOOKUPS_PER_MINUTE), negative_hits и negative_cached (отрицательный кэш).
+    """
+    return api_key_store.stats()
@@ -1,11 +1,13 @@
 from fastapi import APIRouter, Depends
-from app.core.security import get_api_key
+from app.core.security import get_tenant, require_admin
+from app.services.scheduler import request_scheduling
 from app.api.v1.endpoints import (
     chat,
     images,
     speech,
     listen,
     history,
+    jobs,
     statistics
 )
 
@@ -14,11 +16,16 @@ api_router = APIRouter()
 
 # Включаются маршруты для различных конечных точек API, таких как чат, история, статистика и статистика использования.
 # Каждому маршруту присваивается префикс и теги, а также добавляется зависимость для проверки API-ключа.
-api_router.include_router(chat.router, prefix="/chat", tags=["chat"], dependencies=[Depends(get_api_key)])
-api_router.include_router(images.router, prefix="/images", tags=["images"], dependencies=[Depends(get_api_key)])
-api_router.include_router(speech.router, prefix="/speech", tags=["speech"], dependencies=[Depends(get_api_key)])
-api_router.include_router(listen.router, prefix="/listen", tags=["listen"], dependencies=[Depends(get_api_key)])
-api_router.include_router(history.router, prefix="/history", tags=["history"], dependencies=[Depends(get_api_key)])
+# Маршрутам, обращающимся к OpenAI API, добавляется зависимость с приоритетом и сроком ожидания
+# (заголовки X-Priority и X-Request-Timeout, см. app.services.scheduler).
+api_router.include_router(chat.router, prefix="/chat", tags=["chat"], dependencies=[Depends(get_tenant), Depends(request_scheduling)])
+api_router.include_router(images.router, prefix="/images", tags=["images"], dependencies=[Depends(get_tenant), Depends(request_scheduling)])
+api_router.include_router(speech.router, prefix="/speech", tags=["speech"], dependencies=[Depends(get_tenant), Depends(request_scheduling)])
+api_router.include_router(listen.router, prefix="/listen", tags=["listen"], dependencies=[Depends(get_tenant), Depends(request_scheduling)])
+api_router.include_router(jobs.router, prefix="/jobs", tags=["jobs"], dependencies=[Depends(get_tenant)])
+api_router.include_router(history.router, prefix="/history", tags=["history"], dependencies=[Depends(get_tenant)])
 
 
-api_router.include_router(statistics.router, prefix="/statistics", tags=["statistics"], dependencies=[Depends(get_api_key)])
\ No newline at end of file
+api_router.include_router(statistics.router, prefix="/statistics", tags=["statistics"], dependencies=[Depends(get_tenant)])
+# Счетчики процесса доступны только по ключу оператора (ADMIN_API_KEY), а не по ключам клиентов
+api_router.include_router(statistics.admin_router, prefix="/statistics", tags=["statistics"], dependencies=[Depends(require_admin)])
\ No newline at end of file
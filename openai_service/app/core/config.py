@@ -0,0 +1,183 @@
+from dotenv import load_dotenv
+import json
+import os
+import tempfile
+
+load_dotenv()
+
+# Кэш ответов chat completions (in-memory LRU с TTL + опциональный слой в базе данных)
+CHAT_CACHE_ENABLED: bool = os.getenv("CHAT_CACHE_ENABLED", "true").lower() == "true"
+CHAT_CACHE_MAX_ENTRIES: int = int(os.getenv("CHAT_CACHE_MAX_ENTRIES", "1024"))
+CHAT_CACHE_TTL: float = float(os.getenv("CHAT_CACHE_TTL", "300"))
+CHAT_CACHE_PERSISTENT: bool = os.getenv("CHAT_CACHE_PERSISTENT", "false").lower() == "true"
+CHAT_CACHE_PERSISTENT_TTL: float = float(os.getenv("CHAT_CACHE_PERSISTENT_TTL", "86400"))
+
+# Фоновая запись (write-behind) логов и истории чатов в базу данных
+WRITER_QUEUE_SIZE: int = int(os.getenv("WRITER_QUEUE_SIZE", "10000"))
+WRITER_BATCH_SIZE: int = int(os.getenv("WRITER_BATCH_SIZE", "500"))
+WRITER_FLUSH_INTERVAL: float = float(os.getenv("WRITER_FLUSH_INTERVAL", "0.5"))
+
+# Хранилище контекста сессий (in-memory LRU поверх таблицы context_sessions)
+SESSION_MEMORY_BUDGET: int = int(os.getenv("SESSION_MEMORY_BUDGET", str(64 * 1024 * 1024)))
+SESSION_CACHE_TTL: float = float(os.getenv("SESSION_CACHE_TTL", "5"))
+SESSION_CONTEXT_LENGTH: int = int(os.getenv("SESSION_CONTEXT_LENGTH", "10"))
+
+# Учет токенов и обрезка контекста под окно модели
+CHAT_COMPLETION_RESERVE: int = int(os.getenv("CHAT_COMPLETION_RESERVE", "1024"))
+TOKEN_COUNT_CACHE_SIZE: int = int(os.getenv("TOKEN_COUNT_CACHE_SIZE", "65536"))
+
+# Подключение к базе данных: профиль движка (dev/prod) и точечные переопределения его параметров
+DATABASE_URL: str = os.getenv("DATABASE_URL")
+DB_PROFILE: str = os.getenv("DB_PROFILE", "dev")
+DB_POOL_SIZE: str = os.getenv("DB_POOL_SIZE")
+DB_MAX_OVERFLOW: str = os.getenv("DB_MAX_OVERFLOW")
+DB_POOL_TIMEOUT: str = os.getenv("DB_POOL_TIMEOUT")
+DB_POOL_RECYCLE: str = os.getenv("DB_POOL_RECYCLE")
+DB_POOL_PRE_PING: str = os.getenv("DB_POOL_PRE_PING")
+DB_STATEMENT_CACHE_SIZE: str = os.getenv("DB_STATEMENT_CACHE_SIZE")
+DB_ECHO: str = os.getenv("DB_ECHO")
+
+# История чатов: время жизни кэша количества записей (для total=estimate без Postgres)
+HISTORY_COUNT_CACHE_TTL: float = float(os.getenv("HISTORY_COUNT_CACHE_TTL", "60"))
+
+# Метрики Prometheus: период замера задержки event loop (секунды).
+# Для нескольких воркеров задайте PROMETHEUS_MULTIPROC_DIR (пустой каталог, очищаемый при деплое).
+EVENT_LOOP_LAG_INTERVAL: float = float(os.getenv("EVENT_LOOP_LAG_INTERVAL", "0.5"))
+PROMETHEUS_MULTIPROC_DIR: str = os.getenv("PROMETHEUS_MULTIPROC_DIR")
+
+# Планировщик вызовов OpenAI API: адаптивный (AIMD) лимит одновременных запросов
+# на пару (операция, модель), очередь ожидания и срок ожидания по умолчанию (секунды)
+UPSTREAM_INITIAL_CONCURRENCY: float = float(os.getenv("UPSTREAM_INITIAL_CONCURRENCY", "8"))
+UPSTREAM_MIN_CONCURRENCY: float = float(os.getenv("UPSTREAM_MIN_CONCURRENCY", "1"))
+UPSTREAM_MAX_CONCURRENCY: float = float(os.getenv("UPSTREAM_MAX_CONCURRENCY", "64"))
+UPSTREAM_QUEUE_SIZE: int = int(os.getenv("UPSTREAM_QUEUE_SIZE", "256"))
+UPSTREAM_QUEUE_TIMEOUT: float = float(os.getenv("UPSTREAM_QUEUE_TIMEOUT", "30"))
+UPSTREAM_LATENCY_TOLERANCE: float = float(os.getenv("UPSTREAM_LATENCY_TOLERANCE", "2.0"))
+
+# Устойчивость вызовов OpenAI API: повторы с экспоненциальной задержкой и джиттером,
+# предохранитель (circuit breaker) на модель и хеджирование запросов по p95 задержки
+UPSTREAM_RETRIES: int = int(os.getenv("UPSTREAM_RETRIES", "2"))
+UPSTREAM_RETRY_BASE_DELAY: float = float(os.getenv("UPSTREAM_RETRY_BASE_DELAY", "0.5"))
+UPSTREAM_RETRY_MAX_DELAY: float = float(os.getenv("UPSTREAM_RETRY_MAX_DELAY", "8"))
+CIRCUIT_FAILURE_THRESHOLD: int = int(os.getenv("CIRCUIT_FAILURE_THRESHOLD", "5"))
+CIRCUIT_RESET_TIMEOUT: float = float(os.getenv("CIRCUIT_RESET_TIMEOUT", "30"))
+UPSTREAM_HEDGING: bool = os.getenv("UPSTREAM_HEDGING", "false").lower() == "true"
+UPSTREAM_HEDGE_QUANTILE: float = float(os.getenv("UPSTREAM_HEDGE_QUANTILE", "0.95"))
+UPSTREAM_HEDGE_MIN_SAMPLES: int = int(os.getenv("UPSTREAM_HEDGE_MIN_SAMPLES", "20"))
+
+# HTTP-клиент OpenAI API: один пул соединений на приложение (создается в lifespan, main.py).
+# OPENAI_HTTP2 включает HTTP/2, если установлен пакет h2 (иначе используется HTTP/1.1).
+# OPENAI_WARMUP_CONNECTIONS - сколько соединений открыть при старте, чтобы TLS-рукопожатия
+# не приходились на первые запросы.
+OPENAI_MAX_CONNECTIONS: int = int(os.getenv("OPENAI_MAX_CONNECTIONS", "200"))
+OPENAI_MAX_KEEPALIVE_CONNECTIONS: int = int(os.getenv("OPENAI_MAX_KEEPALIVE_CONNECTIONS", "50"))
+OPENAI_KEEPALIVE_EXPIRY: float = float(os.getenv("OPENAI_KEEPALIVE_EXPIRY", "120"))
+OPENAI_HTTP2: bool = os.getenv("OPENAI_HTTP2", "true").lower() == "true"
+OPENAI_CONNECT_TIMEOUT: float = float(os.getenv("OPENAI_CONNECT_TIMEOUT", "5"))
+OPENAI_READ_TIMEOUT: float = float(os.getenv("OPENAI_READ_TIMEOUT", "120"))
+OPENAI_WRITE_TIMEOUT: float = float(os.getenv("OPENAI_WRITE_TIMEOUT", "30"))
+OPENAI_POOL_TIMEOUT: float = float(os.getenv("OPENAI_POOL_TIMEOUT", "10"))
+OPENAI_WARMUP_CONNECTIONS: int = int(os.getenv("OPENAI_WARMUP_CONNECTIONS", "2"))
+
+# Транскрипция аудио: загрузка кусками во временный файл (AUDIO_TMP_DIR, по умолчанию
+# системный каталог), нарезка длинных записей ffmpeg на перекрывающиеся сегменты (секунды)
+# и параллельная отправка сегментов в Whisper (не более TRANSCRIPTION_CONCURRENCY на запрос)
+AUDIO_TMP_DIR: str = os.getenv("AUDIO_TMP_DIR")
+AUDIO_MAX_UPLOAD_BYTES: int = int(os.getenv("AUDIO_MAX_UPLOAD_BYTES", str(1024 * 1024 * 1024)))
+AUDIO_SPOOL_CHUNK_SIZE: int = int(os.getenv("AUDIO_SPOOL_CHUNK_SIZE", str(1024 * 1024)))
+FFMPEG_BINARY: str = os.getenv("FFMPEG_BINARY", "ffmpeg")
+FFPROBE_BINARY: str = os.getenv("FFPROBE_BINARY", "ffprobe")
+TRANSCRIPTION_SEGMENT_SECONDS: float = float(os.getenv("TRANSCRIPTION_SEGMENT_SECONDS", "300"))
+TRANSCRIPTION_SEGMENT_OVERLAP: float = float(os.getenv("TRANSCRIPTION_SEGMENT_OVERLAP", "2"))
+TRANSCRIPTION_CONCURRENCY: int = int(os.getenv("TRANSCRIPTION_CONCURRENCY", "6"))
+
+# Кэши на диске (app.services.disk_cache): корневой каталог, у каждого кэша свой подкаталог.
+# Кэш транскрипций хранит результаты Whisper по SHA-256 аудио, модели, языку и формату
+# ответа; при превышении TRANSCRIPTION_CACHE_MAX_BYTES удаляются давно не читанные записи.
+DISK_CACHE_DIR: str = os.getenv("DISK_CACHE_DIR", os.path.join(tempfile.gettempdir(), "openai_service_cache"))
+TRANSCRIPTION_CACHE_ENABLED: bool = os.getenv("TRANSCRIPTION_CACHE_ENABLED", "true").lower() == "true"
+TRANSCRIPTION_CACHE_MAX_BYTES: int = int(os.getenv("TRANSCRIPTION_CACHE_MAX_BYTES", str(256 * 1024 * 1024)))
+
+# Синтез речи: размер фрагментов потоковой отдачи аудио (байты) и кэш готового аудио
+# на диске по (текст, голос, модель, формат) с вытеснением давно не запрашиваемых записей
+SPEECH_STREAM_CHUNK_SIZE: int = int(os.getenv("SPEECH_STREAM_CHUNK_SIZE", str(16 * 1024)))
+SPEECH_CACHE_ENABLED: bool = os.getenv("SPEECH_CACHE_ENABLED", "true").lower() == "true"
+SPEECH_CACHE_MAX_BYTES: int = int(os.getenv("SPEECH_CACHE_MAX_BYTES", str(1024 * 1024 * 1024)))
+
+# Генерация изображений: модель по умолчанию, лимиты пакетной генерации
+# (одновременные запросы на пакет и число элементов в пакете)
+IMAGE_MODEL: str = os.getenv("IMAGE_MODEL", "dall-e-2")
+IMAGE_BATCH_CONCURRENCY: int = int(os.getenv("IMAGE_BATCH_CONCURRENCY", "8"))
+IMAGE_BATCH_MAX_ITEMS: int = int(os.getenv("IMAGE_BATCH_MAX_ITEMS", "500"))
+
+# Предобработка изображений для vision: изображение уменьшается под сетку тайлов модели
+# (detail=high: вписать в 2048x2048, короткая сторона не больше 768; detail=low: 512x512)
+# и пережимается в JPEG в пуле процессов (VISION_WORKERS, по умолчанию - по числу ядер).
+# Обработанные изображения и ответы кэшируются в памяти (ответы - по SHA-256 исходного файла).
+VISION_MODEL: str = os.getenv("VISION_MODEL", "gpt-4-vision-preview")
+VISION_DETAIL: str = os.getenv("VISION_DETAIL", "high")
+VISION_JPEG_QUALITY: int = int(os.getenv("VISION_JPEG_QUALITY", "85"))
+VISION_WORKERS: int = int(os.getenv("VISION_WORKERS", "0"))
+VISION_MAX_IMAGE_BYTES: int = int(os.getenv("VISION_MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+VISION_CACHE_MAX_ENTRIES: int = int(os.getenv("VISION_CACHE_MAX_ENTRIES", "256"))
+VISION_CACHE_TTL: float = float(os.getenv("VISION_CACHE_TTL", "3600"))
+
+# Пакетные chat completions: одновременные запросы на пакет, размер пакета
+# и сколько ответов накапливать перед одной записью истории в базу данных
+CHAT_BATCH_CONCURRENCY: int = int(os.getenv("CHAT_BATCH_CONCURRENCY", "16"))
+CHAT_BATCH_MAX_ITEMS: int = int(os.getenv("CHAT_BATCH_MAX_ITEMS", "1000"))
+CHAT_BATCH_FLUSH_SIZE: int = int(os.getenv("CHAT_BATCH_FLUSH_SIZE", "200"))
+
+# Фоновые задачи (генерация изображений, транскрипция с ?async=true): число воркеров
+# в процессе, очередь ожидающих задач, сколько хранится результат, как часто удаляются
+# устаревшие задачи, предельное время выполнения (задачи остановленного процесса
+# по его истечении помечаются failed) и предельное ожидание long-poll
+JOBS_WORKERS: int = int(os.getenv("JOBS_WORKERS", "8"))
+JOBS_QUEUE_SIZE: int = int(os.getenv("JOBS_QUEUE_SIZE", "1000"))
+JOBS_RESULT_TTL: float = float(os.getenv("JOBS_RESULT_TTL", "3600"))
+JOBS_CLEANUP_INTERVAL: float = float(os.getenv("JOBS_CLEANUP_INTERVAL", "60"))
+JOBS_MAX_RUNTIME: float = float(os.getenv("JOBS_MAX_RUNTIME", "1800"))
+JOBS_LONG_POLL_MAX: float = float(os.getenv("JOBS_LONG_POLL_MAX", "60"))
+JOBS_POLL_INTERVAL: float = float(os.getenv("JOBS_POLL_INTERVAL", "1"))
+
+# Лимиты запросов (RPM) и токенов (TPM) в минуту на API-ключ, маршрут и модель
+# (0 - без ограничения). RATE_LIMIT_MODEL_LIMITS - JSON с лимитами отдельных моделей,
+# например {"gpt-4": {"rpm": 60, "tpm": 40000}}; модель из запроса приводится к известному имени
+# (снимки - к базовой модели, неизвестные - к "other", см. KNOWN_MODELS). RATE_LIMIT_STORAGE - memory (в процессе)
+# или URI хранилища библиотеки limits (async+redis://host:6379) для общих лимитов воркеров.
+# RATE_LIMIT_MAX_WAIT - сколько пакетные запросы ждут лимита вместо отказа (секунды)
+RATE_LIMIT_ENABLED: bool = os.getenv("RATE_LIMIT_ENABLED", "true").lower() == "true"
+RATE_LIMIT_RPM: float = float(os.getenv("RATE_LIMIT_RPM", "600"))
+RATE_LIMIT_TPM: float = float(os.getenv("RATE_LIMIT_TPM", "200000"))
+RATE_LIMIT_MODEL_LIMITS: dict = json.loads(os.getenv("RATE_LIMIT_MODEL_LIMITS", "{}"))
+RATE_LIMIT_STORAGE: str = os.getenv("RATE_LIMIT_STORAGE", "memory")
+RATE_LIMIT_MAX_WAIT: float = float(os.getenv("RATE_LIMIT_MAX_WAIT", "30"))
+
+# Известные модели: имя модели приходит от клиента, поэтому метрики Prometheus,
+# лимиты планировщика и предохранители ведутся отдельно только для этих моделей
+# (и их датированных снимков, например gpt-4o-2024-08-06), остальные попадают в "other".
+# KNOWN_MODELS - список через запятую, дополняет модели по умолчанию
+KNOWN_MODELS: frozenset = frozenset(
+    name.strip()
+    for name in (
+        "gpt-3.5-turbo,gpt-3.5-turbo-16k,gpt-4,gpt-4-32k,gpt-4-turbo,gpt-4-turbo-preview,"
+        "gpt-4-vision-preview,gpt-4o,gpt-4o-mini,gpt-4.1,gpt-4.1-mini,gpt-4.1-nano,"
+        "o1,o1-mini,o3,o3-mini,o4-mini,dall-e-2,dall-e-3,gpt-image-1,whisper-1,"
+        "gpt-4o-transcribe,gpt-4o-mini-transcribe,tts-1,tts-1-hd,gpt-4o-mini-tts,"
+        + os.getenv("KNOWN_MODELS", "")
+    ).split(",")
+    if name.strip()
+) | {IMAGE_MODEL, VISION_MODEL} | set(RATE_LIMIT_MODEL_LIMITS)
+
+# Проверка API-ключей клиентов (таблица users): ключи загружаются в память и перечитываются
+# раз в API_KEYS_REFRESH_INTERVAL секунд; неизвестные ключи кэшируются на API_KEYS_NEGATIVE_TTL,
+# а поиск неизвестных ключей в базе ограничен API_KEYS_LOOKUPS_PER_MINUTE на процесс (0 - без поиска)
+API_KEYS_REFRESH_INTERVAL: float = float(os.getenv("API_KEYS_REFRESH_INTERVAL", "60"))
+API_KEYS_NEGATIVE_TTL: float = float(os.getenv("API_KEYS_NEGATIVE_TTL", "60"))
+API_KEYS_NEGATIVE_MAX_ENTRIES: int = int(os.getenv("API_KEYS_NEGATIVE_MAX_ENTRIES", "10000"))
+API_KEYS_LOOKUPS_PER_MINUTE: int = int(os.getenv("API_KEYS_LOOKUPS_PER_MINUTE", "30"))
+
+# Ключ оператора сервиса: открывает счетчики всего процесса (/api/v1/statistics/cache, /pool,
+# /upstream, /auth и др.), которые не относятся к одному клиенту. Без ключа эти маршруты
+# недоступны (403), счетчики остаются в /metrics
+ADMIN_API_KEY: str = os.getenv("ADMIN_API_KEY")
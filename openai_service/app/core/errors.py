@@ -0,0 +1,65 @@
+from typing import Optional
+
+
+class UpstreamError(Exception):
+    """
+    Ошибка обращения к OpenAI API.
+
+    Обработчик в main.py отвечает на нее кодом status_code (и заголовком
+    Retry-After, если задан retry_after). Ответы с ошибками не кэшируются
+    и не сохраняются в историю чатов.
+
+    Атрибуты:
+        operation: str - Операция (chat, chat_stream, vision, whisper, tts, images)
+        model: str - Модель
+        retry_after: float - Через сколько секунд имеет смысл повторить запрос (опционально)
+        upstream_status: int - HTTP-статус ответа OpenAI API (опционально)
+    """
+    status_code = 502
+
+    def __init__(self, operation: str, model: str, message: str, retry_after: Optional[float] = None, upstream_status: Optional[int] = None):
+        self.operation = operation
+        self.model = model
+        self.retry_after = retry_after
+        self.upstream_status = upstream_status
+        super().__init__(message)
+
+
+class UpstreamOverloaded(UpstreamError):
+    """
+    Запрос к OpenAI API не допущен планировщиком: очередь переполнена
+    или ожидание не укладывается в срок запроса.
+
+    Атрибуты:
+        reason: str - queue_full, deadline или timeout
+    """
+    status_code = 503
+
+    def __init__(self, operation: str, model: str, retry_after: float, reason: str, message: Optional[str] = None):
+        self.reason = reason
+        super().__init__(
+            operation,
+            model,
+            message or f"Upstream {operation} for {model} is overloaded ({reason}), retry after {retry_after:.0f}s",
+            retry_after=retry_after
+        )
+
+
+class UpstreamUnavailable(UpstreamError):
+    """Предохранитель (circuit breaker) модели разомкнут: upstream недоступен, запрос не отправлялся."""
+    status_code = 503
+
+
+class UpstreamRateLimited(UpstreamError):
+    """OpenAI API ответил 429, и повторы не помогли (или Retry-After слишком велик)."""
+    status_code = 429
+
+
+class UpstreamTimeout(UpstreamError):
+    """OpenAI API не ответил за отведенное время."""
+    status_code = 504
+
+
+class UpstreamRejected(UpstreamError):
+    """OpenAI API отклонил запрос как некорректный (400, 404, 422): повтор не поможет."""
+    status_code = 400
@@ -1,10 +1,14 @@
-from app.db.database import add_to_table, JsonData
+from app.db.database import JsonData
+from app.db.writer import writer
 
 
 async def logs_bot(TypeLog: str, Text: str) -> None:
     """
     Логирует сообщения в базу данных.
 
+    Запись выполняется фоновым писателем пакетами (см. app.db.writer),
+    поэтому вызов не ждет обращения к базе данных.
+
     Аргументы:
         TypeLog: str - Уровень логирования (например, "error", "warning", "info", "debug").
         Text: str - Сообщение для логирования.
@@ -13,6 +17,5 @@ async def logs_bot(TypeLog: str, Text: str) -> None:
     if TypeLog.lower() not in valid_log_types:
         TypeLog = "warning"  
 
-    # Сохраняем лог в базу данных
-    log_entry = JsonData(data={"level": TypeLog, "message": Text})
-    await add_to_table(JsonData, {"data": log_entry.data})  # Оборачиваем log_entry.data в словарь
+    # Ставим лог в очередь на запись в базу данных
+    await writer.insert(JsonData, {"data": {"level": TypeLog, "message": Text}})
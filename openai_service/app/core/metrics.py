@@ -0,0 +1,328 @@
+"""
+Метрики Prometheus сервиса.
+
+- http_request_duration_seconds: время обработки запросов по методу, шаблону маршрута и статусу;
+- upstream_request_duration_seconds / upstream_errors_total: вызовы OpenAI API по операции
+  (chat, chat_stream, vision, whisper, tts, images) и модели;
+- tokens_total: токены, израсходованные в OpenAI API, по модели и виду (prompt/completion);
+- db_query_duration_seconds: время выполнения SQL-запросов по типу запроса;
+- event_loop_lag_seconds: задержка event loop (насколько позже назначенного просыпается таймер);
+- upstream_queue_depth, upstream_in_flight, upstream_concurrency_limit, upstream_rejected_total:
+  состояние планировщика вызовов OpenAI API (app.services.scheduler);
+- upstream_retries_total, upstream_hedges_total, upstream_circuit_state: повторы, хеджирование
+  и предохранители моделей (app.services.resilience);
+- disk_cache_requests_total, disk_cache_bytes, disk_cache_evictions_total: кэши на диске
+  (app.services.disk_cache) - попадания, промахи и обходы, занятый объем и вытеснения.
+
+Метка model - это model_label(модель): известная модель (KNOWN_MODELS) или "other",
+чтобы клиент, присылающий произвольные имена моделей, не создавал новые временные ряды.
+
+При нескольких воркерах uvicorn/gunicorn задайте PROMETHEUS_MULTIPROC_DIR: значения
+пишутся в файлы этого каталога, а /metrics собирает их со всех процессов.
+"""
+from contextlib import contextmanager
+from typing import Iterator, Optional
+# config загружает .env до импорта prometheus_client: режим multiprocess
+# выбирается по PROMETHEUS_MULTIPROC_DIR в момент импорта библиотеки
+from app.core.config import EVENT_LOOP_LAG_INTERVAL, PROMETHEUS_MULTIPROC_DIR, KNOWN_MODELS
+from prometheus_client import (
+    CONTENT_TYPE_LATEST,
+    CollectorRegistry,
+    Counter,
+    Gauge,
+    Histogram,
+    generate_latest,
+    multiprocess,
+)
+from starlette.requests import Request
+from starlette.responses import Response
+from sqlalchemy import event
+from sqlalchemy.ext.asyncio import AsyncEngine
+import asyncio
+import os
+import re
+import time
+
+# Суффикс датированного снимка модели: gpt-4o-2024-08-06, gpt-4-0613
+_MODEL_SNAPSHOT = re.compile(r"-(\d{4}-\d{2}-\d{2}|\d{4})$")
+
+
+def model_label(model: Optional[str]) -> str:
+    """
+    Приводит имя модели из запроса к ограниченному набору значений.
+
+    Возвращает:
+        str: Имя известной модели (снимок - без даты) или "other"
+    """
+    if model in KNOWN_MODELS:
+        return model
+    base = _MODEL_SNAPSHOT.sub("", model or "")
+    return base if base in KNOWN_MODELS else "other"
+
+
+# Вызовы OpenAI API длятся секунды и десятки секунд, SQL-запросы - миллисекунды
+REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120)
+DB_BUCKETS = (0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5)
+
+HTTP_REQUEST_DURATION = Histogram(
+    "http_request_duration_seconds",
+    "Время обработки HTTP-запроса",
+    ["method", "route", "status"],
+    buckets=REQUEST_BUCKETS,
+)
+UPSTREAM_REQUEST_DURATION = Histogram(
+    "upstream_request_duration_seconds",
+    "Время вызова OpenAI API",
+    ["operation", "model"],
+    buckets=REQUEST_BUCKETS,
+)
+UPSTREAM_ERRORS = Counter(
+    "upstream_errors_total",
+    "Ошибки вызовов OpenAI API",
+    ["operation", "model", "error"],
+)
+TOKENS = Counter(
+    "tokens_total",
+    "Токены, израсходованные в OpenAI API",
+    ["model", "kind"],
+)
+DB_QUERY_DURATION = Histogram(
+    "db_query_duration_seconds",
+    "Время выполнения SQL-запроса",
+    ["operation"],
+    buckets=DB_BUCKETS,
+)
+EVENT_LOOP_LAG = Gauge(
+    "event_loop_lag_seconds",
+    "Задержка event loop",
+    multiprocess_mode="livemax",
+)
+UPSTREAM_QUEUE_DEPTH = Gauge(
+    "upstream_queue_depth",
+    "Запросы, ожидающие допуска к OpenAI API",
+    ["operation", "model"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_IN_FLIGHT = Gauge(
+    "upstream_in_flight",
+    "Допущенные и выполняющиеся запросы к OpenAI API",
+    ["operation", "model"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_CONCURRENCY_LIMIT = Gauge(
+    "upstream_concurrency_limit",
+    "Текущий адаптивный лимит одновременных запросов к OpenAI API",
+    ["operation", "model"],
+    multiprocess_mode="livesum",
+)
+UPSTREAM_REJECTED = Counter(
+    "upstream_rejected_total",
+    "Запросы, отклоненные планировщиком до обращения к OpenAI API",
+    ["operation", "model", "reason"],
+)
+UPSTREAM_RETRIES = Counter(
+    "upstream_retries_total",
+    "Повторы вызовов OpenAI API",
+    ["operation", "model", "error"],
+)
+UPSTREAM_HEDGES = Counter(
+    "upstream_hedges_total",
+    "Хеджирующие запросы к OpenAI API (fired - отправлен, won - ответил первым)",
+    ["operation", "model", "outcome"],
+)
+UPSTREAM_CIRCUIT_STATE = Gauge(
+    "upstream_circuit_state",
+    "Состояние предохранителя модели: 0 - замкнут, 1 - полуоткрыт, 2 - разомкнут",
+    ["model"],
+    multiprocess_mode="livemax",
+)
+DISK_CACHE_REQUESTS = Counter(
+    "disk_cache_requests_total",
+    "Обращения к кэшу на диске (hit, miss, bypass)",
+    ["cache", "result"],
+)
+DISK_CACHE_BYTES = Gauge(
+    "disk_cache_bytes",
+    "Объем кэша на диске",
+    ["cache"],
+    multiprocess_mode="livemax",
+)
+DISK_CACHE_EVICTIONS = Counter(
+    "disk_cache_evictions_total",
+    "Записи, вытесненные из кэша на диске по лимиту объема",
+    ["cache"],
+)
+JOBS = Counter(
+    "jobs_total",
+    "Завершенные фоновые задачи по типу и итоговому статусу",
+    ["kind", "status"],
+)
+JOBS_QUEUE_DEPTH = Gauge(
+    "jobs_queue_depth",
+    "Фоновые задачи, ожидающие свободного воркера",
+    multiprocess_mode="livesum",
+)
+JOBS_RUNNING = Gauge(
+    "jobs_running",
+    "Выполняющиеся фоновые задачи",
+    multiprocess_mode="livesum",
+)
+AUTH_REQUESTS = Counter(
+    "auth_requests_total",
+    "Проверки API-ключа по результату (memory, database, negative, throttled, invalid, missing)",
+    ["result"],
+)
+RATE_LIMITED = Counter(
+    "rate_limited_total",
+    "Запросы, отклоненные лимитами API-ключа (rpm, tpm)",
+    ["route", "limit"],
+)
+
+_DB_OPERATIONS = {"SELECT", "INSERT", "UPDATE", "DELETE", "BEGIN", "COMMIT", "ROLLBACK"}
+
+
+class MetricsMiddleware:
+    """
+    ASGI-middleware, измеряющее время обработки запросов.
+
+    Время считается до отправки последнего фрагмента ответа, поэтому потоковые
+    ответы (SSE) учитываются целиком. В метку route попадает шаблон маршрута
+    (например, /api/v1/chat/delete/{chat_id}), а не фактический путь.
+    """
+
+    def __init__(self, app):
+        self.app = app
+
+    async def __call__(self, scope, receive, send):
+        if scope["type"] != "http":
+            await self.app(scope, receive, send)
+            return
+
+        status = 500
+        started = time.perf_counter()
+
+        async def send_wrapper(message):
+            nonlocal status
+            if message["type"] == "http.response.start":
+                status = message["status"]
+            await send(message)
+
+        try:
+            await self.app(scope, receive, send_wrapper)
+        finally:
+            route = scope.get("route")
+            HTTP_REQUEST_DURATION.labels(
+                scope["method"],
+                getattr(route, "path", "unmatched"),
+                str(status),
+            ).observe(time.perf_counter() - started)
+
+
+@contextmanager
+def track_upstream(operation: str, model: str) -> Iterator[None]:
+    """
+    Измеряет вызов OpenAI API и считает ошибки по классу исключения.
+
+    Аргументы:
+        operation: str - Операция (chat, chat_stream, vision, whisper, tts, images)
+        model: str - Модель
+    """
+    model = model_label(model)
+    started = time.perf_counter()
+    try:
+        yield
+    except Exception as e:
+        UPSTREAM_ERRORS.labels(operation, model, type(e).__name__).inc()
+        raise
+    finally:
+        UPSTREAM_REQUEST_DURATION.labels(operation, model).observe(time.perf_counter() - started)
+
+def record_tokens(model: str, prompt_tokens: int, completion_tokens: int) -> None:
+    """Увеличивает счетчики токенов модели."""
+    model = model_label(model)
+    if prompt_tokens:
+        TOKENS.labels(model, "prompt").inc(prompt_tokens)
+    if completion_tokens:
+        TOKENS.labels(model, "completion").inc(completion_tokens)
+
+def instrument_engine(engine: AsyncEngine) -> None:
+    """
+    Подключает к движку измерение времени SQL-запросов через события SQLAlchemy.
+
+    Аргументы:
+        engine: AsyncEngine - Движок базы данных
+    """
+    sync_engine = engine.sync_engine
+
+    @event.listens_for(sync_engine, "before_cursor_execute")
+    def _before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault("query_started", []).append(time.perf_counter())
+
+    @event.listens_for(sync_engine, "after_cursor_execute")
+    def _after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+        started = conn.info["query_started"].pop()
+        DB_QUERY_DURATION.labels(_db_operation(statement)).observe(time.perf_counter() - started)
+
+    @event.listens_for(sync_engine, "handle_error")
+    def _handle_error(context):
+        stack = context.connection.info.get("query_started") if context.connection is not None else None
+        if stack:
+            started = stack.pop()
+            DB_QUERY_DURATION.labels("error").observe(time.perf_counter() - started)
+
+def _db_operation(statement: str) -> str:
+    operation = statement.lstrip().split(None, 1)[0].upper() if statement.strip() else ""
+    return operation if operation in _DB_OPERATIONS else "other"
+
+
+class EventLoopLagMonitor:
+    """
+    Фоновая задача, измеряющая задержку event loop.
+
+    Каждые interval секунд задача засыпает и сравнивает фактическое время
+    пробуждения с назначенным: разница - время, которое loop был занят
+    другим (в том числе блокирующим) кодом.
+    """
+
+    def __init__(self, interval: float = EVENT_LOOP_LAG_INTERVAL):
+        self.interval = interval
+        self._task: Optional[asyncio.Task] = None
+
+    async def start(self) -> None:
+        if self._task is None or self._task.done():
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        if self._task is None:
+            return
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            scheduled = loop.time() + self.interval
+            await asyncio.sleep(self.interval)
+            EVENT_LOOP_LAG.set(max(loop.time() - scheduled, 0.0))
+
+
+async def metrics_endpoint(request: Request) -> Response:
+    """Отдает метрики в текстовом формате Prometheus (со всех процессов в multiprocess-режиме)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+        return Response(generate_latest(registry), media_type=CONTENT_TYPE_LATEST)
+    return Response(generate_latest(), media_type=CONTENT_TYPE_LATEST)
+
+def mark_process_dead() -> None:
+    """Удаляет файлы live-метрик текущего процесса при остановке воркера (multiprocess-режим)."""
+    if PROMETHEUS_MULTIPROC_DIR:
+        multiprocess.mark_process_dead(os.getpid())
+
+
+# Общий монитор задержки event loop, запускается при старте приложения
+loop_lag_monitor = EventLoopLagMonitor()
@@ -0,0 +1,304 @@
+from typing import TYPE_CHECKING, Dict, List, Optional, Sequence, Tuple
+from app.core.config import (
+    RATE_LIMIT_ENABLED,
+    RATE_LIMIT_RPM,
+    RATE_LIMIT_TPM,
+    RATE_LIMIT_MODEL_LIMITS,
+    RATE_LIMIT_STORAGE,
+)
+from app.core.metrics import RATE_LIMITED, model_label
+import asyncio
+import math
+import time
+
+if TYPE_CHECKING:
+    # app.core.security сам импортирует этот модуль
+    from app.core.security import Tenant
+
+# Запрос к лимиту: (ключ корзины, лимит в минуту, стоимость)
+BucketRequest = Tuple[str, float, float]
+
+# Сколько корзин держать в памяти, прежде чем удалять полные (неиспользуемые)
+_MEMORY_PRUNE_THRESHOLD = 10000
+
+
+class RateLimitExceeded(Exception):
+    """
+    Запрос превышает лимит ключа: обработчик в main.py отвечает 429 с Retry-After.
+
+    Атрибуты:
+        route: str - Маршрут (chat, images, speech, ...)
+        model: str - Модель
+        limit: str - Превышенный лимит (rpm или tpm)
+        retry_after: float - Через сколько секунд лимит позволит выполнить запрос
+    """
+    status_code = 429
+
+    def __init__(self, route: str, model: str, limit: str, retry_after: float):
+        self.route = route
+        self.model = model
+        self.limit = limit
+        self.retry_after = retry_after
+        super().__init__(f"Rate limit exceeded ({limit}) for {route}/{model}, retry after {math.ceil(retry_after)}s")
+
+
+class MemoryBackend:
+    """
+    Token bucket в памяти процесса: емкость - лимит в минуту, пополнение - limit/60 в секунду.
+
+    Проверка - несколько арифметических операций над словарем, без ввода-вывода.
+    Корзина может уйти в минус (резервирование с ожиданием, доплата по фактическому
+    usage), тогда следующие запросы ждут, пока долг не погасится.
+
+    Лимиты действуют на процесс: при нескольких воркерах uvicorn общий лимит
+    в N раз больше (см. LimitsBackend).
+    """
+
+    def __init__(self):
+        self._buckets: Dict[str, List[float]] = {}  # ключ -> [токены, время обновления]
+
+    def _refill(self, key: str, limit: float, now: float) -> List[float]:
+        bucket = self._buckets.get(key)
+        if bucket is None:
+            if len(self._buckets) >= _MEMORY_PRUNE_THRESHOLD:
+                self._prune(now)
+            bucket = self._buckets[key] = [limit, now]
+        else:
+            bucket[0] = min(limit, bucket[0] + (now - bucket[1]) * limit / 60.0)
+            bucket[1] = now
+        return bucket
+
+    def _prune(self, now: float) -> None:
+        # Корзина, которая за прошедшее время наполнилась бы до емкости, неотличима от новой
+        for key in [key for key, (tokens, updated) in self._buckets.items() if now - updated >= 60.0]:
+            del self._buckets[key]
+
+    async def reserve(self, requests: Sequence[BucketRequest], max_wait: float) -> Tuple[bool, float, int]:
+        """
+        Списывает стоимость из всех корзин, если ожидание не превышает max_wait.
+
+        Возвращает:
+            Tuple[bool, float, int]: (списано, сколько секунд ждать перед запросом,
+                индекс корзины с наибольшим ожиданием)
+        """
+        now = time.monotonic()
+        wait, worst = 0.0, 0
+        buckets = []
+        for index, (key, limit, cost) in enumerate(requests):
+            bucket = self._refill(key, limit, now)
+            # Запрос дороже емкости допускается из полной корзины (иначе он не прошел бы никогда)
+            need = min(cost, limit)
+            if bucket[0] < need:
+                bucket_wait = (need - bucket[0]) * 60.0 / limit
+                if bucket_wait > wait:
+                    wait, worst = bucket_wait, index
+            buckets.append(bucket)
+        if wait > max_wait:
+            return False, wait, worst
+        for bucket, (_, _, cost) in zip(buckets, requests):
+            bucket[0] -= cost
+        return True, wait, worst
+
+    async def adjust(self, key: str, limit: float, delta: float) -> None:
+        """Доплата (delta > 0) или возврат (delta < 0) после запроса."""
+        bucket = self._refill(key, limit, time.monotonic())
+        bucket[0] = min(limit, bucket[0] - delta)
+
+
+class LimitsBackend:
+    """
+    Общие для всех процессов лимиты в хранилище библиотеки limits
+    (например, async+redis://host:6379): счетчик на ключ и минутное окно.
+
+    Каждая проверка - обращение к хранилищу (для Redis - один INCRBY, и еще один
+    при откате), поэтому он медленнее MemoryBackend, но лимит не умножается
+    на число воркеров.
+    """
+
+    def __init__(self, uri: str):
+        from limits.storage import storage_from_string
+        # Нужна асинхронная реализация хранилища (схема async+...)
+        self.storage = storage_from_string(uri if uri.startswith("async+") else f"async+{uri}")
+
+    @staticmethod
+    def _window(now: float) -> Tuple[int, float]:
+        window = int(now // 60)
+        return window, (window + 1) * 60 - now
+
+    async def reserve(self, requests: Sequence[BucketRequest], max_wait: float) -> Tuple[bool, float, int]:
+        window, remaining = self._window(time.time())
+        charged = []
+        for index, (key, limit, cost) in enumerate(requests):
+            counter = f"rate_limit:{key}:{window}"
+            amount = max(int(math.ceil(cost)), 1)
+            count = await self.storage.incr(counter, 120, amount=amount)
+            charged.append((counter, amount))
+            # Запрос дороже лимита допускается первым в окне
+            if count > limit and count > amount:
+                for counter, amount in charged:
+                    await self.storage.incr(counter, 120, amount=-amount)
+                return False, remaining, index
+        return True, 0.0, 0
+
+    async def adjust(self, key: str, limit: float, delta: float) -> None:
+        window, _ = self._window(time.time())
+        amount = int(round(delta))
+        if amount:
+            await self.storage.incr(f"rate_limit:{key}:{window}", 120, amount=amount)
+
+
+def create_backend(uri: str):
+    """Создает хранилище лимитов: memory (по умолчанию) или URI хранилища limits."""
+    if not uri or uri == "memory":
+        return MemoryBackend()
+    return LimitsBackend(uri)
+
+
+class Reservation:
+    """
+    Списанный с лимитов запрос: после ответа стоимость в токенах уточняется
+    по фактическому usage (reconcile).
+    """
+    __slots__ = ("limiter", "key", "tpm", "tokens")
+
+    def __init__(self, limiter: Optional["RateLimiter"], key: str, tpm: float, tokens: float):
+        self.limiter = limiter
+        self.key = key
+        self.tpm = tpm
+        self.tokens = tokens
+
+    async def reconcile(self, actual_tokens: int) -> None:
+        """
+        Доплачивает или возвращает разницу между оценкой и фактическими токенами.
+
+        Аргументы:
+            actual_tokens: int - usage.total_tokens (0 - запрос не дошел до модели, оценка возвращается)
+        """
+        if self.limiter is None or not self.tpm:
+            return
+        delta = actual_tokens - self.tokens
+        self.tokens = actual_tokens
+        if delta:
+            await self.limiter.backend.adjust(f"{self.key}:tpm", self.tpm, delta)
+
+
+class RateLimiter:
+    """
+    Лимиты запросов (RPM) и токенов (TPM) в минуту по ключу (API-ключ, маршрут, модель).
+
+    Модель в ключе приводится к ограниченному набору имен (app.core.metrics.model_label):
+    иначе клиент получал бы новую корзину, меняя имя модели в каждом запросе.
+
+    Токены списываются заранее по оценке промпта (app.services.tokens) и уточняются
+    по фактическому usage после ответа (Reservation.reconcile): ответ, который
+    оказался длиннее оценки, уменьшает запас для следующих запросов ключа.
+
+    Лимиты по умолчанию - RATE_LIMIT_RPM и RATE_LIMIT_TPM. Лимиты клиента запроса (users.rpm,
+    users.tpm - атрибуты rpm и tpm клиента app.core.security.Tenant) заменяют их, а
+    переопределения моделей из RATE_LIMIT_MODEL_LIMITS действуют поверх тех и других;
+    0 - без ограничения.
+    """
+
+    def __init__(
+        self,
+        backend=None,
+        rpm: float = RATE_LIMIT_RPM,
+        tpm: float = RATE_LIMIT_TPM,
+        model_limits: Optional[Dict[str, dict]] = None,
+        enabled: bool = RATE_LIMIT_ENABLED
+    ):
+        self.backend = backend if backend is not None else MemoryBackend()
+        self.rpm = rpm
+        self.tpm = tpm
+        self.model_limits = model_limits or {}
+        self.enabled = enabled
+        self.admitted = 0
+        self.rejected = 0
+
+    def limits_for(self, tenant: "Tenant", model: str) -> Tuple[float, float]:
+        """
+        Возвращает лимиты (rpm, tpm) для клиента и модели.
+
+        Аргументы:
+            tenant: Tenant - Клиент запроса (app.core.security.Tenant): rpm, tpm (None - по умолчанию)
+            model: str - Модель (имя приводится через model_label)
+
+        Возвращает:
+            Tuple[float, float]: Запросов и токенов в минуту (0 - без ограничения)
+        """
+        rpm, tpm = tenant.rpm, tenant.tpm
+        override = self.model_limits.get(model_label(model), {})
+        return (
+            override.get("rpm", self.rpm if rpm is None else rpm),
+            override.get("tpm", self.tpm if tpm is None else tpm),
+        )
+
+    async def acquire(self, tenant: "Tenant", route: str, model: str, tokens: int = 0, max_wait: float = 0) -> Reservation:
+        """
+        Списывает запрос (и оценку токенов) с лимитов ключа клиента.
+
+        Аргументы:
+            tenant: Tenant - Клиент запроса (app.core.security.Tenant): корзины ведутся
+                по отпечатку его ключа (api_key_id), лимиты - его rpm и tpm
+            route: str - Маршрут (chat, chat_batch, vision, images, speech, transcription)
+            model: str - Модель
+            tokens: int - Оценка токенов промпта (0 - маршрут без лимита токенов)
+            max_wait: float - Сколько секунд можно подождать лимита вместо отказа
+                (пакетные запросы; по умолчанию - отказ сразу)
+
+        Возвращает:
+            Reservation: Для уточнения токенов по usage
+
+        Исключения:
+            RateLimitExceeded: Лимит не позволит выполнить запрос за max_wait секунд
+        """
+        if not self.enabled:
+            return Reservation(None, "", 0, tokens)
+        rpm, tpm = self.limits_for(tenant, model)
+        key = f"{tenant.api_key_id}:{route}:{model_label(model)}"
+        requests: List[BucketRequest] = []
+        names = []
+        if rpm:
+            requests.append((f"{key}:rpm", rpm, 1))
+            names.append("rpm")
+        if tpm and tokens:
+            requests.append((f"{key}:tpm", tpm, tokens))
+            names.append("tpm")
+        if not requests:
+            return Reservation(None, key, 0, tokens)
+
+        deadline = time.monotonic() + max_wait
+        while True:
+            admitted, wait, worst = await self.backend.reserve(requests, max(deadline - time.monotonic(), 0))
+            if admitted:
+                break
+            if time.monotonic() + wait > deadline:
+                self.rejected += 1
+                RATE_LIMITED.labels(route, names[worst]).inc()
+                raise RateLimitExceeded(route, model, names[worst], wait)
+            await asyncio.sleep(wait)
+
+        self.admitted += 1
+        if wait > 0:
+            await asyncio.sleep(wait)
+        return Reservation(self, key, tpm, tokens if tpm else 0)
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики лимитов процесса.
+
+        Возвращает:
+            dict: enabled, backend, rpm, tpm, admitted, rejected
+        """
+        return {
+            "enabled": self.enabled,
+            "backend": type(self.backend).__name__,
+            "rpm": self.rpm,
+            "tpm": self.tpm,
+            "admitted": self.admitted,
+            "rejected": self.rejected,
+        }
+
+
+# Общий ограничитель процесса
+rate_limiter = RateLimiter(create_backend(RATE_LIMIT_STORAGE), model_limits=RATE_LIMIT_MODEL_LIMITS)
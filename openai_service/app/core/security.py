@@ -1,28 +1,322 @@
-from fastapi import Security, HTTPException, Depends
+from fastapi import Security, HTTPException
 from fastapi.security.api_key import APIKeyHeader
 from starlette.status import HTTP_403_FORBIDDEN
-from typing import Optional
+from typing import Dict, Optional
+from app.core.config import (
+    API_KEYS_REFRESH_INTERVAL,
+    API_KEYS_NEGATIVE_TTL,
+    API_KEYS_NEGATIVE_MAX_ENTRIES,
+    API_KEYS_LOOKUPS_PER_MINUTE,
+    ADMIN_API_KEY,
+)
+from app.core.logging import logs_bot
+from app.core.metrics import AUTH_REQUESTS
+from app.db.database import User, assign_chat_owner, create_user, get_active_users, get_user_by_api_key
+from app.services.cache import TTLCache
+import argparse
+import asyncio
+import hashlib
+import hmac
 import os
+import secrets
+import time
 
 API_KEY_NAME = os.getenv("API_KEY_NAME", "X-API-Key")
 api_key_header = APIKeyHeader(name=API_KEY_NAME, auto_error=False)
 
-async def get_api_key(api_key_header: Optional[str] = Security(api_key_header)) -> str:
+
+def hash_api_key(api_key: str) -> str:
+    """Возвращает SHA-256 (hex) API-ключа - в таком виде ключ хранится в users.api_key."""
+    return hashlib.sha256(api_key.encode("utf-8")).hexdigest()
+
+def api_key_fingerprint(api_key: Optional[str]) -> str:
+    """
+    Возвращает короткий отпечаток API-ключа для статистики и истории.
+
+    Сам ключ в базе данных не хранится: по отпечатку (первые 16 символов SHA-256)
+    можно сгруппировать запросы, но нельзя восстановить ключ.
+    """
+    if not api_key:
+        return ""
+    return hash_api_key(api_key)[:16]
+
+
+class Tenant:
+    """
+    Клиент, которому принадлежит API-ключ запроса (зависимость get_tenant).
+
+    Отпечаток ключа - владелец истории, задач и статистики клиента, а лимиты
+    rpm и tpm применяет app.core.rate_limit.
+
+    Атрибуты:
+        id: Optional[int] - users.id (None - общий ключ API_KEY из окружения)
+        name: str - Название клиента
+        key_hash: str - SHA-256 ключа
+        api_key_id: str - Отпечаток ключа для статистики, истории и лимитов
+        rpm, tpm: Optional[int] - Лимиты клиента в минуту (None - по умолчанию)
+    """
+    __slots__ = ("id", "name", "key_hash", "api_key_id", "rpm", "tpm")
+
+    def __init__(self, id: Optional[int], name: str, key_hash: str, rpm: Optional[int] = None, tpm: Optional[int] = None):
+        self.id = id
+        self.name = name
+        self.key_hash = key_hash
+        self.api_key_id = key_hash[:16]
+        self.rpm = rpm
+        self.tpm = tpm
+
+    @classmethod
+    def from_user(cls, user: User) -> "Tenant":
+        return cls(user.id, user.name or f"user-{user.id}", user.api_key, user.rpm, user.tpm)
+
+
+class ApiKeyStore:
+    """
+    API-ключи клиентов в памяти процесса.
+
+    Ключи (SHA-256 из таблицы users) загружаются при старте и перечитываются, когда
+    с загрузки прошло больше refresh_interval секунд: перечитывание запускает первый
+    запрос после этого срока и не ждет его, поэтому проверка ключа - хэширование
+    и поиск в словаре, без обращения к базе данных. Неизвестные ключи запоминаются
+    в отрицательном кэше (он переживает перечитывание ключей). Ключ, которого нет
+    ни там, ни там (например, выданный другим процессом после загрузки), ищется
+    в базе одним запросом, но не чаще lookups_per_minute раз в минуту на процесс:
+    сверх этого ключ отклоняется без обращения к базе, поэтому перебор ключей
+    не нагружает базу, а новый ключ в худшем случае заработает после перечитывания.
+
+    Общий ключ API_KEY из окружения продолжает работать как клиент "default".
+    Ключи клиентов выдает команда python -m app.core.security issue (см. issue).
+    """
+
+    def __init__(
+        self,
+        refresh_interval: float = API_KEYS_REFRESH_INTERVAL,
+        negative_ttl: float = API_KEYS_NEGATIVE_TTL,
+        negative_max_entries: int = API_KEYS_NEGATIVE_MAX_ENTRIES,
+        lookups_per_minute: int = API_KEYS_LOOKUPS_PER_MINUTE
+    ):
+        self.refresh_interval = refresh_interval
+        self.lookups_per_minute = lookups_per_minute
+        self._lookup_tokens = float(lookups_per_minute)
+        self._lookup_updated = time.monotonic()
+        self._tenants: Dict[str, Tenant] = {}  # SHA-256 ключа -> клиент
+        self._negative = TTLCache(negative_max_entries, negative_ttl)
+        self._loaded_at: Optional[float] = None
+        self._refresh_task: Optional[asyncio.Task] = None
+        legacy_key = os.getenv("API_KEY")
+        self._legacy = Tenant(None, "default", hash_api_key(legacy_key)) if legacy_key else None
+        self.refreshes = 0
+        self.database_lookups = 0
+        self.negative_hits = 0
+        self.lookups_throttled = 0
+
+    def configured(self) -> bool:
+        """True, если есть хотя бы один ключ (API_KEY или клиенты в базе)."""
+        return self._legacy is not None or bool(self._tenants)
+
+    async def refresh(self) -> None:
+        """Перечитывает активных клиентов (ключи и лимиты) из базы данных."""
+        try:
+            users = await get_active_users()
+        except Exception as e:
+            # База недоступна: продолжаем работать с загруженными ранее ключами
+            await logs_bot("error", f"Ошибка загрузки API-ключей: {str(e)}")
+        else:
+            self._tenants = {user.api_key: Tenant.from_user(user) for user in users if user.api_key}
+            # Отрицательный кэш сохраняется: из него убираются только ключи, которые появились в базе
+            for key_hash in self._tenants:
+                self._negative.pop(key_hash)
+            self.refreshes += 1
+        self._loaded_at = time.monotonic()
+
+    async def _refresh_if_stale(self) -> None:
+        if self._loaded_at is not None and time.monotonic() - self._loaded_at < self.refresh_interval:
+            return
+        if self._refresh_task is None or self._refresh_task.done():
+            self._refresh_task = asyncio.create_task(self.refresh())
+        # Ждем только первую загрузку; дальше запросы обслуживаются по текущим ключам,
+        # пока новые загружаются в фоне
+        if self._loaded_at is None:
+            await asyncio.shield(self._refresh_task)
+
+    async def resolve(self, api_key: str) -> Optional[Tenant]:
+        """
+        Находит клиента по API-ключу.
+
+        Аргументы:
+            api_key: str - Ключ из заголовка запроса
+
+        Возвращает:
+            Optional[Tenant]: Клиент (None - ключ неизвестен или клиент отключен)
+        """
+        await self._refresh_if_stale()
+        key_hash = hash_api_key(api_key)
+
+        # Сравнение хэшей за постоянное время: время ответа не зависит от того,
+        # сколько символов ключа совпало
+        tenant = self._tenants.get(key_hash)
+        if tenant is not None and hmac.compare_digest(tenant.key_hash, key_hash):
+            AUTH_REQUESTS.labels("memory").inc()
+            return tenant
+        if self._legacy is not None and hmac.compare_digest(self._legacy.key_hash, key_hash):
+            AUTH_REQUESTS.labels("memory").inc()
+            return self._legacy
+
+        if self._negative.get(key_hash) is not None:
+            self.negative_hits += 1
+            AUTH_REQUESTS.labels("negative").inc()
+            return None
+
+        if not self._take_lookup():
+            self.lookups_throttled += 1
+            AUTH_REQUESTS.labels("throttled").inc()
+            return None
+
+        self.database_lookups += 1
+        try:
+            user = await get_user_by_api_key(key_hash)
+        except Exception as e:
+            await logs_bot("error", f"Ошибка проверки API-ключа: {str(e)}")
+            user = None
+        if user is None:
+            self._negative.set(key_hash, True)
+            AUTH_REQUESTS.labels("invalid").inc()
+            return None
+
+        tenant = self._tenants[key_hash] = Tenant.from_user(user)
+        AUTH_REQUESTS.labels("database").inc()
+        return tenant
+
+    def _take_lookup(self) -> bool:
+        # Token bucket на поиск неизвестных ключей в базе: емкость и пополнение - lookups_per_minute
+        if self.lookups_per_minute <= 0:
+            return False
+        now = time.monotonic()
+        self._lookup_tokens = min(
+            self.lookups_per_minute,
+            self._lookup_tokens + (now - self._lookup_updated) * self.lookups_per_minute / 60.0
+        )
+        self._lookup_updated = now
+        if self._lookup_tokens < 1:
+            return False
+        self._lookup_tokens -= 1
+        return True
+
+    async def issue(self, name: str, rpm: Optional[int] = None, tpm: Optional[int] = None) -> str:
+        """
+        Создает клиента и выдает ему новый API-ключ.
+
+        Аргументы:
+            name: str - Название клиента
+            rpm: int - Лимит запросов в минуту (None - RATE_LIMIT_RPM)
+            tpm: int - Лимит токенов в минуту (None - RATE_LIMIT_TPM)
+
+        Возвращает:
+            str: API-ключ (в базе сохраняется только его SHA-256, повторно получить ключ нельзя)
+        """
+        api_key = secrets.token_urlsafe(32)
+        user = await create_user(name, hash_api_key(api_key), rpm, tpm)
+        tenant = self._tenants[user.api_key] = Tenant.from_user(user)
+        self._negative.pop(tenant.key_hash)
+        return api_key
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики проверки ключей.
+
+        Возвращает:
+            dict: tenants, legacy_key, refreshes, database_lookups, lookups_throttled,
+                negative_hits, negative_cached
+        """
+        return {
+            "tenants": len(self._tenants),
+            "legacy_key": self._legacy is not None,
+            "refreshes": self.refreshes,
+            "database_lookups": self.database_lookups,
+            "lookups_throttled": self.lookups_throttled,
+            "negative_hits": self.negative_hits,
+            "negative_cached": len(self._negative),
+        }
+
+
+# Общее хранилище ключей процесса; первая загрузка - в lifespan (main.py)
+api_key_store = ApiKeyStore()
+
+
+async def get_tenant(api_key_header: Optional[str] = Security(api_key_header)) -> Tenant:
+    """
+    Зависимость FastAPI: проверяет API-ключ и возвращает его клиента.
+
+    Обработчики берут из клиента отпечаток ключа (история, задачи, статистика)
+    и лимиты (app.core.rate_limit); FastAPI вызывает зависимость один раз на запрос,
+    даже если она указана и у маршрутизатора, и у обработчика.
+
+    Возвращает:
+        Tenant: Клиент запроса
+
+    Вызывает:
+        HTTPException: 403 - ключ не передан, неизвестен или на сервере нет ни одного ключа
+    """
     if api_key_header is None:
+        AUTH_REQUESTS.labels("missing").inc()
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="API key is missing"
         )
-    
-    # Получаем API ключ из переменных окружения
-    api_key = os.getenv("API_KEY")
-    if api_key is None:
-        raise HTTPException(
-            status_code=HTTP_403_FORBIDDEN, detail="API key is not configured on server"
-        )
-    
-    if api_key_header != api_key:
+
+    tenant = await api_key_store.resolve(api_key_header)
+    if tenant is None:
+        if not api_key_store.configured():
+            raise HTTPException(
+                status_code=HTTP_403_FORBIDDEN, detail="API key is not configured on server"
+            )
         raise HTTPException(
             status_code=HTTP_403_FORBIDDEN, detail="Invalid API key"
         )
-        
-    return api_key_header
+    return tenant
+
+async def require_admin(api_key_header: Optional[str] = Security(api_key_header)) -> None:
+    """
+    Зависимость FastAPI: пропускает только ключ оператора (ADMIN_API_KEY).
+
+    Вызывает:
+        HTTPException: 403 - ключ не передан, не совпадает с ADMIN_API_KEY или ADMIN_API_KEY не задан
+    """
+    if not ADMIN_API_KEY or api_key_header is None or not hmac.compare_digest(
+        hash_api_key(api_key_header), hash_api_key(ADMIN_API_KEY)
+    ):
+        raise HTTPException(status_code=HTTP_403_FORBIDDEN, detail="Operator API key required")
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Управление API-ключами клиентов")
+    commands = parser.add_subparsers(dest="command", required=True)
+    assign = commands.add_parser(
+        "assign-chats",
+        help="Назначить владельца чатам без владельца (история до разделения по API-ключам)"
+    )
+    assign.add_argument("--api-key-id", help="Отпечаток ключа владельца (по умолчанию - ключ API_KEY из окружения)")
+    issue = commands.add_parser("issue", help="Создать клиента и выдать ему новый API-ключ")
+    issue.add_argument("--name", required=True, help="Название клиента")
+    issue.add_argument("--rpm", type=int, help="Лимит запросов в минуту (по умолчанию - RATE_LIMIT_RPM)")
+    issue.add_argument("--tpm", type=int, help="Лимит токенов в минуту (по умолчанию - RATE_LIMIT_TPM)")
+    args = parser.parse_args()
+
+    from app.db.database import init_db, engine
+    await init_db()
+    try:
+        if args.command == "assign-chats":
+            api_key_id = args.api_key_id or api_key_fingerprint(os.getenv("API_KEY"))
+            if not api_key_id:
+                parser.error("--api-key-id is required when API_KEY is not set")
+            print({"api_key_id": api_key_id, "assigned": await assign_chat_owner(api_key_id)})
+        elif args.command == "issue":
+            # Ключ показывается один раз: в базе хранится только его SHA-256. Процессы сервиса
+            # находят новый ключ в базе при первом запросе с ним или при перечитывании ключей
+            api_key = await api_key_store.issue(args.name, args.rpm, args.tpm)
+            print({"name": args.name, "api_key": api_key, "api_key_id": api_key_fingerprint(api_key)})
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
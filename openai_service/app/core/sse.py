@@ -0,0 +1,18 @@
+import json
+
+
+def sse_event(data: dict, event: str = None) -> str:
+    """
+    Форматирует одно событие Server-Sent Events.
+
+    Параметры:
+        data: dict - Полезная нагрузка события (сериализуется в JSON)
+        event: str - Имя события (опционально)
+
+    Возвращает:
+        str: Готовый к отправке фрагмент потока text/event-stream
+    """
+    payload = json.dumps(data, ensure_ascii=False)
+    if event:
+        return f"event: {event}\ndata: {payload}\n\n"
+    return f"data: {payload}\n\n"
@@ -1,20 +1,194 @@
-from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession
+from sqlalchemy.ext.asyncio import create_async_engine, AsyncSession, AsyncEngine
 from sqlalchemy.orm import sessionmaker, declarative_base
-from sqlalchemy.pool import NullPool
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, JSON, UUID, select, Text, func
-from .models import Base, User, ChatHistory, ContextSession, JsonData
+from sqlalchemy.pool import NullPool, AsyncAdaptedQueuePool
+from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, JSON, UUID, select, insert, update, delete, Text, func, text, literal, tuple_, or_
+from sqlalchemy import exc
+from .models import Base, User, ChatHistory, ContextSession, JsonData, CachedResponse, Job
 from typing import Any, List, Optional, Tuple
-from datetime import datetime
-from dotenv import load_dotenv
+from datetime import datetime, timedelta
+from app.core.config import (
+    DATABASE_URL,
+    DB_PROFILE,
+    DB_POOL_SIZE,
+    DB_MAX_OVERFLOW,
+    DB_POOL_TIMEOUT,
+    DB_POOL_RECYCLE,
+    DB_POOL_PRE_PING,
+    DB_STATEMENT_CACHE_SIZE,
+    DB_ECHO,
+    HISTORY_COUNT_CACHE_TTL,
+)
+import base64
 import os
 import json
+import time
 import uuid
 
-load_dotenv()
+POSTGRES_URL: str = DATABASE_URL
+
+# Профили движка базы данных.
+# dev - небольшой пул и логирование SQL (echo) для отладки;
+# prod - пул под нагрузку, без echo: echo пишет каждый запрос в лог синхронно.
+# statement_cache_size - размер кэша подготовленных выражений asyncpg на соединение
+# (0 - выключить, нужно при работе через pgbouncer в режиме transaction);
+# insertmanyvalues_page_size - сколько строк add_many/upsert_many отправляют одним INSERT.
+ENGINE_PROFILES = {
+    "dev": {
+        "echo": True,
+        "pool_size": 5,
+        "max_overflow": 5,
+        "pool_timeout": 30,
+        "pool_recycle": 3600,
+        "pool_pre_ping": True,
+        "statement_cache_size": 100,
+        "insertmanyvalues_page_size": 1000,
+    },
+    "prod": {
+        "echo": False,
+        "pool_size": 20,
+        "max_overflow": 10,
+        "pool_timeout": 10,
+        "pool_recycle": 1800,
+        "pool_pre_ping": True,
+        "statement_cache_size": 500,
+        "insertmanyvalues_page_size": 5000,
+    },
+}
+
+
+class PoolStats:
+    """Счетчики пула соединений: выдачи, ожидание соединения, overflow и таймауты."""
+
+    def __init__(self):
+        self.checkouts = 0
+        self.wait_time_total = 0.0
+        self.wait_time_max = 0.0
+        self.overflow_events = 0
+        self.timeouts = 0
+
+
+class InstrumentedQueuePool(AsyncAdaptedQueuePool):
+    """
+    AsyncAdaptedQueuePool, который измеряет время ожидания свободного соединения
+    и считает создание соединений сверх pool_size (overflow) и таймауты пула.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.stats = PoolStats()
+
+    def _do_get(self):
+        overflow_before = self._overflow
+        started = time.perf_counter()
+        try:
+            return super()._do_get()
+        except exc.TimeoutError:
+            self.stats.timeouts += 1
+            raise
+        finally:
+            waited = time.perf_counter() - started
+            self.stats.checkouts += 1
+            self.stats.wait_time_total += waited
+            self.stats.wait_time_max = max(self.stats.wait_time_max, waited)
+            if self._overflow > overflow_before and self._overflow > 0:
+                self.stats.overflow_events += 1
+
+
+def _profile_settings(profile: str) -> dict:
+    """
+    Возвращает параметры профиля с учетом переопределений из переменных окружения.
+
+    Аргументы:
+        profile: str - Имя профиля из ENGINE_PROFILES
+
+    Возвращает:
+        dict: Параметры движка
+    """
+    if profile not in ENGINE_PROFILES:
+        raise ValueError(f"Unknown DB_PROFILE: {profile}")
+
+    settings = dict(ENGINE_PROFILES[profile])
+    overrides = {
+        "pool_size": (DB_POOL_SIZE, int),
+        "max_overflow": (DB_MAX_OVERFLOW, int),
+        "pool_timeout": (DB_POOL_TIMEOUT, float),
+        "pool_recycle": (DB_POOL_RECYCLE, int),
+        "pool_pre_ping": (DB_POOL_PRE_PING, lambda value: value.lower() == "true"),
+        "statement_cache_size": (DB_STATEMENT_CACHE_SIZE, int),
+        "echo": (DB_ECHO, lambda value: value.lower() == "true"),
+    }
+    for name, (value, cast) in overrides.items():
+        if value is not None:
+            settings[name] = cast(value)
+    return settings
+
+def create_engine_for_profile(url: str, profile: str = DB_PROFILE, **overrides: Any) -> AsyncEngine:
+    """
+    Создает асинхронный движок SQLAlchemy по профилю.
+
+    Аргументы:
+        url: str - URL базы данных
+        profile: str - Имя профиля (dev/prod)
+        overrides: Параметры, заменяющие значения профиля (например, poolclass=NullPool)
+
+    Возвращает:
+        AsyncEngine: Движок с InstrumentedQueuePool (если poolclass не переопределен)
+    """
+    settings = _profile_settings(profile)
+    settings.update(overrides)
+    statement_cache_size = settings.pop("statement_cache_size")
+
+    kwargs = {"echo": settings.pop("echo"), "insertmanyvalues_page_size": settings.pop("insertmanyvalues_page_size")}
+    poolclass = settings.pop("poolclass", InstrumentedQueuePool)
+    in_memory_sqlite = url.startswith("sqlite") and (":memory:" in url or url.rstrip("/").endswith(":"))
+
+    if poolclass is NullPool:
+        kwargs["poolclass"] = NullPool
+    elif not in_memory_sqlite:
+        kwargs["poolclass"] = poolclass
+        kwargs.update(settings)
+
+    if url.startswith("postgresql+asyncpg"):
+        kwargs["connect_args"] = {"prepared_statement_cache_size": statement_cache_size}
+
+    return create_async_engine(url, **kwargs)
+
+def get_pool_stats(target: AsyncEngine = None) -> dict:
+    """
+    Возвращает текущую статистику пула соединений.
+
+    Аргументы:
+        target: AsyncEngine - Движок (по умолчанию основной движок приложения)
+
+    Возвращает:
+        dict: Размер пула, занятые и свободные соединения, overflow,
+              число выдач соединений, среднее и максимальное ожидание (мс),
+              число событий overflow и таймаутов
+    """
+    pool = (target or engine).pool
+    result = {"profile": DB_PROFILE, "pool_class": type(pool).__name__}
+
+    if isinstance(pool, AsyncAdaptedQueuePool):
+        result.update({
+            "size": pool.size(),
+            "checked_in": pool.checkedin(),
+            "checked_out": pool.checkedout(),
+            "overflow": max(pool.overflow(), 0),
+        })
+
+    stats = getattr(pool, "stats", None)
+    if stats is not None:
+        result.update({
+            "checkouts": stats.checkouts,
+            "wait_time_avg_ms": round(stats.wait_time_total / stats.checkouts * 1000, 3) if stats.checkouts else 0.0,
+            "wait_time_max_ms": round(stats.wait_time_max * 1000, 3),
+            "overflow_events": stats.overflow_events,
+            "timeouts": stats.timeouts,
+        })
+    return result
 
-POSTGRES_URL: str = os.getenv("DATABASE_URL")
 
-engine = create_async_engine(POSTGRES_URL, echo=True)
+engine = create_engine_for_profile(POSTGRES_URL, DB_PROFILE)
 AsyncSessionLocal: sessionmaker = sessionmaker(
     engine, class_=AsyncSession, expire_on_commit=False
 )
@@ -30,7 +204,7 @@ async def init_db() -> None:
     """
     async with engine.begin() as conn:
         # Импортируем все модели перед созданием таблиц
-        from .models import Base, User, ChatHistory, ContextSession, JsonData
+        from .models import Base, User, ChatHistory, ContextSession, JsonData, CachedResponse, Job
         await conn.run_sync(Base.metadata.create_all)
 
 # Функция для получения сессии базы данных
@@ -51,46 +225,417 @@ async def get_db() -> AsyncSession:
         finally:
             await session.close()
 
-async def add_to_table(table_class: Base, data: dict) -> Any:
+def _coerce_row(table_class: Base, row: dict) -> dict:
+    """Приводит строковые идентификаторы к uuid.UUID для UUID-столбцов (нужно SQLite и др.)."""
+    columns = table_class.__table__.c
+    coerced = dict(row)
+    for name, value in row.items():
+        if isinstance(value, str) and name in columns and isinstance(columns[name].type, UUID):
+            coerced[name] = uuid.UUID(value)
+    return coerced
+
+def _dialect_insert(session: AsyncSession, table_class: Base):
     """
-    Общая функция для добавления данных в любую таблицу с проверкой user_id
-    
+    Возвращает INSERT с поддержкой ON CONFLICT для диалекта сессии
+    (PostgreSQL и SQLite) или None, если диалект его не поддерживает.
+    """
+    dialect = session.bind.dialect.name
+    if dialect == "postgresql":
+        from sqlalchemy.dialects.postgresql import insert as dialect_insert
+    elif dialect == "sqlite":
+        from sqlalchemy.dialects.sqlite import insert as dialect_insert
+    else:
+        return None
+    return dialect_insert(table_class)
+
+def _merge_by_key(rows: List[dict], conflict_keys: Tuple[str, ...]) -> List[dict]:
+    # Одна строка на ключ: ON CONFLICT не может обновить одну строку дважды в одном выражении
+    merged: dict = {}
+    for row in rows:
+        merged.setdefault(tuple(row[key] for key in conflict_keys), {}).update(row)
+    return list(merged.values())
+
+async def add_many(table_class: Base, rows: List[dict], session: AsyncSession = None, returning: bool = True) -> List[Any]:
+    """
+    Вставляет много строк за один запрос (INSERT ... VALUES (...), (...) [RETURNING]).
+
+    SQLAlchemy отправляет строки пачками по insertmanyvalues_page_size
+    (см. профили движка), а не отдельным запросом на каждую строку.
+
     Аргументы:
         table_class: Base - Класс модели SQLAlchemy
-        data: dict - Данные для вставки
-        
+        rows: List[dict] - Значения столбцов для каждой строки
+        session: AsyncSession - Сессия, в транзакции которой выполняется вставка
+                 (по умолчанию создается своя сессия с коммитом)
+        returning: bool - Вернуть созданные записи (RETURNING)
+
     Возвращает:
-        Созданную или существующую запись или False, если не удалось вставить данные
+        List: Созданные записи (или пустой список при returning=False)
     """
-    
+    if not rows:
+        return []
+
+    rows = [_coerce_row(table_class, row) for row in rows]
+    statement = insert(table_class)
+    if returning:
+        statement = statement.returning(table_class)
+
+    async def _execute(session: AsyncSession) -> List[Any]:
+        result = await session.execute(statement, rows)
+        return list(result.scalars().all()) if returning else []
+
+    if session is not None:
+        return await _execute(session)
+
+    async with AsyncSessionLocal() as session:
+        records = await _execute(session)
+        await session.commit()
+        return records
+
+async def upsert_many(
+    table_class: Base,
+    rows: List[dict],
+    conflict_keys: Tuple[str, ...] = ("chat_id",),
+    session: AsyncSession = None,
+    owner_key: Optional[str] = None
+) -> int:
+    """
+    Вставляет строки или обновляет существующие одним запросом
+    INSERT ... ON CONFLICT (conflict_keys) DO UPDATE.
+
+    Обновляются только столбцы, переданные в строке, поэтому одновременные
+    обновления разных столбцов одной записи (например, переименование чата
+    и сохранение ответа) не затирают друг друга. Строки с одинаковым ключом
+    объединяются (более поздние значения имеют приоритет).
+
+    Для диалектов без ON CONFLICT используется SELECT + UPDATE/INSERT в одной транзакции.
+
+    Аргументы:
+        table_class: Base - Класс модели SQLAlchemy
+        rows: List[dict] - Значения столбцов, включая conflict_keys
+        conflict_keys: Tuple[str, ...] - Столбцы уникального ограничения
+        session: AsyncSession - Сессия, в транзакции которой выполняется запрос
+                 (по умолчанию создается своя сессия с коммитом)
+        owner_key: str - Столбец владельца (например, "api_key_id"): существующая строка
+                   обновляется, только если владелец совпадает (опционально). Строки без
+                   владельца (история до разделения по ключам) не обновляет никто, пока
+                   им не назначен владелец (assign_chat_owner)
+
+    Возвращает:
+        int: Количество обработанных строк
+    """
+    # Строки разных владельцев с одним ключом не объединяются: каждая проверяется отдельно
+    merge_keys = tuple(conflict_keys) + ((owner_key,) if owner_key is not None else ())
+    rows = _merge_by_key([_coerce_row(table_class, row) for row in rows], merge_keys)
+    if not rows:
+        return 0
+
+    async def _execute(session: AsyncSession) -> None:
+        # Группируем строки по набору столбцов (у одного выражения один SET) и по очереди
+        # ключа: повторы ключа идут следующими выражениями, в порядке поступления
+        groups: dict = {}
+        seen: dict = {}
+        for row in rows:
+            key = tuple(row[name] for name in conflict_keys)
+            position = seen[key] = seen.get(key, -1) + 1
+            groups.setdefault((position, tuple(sorted(row))), []).append(row)
+
+        for (_, columns), group in sorted(groups.items(), key=lambda item: item[0][0]):
+            statement = _dialect_insert(session, table_class)
+            if statement is None:
+                await _upsert_fallback(session, table_class, group, tuple(conflict_keys), owner_key)
+                continue
+
+            update_columns = [name for name in columns if name not in conflict_keys]
+            if update_columns:
+                owner = None
+                if owner_key is not None:
+                    column = getattr(table_class, owner_key)
+                    owner = column == statement.excluded[owner_key]
+                statement = statement.on_conflict_do_update(
+                    index_elements=list(conflict_keys),
+                    set_={name: statement.excluded[name] for name in update_columns},
+                    where=owner
+                )
+            else:
+                statement = statement.on_conflict_do_nothing(index_elements=list(conflict_keys))
+            await session.execute(statement, group)
+
+    if session is not None:
+        await _execute(session)
+        return len(rows)
+
     async with AsyncSessionLocal() as session:
-        if 'chat_id' in data:
-            # Проверяем, существует ли запись с этим chat_id
-            existing = await session.execute(
-                select(table_class).where(
-                    table_class.chat_id == data['chat_id']
+        await _execute(session)
+        await session.commit()
+    return len(rows)
+
+async def _upsert_fallback(
+    session: AsyncSession,
+    table_class: Base,
+    rows: List[dict],
+    conflict_keys: Tuple[str, ...],
+    owner_key: Optional[str] = None
+) -> None:
+    for row in rows:
+        condition = [getattr(table_class, key) == row[key] for key in conflict_keys]
+        values = {name: value for name, value in row.items() if name not in conflict_keys}
+        owner = []
+        if owner_key is not None:
+            column = getattr(table_class, owner_key)
+            owner = [column == row.get(owner_key)]
+        result = await session.execute(update(table_class).where(*condition, *owner).values(**values)) if values else None
+        if result is None or result.rowcount == 0:
+            exists = await session.scalar(select(func.count()).select_from(table_class).where(*condition))
+            if not exists:
+                await session.execute(insert(table_class), [row])
+
+async def increment_many(table_class: Base, rows: List[dict], conflict_keys: Tuple[str, ...], session: AsyncSession = None) -> int:
+    """
+    Прибавляет значения счетчиков к строкам агрегатов одним запросом
+    INSERT ... ON CONFLICT (conflict_keys) DO UPDATE SET столбец = столбец + excluded.столбец.
+
+    Все столбцы, кроме conflict_keys, считаются счетчиками. Строки с одинаковым
+    ключом суммируются до отправки запроса, поэтому пакет из тысяч событий за один
+    час превращается в несколько строк. Отсутствующая строка создается со значениями
+    из запроса. Для диалектов без ON CONFLICT используется UPDATE, а при его
+    промахе - INSERT.
+
+    Аргументы:
+        table_class: Base - Класс модели SQLAlchemy
+        rows: List[dict] - Ключевые столбцы и приращения счетчиков
+        conflict_keys: Tuple[str, ...] - Столбцы первичного ключа (уникального ограничения)
+        session: AsyncSession - Сессия, в транзакции которой выполняется запрос
+                 (по умолчанию создается своя сессия с коммитом)
+
+    Возвращает:
+        int: Количество затронутых строк агрегатов
+    """
+    merged: dict = {}
+    for row in rows:
+        ident = tuple(row[key] for key in conflict_keys)
+        current = merged.get(ident)
+        if current is None:
+            merged[ident] = dict(row)
+            continue
+        for name, value in row.items():
+            if name not in conflict_keys:
+                current[name] = (current.get(name) or 0) + value
+    rows = list(merged.values())
+    if not rows:
+        return 0
+
+    async def _execute(session: AsyncSession) -> None:
+        groups: dict = {}
+        for row in rows:
+            groups.setdefault(tuple(sorted(row)), []).append(row)
+
+        for columns, group in groups.items():
+            counters = [name for name in columns if name not in conflict_keys]
+            statement = _dialect_insert(session, table_class)
+            if statement is None:
+                for row in group:
+                    condition = [getattr(table_class, key) == row[key] for key in conflict_keys]
+                    result = await session.execute(
+                        update(table_class).where(*condition).values(
+                            {name: getattr(table_class, name) + row[name] for name in counters}
+                        )
+                    )
+                    if result.rowcount == 0:
+                        await session.execute(insert(table_class), [row])
+                continue
+
+            statement = statement.on_conflict_do_update(
+                index_elements=list(conflict_keys),
+                set_={name: getattr(table_class, name) + statement.excluded[name] for name in counters}
+            )
+            await session.execute(statement, group)
+
+    if session is not None:
+        await _execute(session)
+        return len(rows)
+
+    async with AsyncSessionLocal() as session:
+        await _execute(session)
+        await session.commit()
+    return len(rows)
+
+async def append_context_many(rows: List[dict], session: AsyncSession = None) -> int:
+    """
+    Дописывает сообщения в контекст сессий (context_sessions) внутри базы.
+
+    Строки сессий блокируются (SELECT ... FOR UPDATE), новые сообщения добавляются
+    к контексту, сохраненному в базе, и контекст обрезается до context_length.
+    Поэтому процессы, которые одновременно дописывают одну сессию, не затирают
+    сообщения друг друга, как это было бы при записи всего списка из своей копии.
+    Отсутствующие сессии создаются (INSERT ... ON CONFLICT DO NOTHING), неактивная
+    сессия начинается заново. Операции одной сессии применяются в порядке поступления.
+
+    Аргументы:
+        rows: List[dict] - session_id, messages (новые сообщения), context_length
+              (для новой сессии) и updated_at
+        session: AsyncSession - Сессия, в транзакции которой выполняется запрос
+                 (по умолчанию создается своя сессия с коммитом)
+
+    Возвращает:
+        int: Количество обновленных сессий
+    """
+    rows = [_coerce_row(ContextSession, row) for row in rows]
+    first: dict = {}
+    for row in rows:
+        first.setdefault(row["session_id"], row)
+    if not first:
+        return 0
+
+    async def _execute(session: AsyncSession) -> None:
+        # Порядок блокировки одинаковый во всех процессах, чтобы не было взаимных блокировок
+        ids = sorted(first, key=str)
+        missing = [
+            {
+                "session_id": key,
+                "context": [],
+                "context_length": first[key]["context_length"],
+                "is_active": True,
+                "created_at": first[key]["updated_at"],
+                "updated_at": first[key]["updated_at"],
+            }
+            for key in ids
+        ]
+        statement = _dialect_insert(session, ContextSession)
+        if statement is not None:
+            await session.execute(statement.on_conflict_do_nothing(index_elements=["session_id"]), missing)
+        else:
+            existing = set(await session.scalars(select(ContextSession.session_id).where(ContextSession.session_id.in_(ids))))
+            missing = [row for row in missing if row["session_id"] not in existing]
+            if missing:
+                await session.execute(insert(ContextSession), missing)
+
+        result = await session.execute(
+            select(ContextSession.session_id, ContextSession.context, ContextSession.context_length, ContextSession.is_active)
+            .where(ContextSession.session_id.in_(ids))
+            .order_by(ContextSession.session_id)
+            .with_for_update()
+        )
+        stored = {
+            key: (list(context or []) if is_active else [], context_length or first[key]["context_length"])
+            for key, context, context_length, is_active in result.all()
+        }
+
+        contexts: dict = {}
+        updated: dict = {}
+        for row in rows:
+            key = row["session_id"]
+            context, context_length = contexts.get(key) or stored[key]
+            contexts[key] = ((context + row["messages"])[-context_length:], context_length)
+            updated[key] = row["updated_at"]
+
+        for key, (context, _) in contexts.items():
+            await session.execute(
+                update(ContextSession)
+                .where(ContextSession.session_id == key)
+                .values(
+                    context=context,
+                    is_active=True,
+                    updated_at=updated[key],
+                    last_message_at=updated[key],
                 )
             )
 
-            existing_record: Optional[Base] = existing.scalar_one_or_none()
-            
-            if existing_record:
-                # Обновляем существующую запись
-                for key, value in data.items():
-                    setattr(existing_record, key, value)
-                await session.commit()
-                return existing_record
+    if session is not None:
+        await _execute(session)
+        return len(first)
+
+    async with AsyncSessionLocal() as session:
+        await _execute(session)
+        await session.commit()
+    return len(first)
+
+async def upsert(table_class: Base, data: dict, conflict_keys: Tuple[str, ...] = ("chat_id",)) -> Any:
+    """
+    Вставляет запись или обновляет существующую одним запросом и возвращает ее.
+
+    Аргументы:
+        table_class: Base - Класс модели SQLAlchemy
+        data: dict - Значения столбцов, включая conflict_keys
+        conflict_keys: Tuple[str, ...] - Столбцы уникального ограничения
+
+    Возвращает:
+        Актуальную запись после вставки или обновления
+    """
+    data = _coerce_row(table_class, data)
+    async with AsyncSessionLocal() as session:
+        statement = _dialect_insert(session, table_class)
+        if statement is None:
+            await _upsert_fallback(session, table_class, [data], tuple(conflict_keys))
+            record = await session.scalar(
+                select(table_class).where(*[getattr(table_class, key) == data[key] for key in conflict_keys])
+            )
+        else:
+            update_columns = {name: statement.excluded[name] for name in data if name not in conflict_keys}
+            statement = statement.values(**data)
+            if update_columns:
+                statement = statement.on_conflict_do_update(index_elements=list(conflict_keys), set_=update_columns)
+            else:
+                # DO UPDATE без изменений, чтобы RETURNING вернул существующую запись
+                key = conflict_keys[0]
+                statement = statement.on_conflict_do_update(index_elements=list(conflict_keys), set_={key: statement.excluded[key]})
+            result = await session.execute(
+                statement.returning(table_class),
+                execution_options={"populate_existing": True}
+            )
+            record = result.scalar_one()
+        await session.commit()
+        return record
+
+async def update_by_key(table_class: Base, key: str, value: Any, data: dict, where: Optional[dict] = None) -> Any:
+    """
+    Обновляет запись по значению столбца одним запросом UPDATE ... RETURNING.
+
+    Аргументы:
+        table_class: Base - Класс модели SQLAlchemy
+        key: str - Имя столбца для поиска (например, "chat_id")
+        value: Any - Значение столбца
+        data: dict - Новые значения столбцов
+        where: dict - Дополнительные условия равенства столбцов (например, {"api_key_id": ...}),
+                      запись, не подходящая под них, считается не найденной (опционально)
+
+    Возвращает:
+        Обновленную запись или None, если запись не найдена
+    """
+    lookup = _coerce_row(table_class, {key: value})[key]
+    conditions = [getattr(table_class, column) == column_value for column, column_value in (where or {}).items()]
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(table_class)
+            .where(getattr(table_class, key) == lookup, *conditions)
+            .values(**_coerce_row(table_class, data))
+            .returning(table_class),
+            execution_options={"synchronize_session": False}
+        )
+        record = result.scalars().first()
+        await session.commit()
+        return record
+
+async def add_to_table(table_class: Base, data: dict) -> Any:
+    """
+    Общая функция для добавления данных в любую таблицу.
+
+    Если в данных есть chat_id, запись вставляется или обновляется одним
+    запросом INSERT ... ON CONFLICT (chat_id) (см. upsert), иначе просто вставляется.
+    Ошибки базы данных пробрасываются вызывающему коду.
+    
+    Аргументы:
+        table_class: Base - Класс модели SQLAlchemy
+        data: dict - Данные для вставки
         
-        # Проверяем, можно ли создать новую запись
-        try:
-            new_record: Base = table_class(**data)
-            session.add(new_record)
-            await session.commit()
-            await session.refresh(new_record)
-            return new_record
-        except Exception as e:
-            # Если не удалось вставить данные, возвращаем False
-            return False
+    Возвращает:
+        Созданную или обновленную запись
+    """
+    if 'chat_id' in data:
+        return await upsert(table_class, data, ("chat_id",))
+
+    records = await add_many(table_class, [data])
+    return records[0]
 
 async def get_table_data(table_class: Base) -> List[dict]:
     """
@@ -128,7 +673,8 @@ async def save_chat_history(request: Any = None) -> ChatHistory:
             'answer': "",  # Используем переданный ответ
             'token': request['token'],  # Используем переданное количество токенов
             'context': request['context'],  # Используем переданный контекст
-            'created_at': request.get('created_at', datetime.utcnow())  # Используем переданное время или текущее
+            'created_at': request.get('created_at', datetime.utcnow()),  # Используем переданное время или текущее
+            'api_key_id': request.get('api_key_id')  # Отпечаток ключа владельца чата
         }
         
         # Добавляем chat_id только если его нет в request
@@ -145,9 +691,64 @@ async def save_chat_history(request: Any = None) -> ChatHistory:
 
 
 
-async def get_history(model: Optional[str], start_date: Optional[datetime], end_date: Optional[datetime], page: int, page_size: int) -> Tuple[List[ChatHistory], int]:
+def _history_filters(model: Optional[str], start_date: Optional[datetime], end_date: Optional[datetime], api_key_id: Optional[str] = None) -> list:
+    conditions = []
+    if api_key_id is not None:
+        conditions.append(ChatHistory.api_key_id == api_key_id)
+    if model:
+        conditions.append(ChatHistory.model_gpt == model)
+    if start_date:
+        conditions.append(ChatHistory.created_at >= start_date)
+    if end_date:
+        conditions.append(ChatHistory.created_at <= end_date)
+    return conditions
+
+def encode_history_cursor(row: ChatHistory, direction: str) -> str:
     """
-    Получает историю чатов с возможностью фильтрации и пагинации.
+    Кодирует позицию в истории в непрозрачный курсор.
+
+    Аргументы:
+        row: ChatHistory - Крайняя запись страницы
+        direction: str - "next" (записи старше row) или "prev" (записи новее row)
+
+    Возвращает:
+        str: base64url-строка без выравнивания
+    """
+    payload = json.dumps({"c": row.created_at.isoformat(), "i": row.id, "d": direction}, separators=(",", ":"))
+    return base64.urlsafe_b64encode(payload.encode()).decode().rstrip("=")
+
+def decode_history_cursor(cursor: str) -> Tuple[datetime, int, str]:
+    """
+    Разбирает курсор, созданный encode_history_cursor.
+
+    Возвращает:
+        Tuple[datetime, int, str] - created_at, id и направление
+
+    Исключения:
+        ValueError: Если курсор поврежден
+    """
+    try:
+        payload = json.loads(base64.urlsafe_b64decode(cursor + "=" * (-len(cursor) % 4)))
+        direction = payload["d"]
+        if direction not in ("next", "prev"):
+            raise ValueError(direction)
+        return datetime.fromisoformat(payload["c"]), int(payload["i"]), direction
+    except Exception:
+        raise ValueError("Invalid cursor")
+
+async def get_history(
+    model: Optional[str],
+    start_date: Optional[datetime],
+    end_date: Optional[datetime],
+    page: int,
+    page_size: int,
+    api_key_id: Optional[str] = None
+) -> Tuple[List[ChatHistory], int]:
+    """
+    Получает историю чатов с возможностью фильтрации и пагинации через OFFSET.
+
+    Оставлена для совместимости: стоимость OFFSET и count(*) растет с номером страницы,
+    для новых клиентов используйте get_history_page.
     
     Аргументы:
         model: str - Фильтр по модели (опционально)
@@ -155,83 +756,213 @@ async def get_history(model: Optional[str], start_date: Optional[datetime], end_
         end_date: datetime - Конечная дата фильтрации (опционально)
         page: int - Номер страницы
         page_size: int - Количество записей на странице
+        api_key_id: str - Только записи этого API-ключа (опционально, None - все записи)
         
     Возвращает:
         Tuple[List[ChatHistory], int] - Список записей истории и общее количество
     """
     async with AsyncSessionLocal() as session:
-        query = select(ChatHistory)
-        
-        if model:
-            query = query.where(ChatHistory.model == model)
-        if start_date:
-            query = query.where(ChatHistory.created_at >= start_date)
-        if end_date:
-            query = query.where(ChatHistory.created_at <= end_date)
+        query = select(ChatHistory).where(*_history_filters(model, start_date, end_date, api_key_id))
         
         # Получаем общее количество записей
         total: int = await session.scalar(select(func.count()).select_from(query.subquery()))
         
         # Применяем пагинацию
+        query = query.order_by(ChatHistory.created_at.desc(), ChatHistory.id.desc())
         query = query.offset((page - 1) * page_size).limit(page_size)
         result = await session.execute(query)
         history: List[ChatHistory] = result.scalars().all()
         
         return history, total
 
-async def get_statistics() -> dict:
+async def get_history_page(
+    model: Optional[str],
+    start_date: Optional[datetime],
+    end_date: Optional[datetime],
+    limit: int,
+    cursor: Optional[str] = None,
+    total: str = "none",
+    api_key_id: Optional[str] = None
+) -> dict:
     """
-    Получает статистику использования чата.
-    
+    Получает страницу истории чатов с keyset-пагинацией по (created_at, id).
+
+    Записи отдаются от новых к старым. Вместо OFFSET страница начинается с условия
+    (created_at, id) < (курсор), которое обслуживается индексом
+    ix_chat_history_api_key_id_created_at_id (или ix_chat_history_api_key_id_model_gpt_created_at_id
+    при фильтре по модели), поэтому любая страница стоит столько же, сколько первая.
+
+    Аргументы:
+        model: str - Фильтр по модели (опционально)
+        start_date: datetime - Начальная дата фильтрации (опционально)
+        end_date: datetime - Конечная дата фильтрации (опционально)
+        limit: int - Количество записей на странице
+        cursor: str - next_cursor или prev_cursor предыдущего ответа (опционально)
+        total: str - Подсчет общего количества: "none" (не считать), "exact" (count(*))
+                     или "estimate" (оценка планировщика Postgres или кэшированный count)
+        api_key_id: str - Только записи этого API-ключа (опционально, None - все записи)
+
     Возвращает:
-        dict - Словарь со статистикой:
-            - total_requests: Общее количество запросов
-            - requests_by_model: Количество запросов по каждой модели
-            - total_tokens: Общее количество использованных токенов
+        dict: items, next_cursor, prev_cursor, total, total_is_estimate
+
+    Исключения:
+        ValueError: Если курсор поврежден
     """
+    conditions = _history_filters(model, start_date, end_date, api_key_id)
+    position = tuple_(ChatHistory.created_at, ChatHistory.id)
+    direction = "next"
+    if cursor:
+        created_at, row_id, direction = decode_history_cursor(cursor)
+        if direction == "next":
+            conditions.append(position < tuple_(literal(created_at, TIMESTAMP), literal(row_id, Integer)))
+        else:
+            conditions.append(position > tuple_(literal(created_at, TIMESTAMP), literal(row_id, Integer)))
+
+    if direction == "next":
+        order = (ChatHistory.created_at.desc(), ChatHistory.id.desc())
+    else:
+        order = (ChatHistory.created_at.asc(), ChatHistory.id.asc())
+
     async with AsyncSessionLocal() as session:
-        # Получаем общее количество запросов
-        total_requests: int = await session.scalar(
-            select(func.count()).select_from(ChatHistory)
+        # Берем на одну запись больше, чтобы узнать, есть ли следующая страница
+        result = await session.execute(
+            select(ChatHistory).where(*conditions).order_by(*order).limit(limit + 1)
         )
-        
-        # Получаем статистику по моделям
-        models_query = select(
-            ChatHistory.model,
-            func.count(ChatHistory.id).label('count')
-        ).group_by(ChatHistory.model)
-        
-        models_result = await session.execute(models_query)
-        models_stats: dict = {row.model: row.count for row in models_result}
-        
-        # Получаем общее количество токенов
-        total_tokens: int = await session.scalar(
-            select(func.sum(ChatHistory.tokens_used))
-        ) or 0
-        
-        return {
-            "total_requests": total_requests,
-            "requests_by_model": models_stats,
-            "total_tokens": total_tokens
-        }
+        rows: List[ChatHistory] = list(result.scalars().all())
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+        if direction == "prev":
+            rows.reverse()
+
+        count, is_estimate = None, False
+        if total == "exact":
+            count = await _count_history(session, model, start_date, end_date, api_key_id)
+        elif total == "estimate":
+            count, is_estimate = await _estimate_history_count(session, model, start_date, end_date, api_key_id)
+
+    next_cursor = prev_cursor = None
+    if rows:
+        # Вперед: следующая страница есть, если запрос вернул лишнюю запись;
+        # назад: после текущей страницы всегда есть запись, с которой мы пришли
+        if has_more or direction == "prev":
+            next_cursor = encode_history_cursor(rows[-1], "next")
+        if (has_more and direction == "prev") or (cursor and direction == "next"):
+            prev_cursor = encode_history_cursor(rows[0], "prev")
+
+    return {
+        "items": rows,
+        "next_cursor": next_cursor,
+        "prev_cursor": prev_cursor,
+        "total": count,
+        "total_is_estimate": is_estimate,
+    }
 
-async def delete_table(table_class: Base, chat_id: str) -> bool:
+async def _count_history(
+    session: AsyncSession,
+    model: Optional[str],
+    start_date: Optional[datetime],
+    end_date: Optional[datetime],
+    api_key_id: Optional[str] = None
+) -> int:
+    return await session.scalar(
+        select(func.count()).select_from(ChatHistory).where(*_history_filters(model, start_date, end_date, api_key_id))
+    )
+
+# Кэш точных count(*) для total=estimate на базах без оценки планировщика:
+# (model, start_date, end_date, api_key_id) -> (момент устаревания, количество)
+_history_count_cache: dict = {}
+
+async def _estimate_history_count(
+    session: AsyncSession,
+    model: Optional[str],
+    start_date: Optional[datetime],
+    end_date: Optional[datetime],
+    api_key_id: Optional[str] = None
+) -> Tuple[int, bool]:
+    """
+    Оценивает количество записей истории без полного прохода по таблице.
+
+    На Postgres используется статистика планировщика: reltuples из pg_class без фильтров,
+    иначе "Plan Rows" из EXPLAIN. На остальных базах (и если оценка не удалась)
+    возвращается точный count(*), кэшируемый на HISTORY_COUNT_CACHE_TTL секунд.
+
+    Возвращает:
+        Tuple[int, bool] - Количество и признак того, что это оценка
+    """
+    dialect = session.bind.dialect
+    if dialect.name == "postgresql":
+        try:
+            conn = await session.connection()
+            if not (model or start_date or end_date or api_key_id is not None):
+                estimate = await session.scalar(
+                    text("SELECT reltuples::bigint FROM pg_class WHERE oid = 'chat_history'::regclass")
+                )
+                # reltuples = -1, пока таблицу ни разу не анализировали
+                if estimate is not None and estimate >= 0:
+                    return int(estimate), True
+            else:
+                query = select(ChatHistory.id).where(*_history_filters(model, start_date, end_date, api_key_id))
+                sql = str(query.compile(dialect=dialect, compile_kwargs={"literal_binds": True}))
+                result = await conn.exec_driver_sql("EXPLAIN (FORMAT JSON) " + sql)
+                plan = result.scalar()
+                if isinstance(plan, str):
+                    plan = json.loads(plan)
+                return int(plan[0]["Plan"]["Plan Rows"]), True
+        except Exception as e:
+            print(f"Error occurred while estimating history count: {e}")
+
+    key = (model, start_date, end_date, api_key_id)
+    cached = _history_count_cache.get(key)
+    now = time.monotonic()
+    if cached is not None and cached[0] > now:
+        return cached[1], True
+
+    count = await _count_history(session, model, start_date, end_date, api_key_id)
+    if len(_history_count_cache) >= 1024:
+        _history_count_cache.clear()
+    _history_count_cache[key] = (now + HISTORY_COUNT_CACHE_TTL, count)
+    return count, True
+
+async def assign_chat_owner(api_key_id: str) -> int:
+    """
+    Назначает владельца чатам без владельца (api_key_id IS NULL).
+
+    История, записанная до разделения по API-ключам, не принадлежит ни одному ключу:
+    ее не видно в истории клиентов, и ее не могут изменить ни сохранение ответа,
+    ни переименование, ни удаление. Шаг миграции: python -m app.core.security assign-chats.
+
+    Аргументы:
+        api_key_id: str - Отпечаток API-ключа нового владельца
+
+    Возвращает:
+        int: Количество чатов, получивших владельца
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(ChatHistory).where(ChatHistory.api_key_id.is_(None)).values(api_key_id=api_key_id)
+        )
+        await session.commit()
+    return result.rowcount
+
+async def delete_table(table_class: Base, chat_id: str, api_key_id: Optional[str] = None) -> bool:
     """
     Удаляет чат из базы данных по его идентификатору.
     
     Аргументы:
         chat_id: str - Уникальный идентификатор чата для удаления
         table_class: Base - Класс модели SQLAlchemy для удаления
+        api_key_id: str - Удалять только чат этого API-ключа (опционально, чужой чат не найден)
         
     Возвращает:
         bool: True если чат был успешно удален, False если чат не найден
     """
     async with AsyncSessionLocal() as session:
         try:
-            # Находим чат по ID
-            chat = await session.scalar(
-                select(table_class).where(table_class.chat_id == chat_id)
-            )
+            # Находим чат по ID (строковый идентификатор приводится к UUID, как в update_by_key)
+            query = select(table_class).where(table_class.chat_id == _coerce_row(table_class, {"chat_id": chat_id})["chat_id"])
+            if api_key_id is not None:
+                query = query.where(table_class.api_key_id == api_key_id)
+            chat = await session.scalar(query)
             if chat is None:
                 return False  # Чат не найден
             
@@ -255,6 +986,8 @@ async def get_chat_data(chat_id: str) -> dict:
         dict: Данные чата, если найден, иначе None
     """
     async with AsyncSessionLocal() as session:
+        # Строковый идентификатор приводится к UUID, как в delete_table
+        chat_id = _coerce_row(ChatHistory, {"chat_id": chat_id})["chat_id"]
         result = await session.execute(select(ChatHistory).where(ChatHistory.chat_id == chat_id))
         chat_data = result.scalars().first()
         
@@ -265,3 +998,173 @@ async def get_chat_data(chat_id: str) -> dict:
                 # Добавьте другие необходимые поля
             }
     return None
+
+async def get_cached_response(key: str) -> Optional[str]:
+    """
+    Получает сохраненный ответ из постоянного слоя кэша.
+
+    Параметры:
+        key: str - Хэш запроса (см. app.services.cache.request_cache_key)
+
+    Возвращает:
+        str: Текст ответа, если запись найдена и не устарела, иначе None
+    """
+    async with AsyncSessionLocal() as session:
+        return await session.scalar(
+            select(CachedResponse.response).where(
+                CachedResponse.key == key,
+                CachedResponse.expires_at > datetime.utcnow()
+            )
+        )
+
+async def save_cached_response(key: str, model: str, response: str, ttl: float) -> None:
+    """
+    Сохраняет ответ в постоянный слой кэша (перезаписывая существующую запись).
+
+    Параметры:
+        key: str - Хэш запроса
+        model: str - Модель, сгенерировавшая ответ
+        response: str - Текст ответа
+        ttl: float - Время жизни записи в секундах
+    """
+    now = datetime.utcnow()
+    await upsert_many(CachedResponse, [{
+        "key": key,
+        "model": model,
+        "response": response,
+        "created_at": now,
+        "expires_at": now + timedelta(seconds=ttl)
+    }], ("key",))
+
+async def create_job(kind: str, params: dict, api_key_id: Optional[str]) -> Job:
+    """
+    Создает фоновую задачу в статусе queued.
+
+    Параметры:
+        kind: str - Тип задачи (image, transcription)
+        params: dict - Параметры задачи (JSON)
+        api_key_id: str - Отпечаток API-ключа владельца
+
+    Возвращает:
+        Job: Созданная задача
+    """
+    async with AsyncSessionLocal() as session:
+        job = Job(kind=kind, status="queued", params=params, api_key_id=api_key_id, created_at=datetime.utcnow())
+        session.add(job)
+        await session.commit()
+        return job
+
+async def get_job(job_id: uuid.UUID) -> Optional[Job]:
+    """Возвращает фоновую задачу по идентификатору (None, если ее нет или она удалена по TTL)."""
+    async with AsyncSessionLocal() as session:
+        return await session.get(Job, job_id)
+
+async def get_job_statuses(job_ids: List[uuid.UUID]) -> dict:
+    """
+    Возвращает статусы задач.
+
+    Возвращает:
+        dict: Идентификатор задачи -> статус (удаленных задач в словаре нет)
+    """
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(select(Job.id, Job.status).where(Job.id.in_(job_ids)))
+        return {job_id: status for job_id, status in rows}
+
+async def update_job(job_id: uuid.UUID, data: dict, statuses: Tuple[str, ...]) -> bool:
+    """
+    Обновляет задачу, только если она в одном из статусов statuses.
+
+    Условное обновление - это переход состояния: задачу может взять в работу только
+    один воркер, а результат задачи, отмененной во время выполнения, не перезапишет отмену.
+
+    Параметры:
+        job_id: UUID - Идентификатор задачи
+        data: dict - Новые значения столбцов
+        statuses: Tuple[str, ...] - Допустимые текущие статусы
+
+    Возвращает:
+        bool: True, если задача обновлена
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(Job).where(Job.id == job_id, Job.status.in_(statuses)).values(**data)
+        )
+        await session.commit()
+        return result.rowcount > 0
+
+async def delete_expired_jobs(now: datetime) -> int:
+    """
+    Удаляет завершенные задачи с истекшим сроком хранения результата.
+
+    Возвращает:
+        int: Количество удаленных задач
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(delete(Job).where(Job.expires_at < now))
+        await session.commit()
+        return result.rowcount
+
+async def fail_stale_jobs(started_before: datetime, expires_at: datetime) -> int:
+    """
+    Помечает failed задачи, которые ждут или выполняются дольше допустимого
+    (например, процесс, выполнявший их, был остановлен).
+
+    Параметры:
+        started_before: datetime - Задачи, созданные раньше этого момента, считаются зависшими
+        expires_at: datetime - Срок хранения для помеченных задач
+
+    Возвращает:
+        int: Количество помеченных задач
+    """
+    async with AsyncSessionLocal() as session:
+        result = await session.execute(
+            update(Job)
+            .where(Job.status.in_(("queued", "running")), Job.created_at < started_before)
+            .values(
+                status="failed",
+                error={"error": "JobInterrupted", "detail": "Job did not finish in time", "status_code": 500},
+                finished_at=datetime.utcnow(),
+                expires_at=expires_at
+            )
+        )
+        await session.commit()
+        return result.rowcount
+
+async def get_active_users() -> List[User]:
+    """Возвращает активных клиентов (для загрузки API-ключей в память, см. app.core.security)."""
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(select(User).where(User.is_active.is_(True)))
+        return list(rows.scalars())
+
+async def get_user_by_api_key(key_hash: str) -> Optional[User]:
+    """
+    Возвращает активного клиента по SHA-256 API-ключа.
+
+    Параметры:
+        key_hash: str - SHA-256 (hex) ключа (см. app.core.security.hash_api_key)
+
+    Возвращает:
+        Optional[User]: Клиент (None, если ключа нет или клиент отключен)
+    """
+    async with AsyncSessionLocal() as session:
+        rows = await session.execute(select(User).where(User.api_key == key_hash, User.is_active.is_(True)))
+        return rows.scalar_one_or_none()
+
+async def create_user(name: str, key_hash: str, rpm: Optional[int] = None, tpm: Optional[int] = None) -> User:
+    """
+    Создает клиента с API-ключом.
+
+    Параметры:
+        name: str - Название клиента
+        key_hash: str - SHA-256 (hex) ключа
+        rpm: int - Лимит запросов в минуту (None - по умолчанию)
+        tpm: int - Лимит токенов в минуту (None - по умолчанию)
+
+    Возвращает:
+        User: Созданный клиент
+    """
+    async with AsyncSessionLocal() as session:
+        user = User(name=name, api_key=key_hash, is_active=True, rpm=rpm, tpm=tpm, created_at=datetime.utcnow())
+        session.add(user)
+        await session.commit()
+        return user
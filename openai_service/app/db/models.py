@@ -1,4 +1,4 @@
-from sqlalchemy import Column, Integer, String, TIMESTAMP, ForeignKey, JSON, UUID, Text, Boolean
+from sqlalchemy import Column, Integer, BigInteger, String, TIMESTAMP, ForeignKey, JSON, UUID, Text, Boolean, Index
 from sqlalchemy.ext.declarative import declarative_base
 from datetime import datetime, timezone, timedelta
 import uuid
@@ -6,42 +6,113 @@ import uuid
 Base = declarative_base()
 
 class User(Base):
+    """Клиент сервиса (tenant): API-ключ и лимиты клиента (см. app.core.security)."""
     __tablename__ = "users"
     
     id = Column(Integer, primary_key=True)
-    api_key = Column(String(100))
+    name = Column(String(100))
+    api_key = Column(String(100), unique=True)  # SHA-256 (hex) ключа; сам ключ не хранится
+    is_active = Column(Boolean, default=True, nullable=False)
+    rpm = Column(Integer)  # Лимиты клиента в минуту (NULL - RATE_LIMIT_RPM / RATE_LIMIT_TPM)
+    tpm = Column(Integer)
     created_at = Column(TIMESTAMP, default=datetime.utcnow)
 
 class ChatHistory(Base):
     __tablename__ = "chat_history"
 
     id = Column(Integer, primary_key=True, autoincrement=True)
-    chat_id = Column(UUID(as_uuid=True), nullable=False)  
+    chat_id = Column(UUID(as_uuid=True), nullable=False, unique=True)
     chat_name = Column(String)
     question = Column(Text)
     answer = Column(Text)
     model_gpt = Column(String)
-    created_at = Column(TIMESTAMP, default=lambda: datetime.now().replace(second=0, microsecond=0), nullable=False)
+    created_at = Column(TIMESTAMP, default=lambda: datetime.utcnow().replace(second=0, microsecond=0), nullable=False)
     context = Column(JSON)
     token = Column(Integer)
+    prompt_tokens = Column(Integer)
+    completion_tokens = Column(Integer)
+    response_time_ms = Column(Integer)
+    api_key_id = Column(String(16))
+
+    # Индексы под keyset-пагинацию истории API-ключа: ORDER BY created_at DESC, id DESC
+    # (с фильтром по модели и без него); created_at, id - для пересчета агрегатов по времени
+    __table_args__ = (
+        Index("ix_chat_history_created_at_id", "created_at", "id"),
+        Index("ix_chat_history_api_key_id_created_at_id", "api_key_id", "created_at", "id"),
+        Index("ix_chat_history_api_key_id_model_gpt_created_at_id", "api_key_id", "model_gpt", "created_at", "id"),
+    )
 
 class ContextSession(Base):
     __tablename__ = "context_sessions"
     
     id = Column(Integer, primary_key=True)
     user_id = Column(Integer, ForeignKey("users.id"))
-    session_id = Column(UUID)
+    session_id = Column(UUID(as_uuid=True), unique=True)
     context = Column(JSON)
     context_length = Column(Integer, default=10)
     is_active = Column(Boolean, default=True)
-    created_at = Column(TIMESTAMP, default=lambda: datetime.now().replace(second=0, microsecond=0), nullable=False)
-    updated_at = Column(TIMESTAMP, default=lambda: datetime.now().replace(second=0, microsecond=0), nullable=False)
+    created_at = Column(TIMESTAMP, default=lambda: datetime.utcnow().replace(second=0, microsecond=0), nullable=False)
+    updated_at = Column(TIMESTAMP, default=lambda: datetime.utcnow().replace(second=0, microsecond=0), nullable=False)
     last_message_at = Column(TIMESTAMP)
 
 class JsonData(Base):
     __tablename__ = "json_data"
     
     id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
-    created_at = Column(TIMESTAMP, default=lambda: datetime.now().replace(second=0, microsecond=0), nullable=False)
+    created_at = Column(TIMESTAMP, default=lambda: datetime.utcnow().replace(second=0, microsecond=0), nullable=False)
     data = Column(JSON)
 
+class CachedResponse(Base):
+    __tablename__ = "response_cache"
+
+    key = Column(String(64), primary_key=True)
+    model = Column(String)
+    response = Column(Text)
+    created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+    expires_at = Column(TIMESTAMP, nullable=False)
+
+class UsageRollup(Base):
+    """Агрегаты использования за час по модели и API-ключу (см. app.db.rollups)."""
+    __tablename__ = "usage_rollups"
+
+    bucket = Column(TIMESTAMP, primary_key=True)
+    model = Column(String, primary_key=True)
+    api_key_id = Column(String(16), primary_key=True)
+    requests = Column(Integer, nullable=False, default=0)
+    prompt_tokens = Column(BigInteger, nullable=False, default=0)
+    completion_tokens = Column(BigInteger, nullable=False, default=0)
+    total_tokens = Column(BigInteger, nullable=False, default=0)
+    latency_count = Column(Integer, nullable=False, default=0)
+    latency_ms_sum = Column(BigInteger, nullable=False, default=0)
+
+class LatencyHistogram(Base):
+    """Гистограмма времени ответа за час по модели и API-ключу: le_ms - верхняя граница корзины."""
+    __tablename__ = "usage_latency_histogram"
+
+    bucket = Column(TIMESTAMP, primary_key=True)
+    model = Column(String, primary_key=True)
+    api_key_id = Column(String(16), primary_key=True)
+    le_ms = Column(Integer, primary_key=True)
+    count = Column(Integer, nullable=False, default=0)
+
+class Job(Base):
+    """Фоновая задача (см. app.services.jobs): параметры, состояние и результат."""
+    __tablename__ = "jobs"
+
+    id = Column(UUID(as_uuid=True), primary_key=True, default=uuid.uuid4)
+    kind = Column(String(32), nullable=False)
+    status = Column(String(16), nullable=False, default="queued")
+    params = Column(JSON)
+    result = Column(JSON)
+    error = Column(JSON)
+    api_key_id = Column(String(16))
+    created_at = Column(TIMESTAMP, default=datetime.utcnow, nullable=False)
+    started_at = Column(TIMESTAMP)
+    finished_at = Column(TIMESTAMP)
+    expires_at = Column(TIMESTAMP)
+
+    # Очистка устаревших и зависших задач: WHERE expires_at < now / WHERE status = ... AND created_at < ...
+    __table_args__ = (
+        Index("ix_jobs_expires_at", "expires_at"),
+        Index("ix_jobs_status_created_at", "status", "created_at"),
+    )
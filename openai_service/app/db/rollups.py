@@ -0,0 +1,321 @@
+"""
+Почасовые агрегаты использования (rollups) для статистики.
+
+Каждое завершение чата прибавляет счетчики к строке usage_rollups
+(час, модель, отпечаток API-ключа) и к корзине гистограммы времени ответа
+в usage_latency_histogram. Запись идет через фоновый писатель (app.db.writer),
+который суммирует события пакета, поэтому на пакет приходится по одному
+INSERT ... ON CONFLICT на таблицу.
+
+Статистика читается только из агрегатов: стоимость запроса пропорциональна
+количеству часовых корзин в диапазоне, а не количеству строк chat_history.
+
+Заполнение агрегатов для истории, накопленной до их появления:
+    python -m app.db.rollups --start 2024-01-01 [--end 2024-06-01]
+"""
+from sqlalchemy import select, delete, func
+from typing import Dict, List, Optional, Tuple
+from datetime import datetime, timedelta
+from bisect import bisect_left
+from .database import AsyncSessionLocal, add_many
+from .models import ChatHistory, UsageRollup, LatencyHistogram
+from .writer import writer
+import argparse
+import asyncio
+
+# Верхние границы корзин гистограммы времени ответа (мс); все, что дольше, - в LATENCY_OVERFLOW_MS
+LATENCY_BUCKETS_MS = (25, 50, 100, 250, 500, 1000, 2500, 5000, 10000, 30000, 60000, 120000)
+LATENCY_OVERFLOW_MS = 2 ** 31 - 1
+PERCENTILES = (0.5, 0.9, 0.95, 0.99)
+
+ROLLUP_KEYS = ("bucket", "model", "api_key_id")
+HISTOGRAM_KEYS = ROLLUP_KEYS + ("le_ms",)
+
+
+def hour_bucket(moment: datetime) -> datetime:
+    """Возвращает начало часа, к которому относится момент времени."""
+    return moment.replace(minute=0, second=0, microsecond=0)
+
+def latency_bucket(response_time_ms: int) -> int:
+    """Возвращает верхнюю границу корзины гистограммы для времени ответа."""
+    index = bisect_left(LATENCY_BUCKETS_MS, response_time_ms)
+    return LATENCY_BUCKETS_MS[index] if index < len(LATENCY_BUCKETS_MS) else LATENCY_OVERFLOW_MS
+
+async def record_completion(
+    model: str,
+    api_key_id: str,
+    prompt_tokens: int,
+    completion_tokens: int,
+    response_time_ms: Optional[int],
+    at: Optional[datetime] = None
+) -> None:
+    """
+    Ставит в очередь фонового писателя приращения агрегатов для одного завершения чата.
+
+    Аргументы:
+        model: str - Модель
+        api_key_id: str - Отпечаток API-ключа (см. app.core.security.api_key_fingerprint)
+        prompt_tokens: int - Токены промпта
+        completion_tokens: int - Токены ответа
+        response_time_ms: int - Время ответа в миллисекундах (None - не учитывать в задержках)
+        at: datetime - Момент завершения в UTC (по умолчанию сейчас)
+    """
+    key = {
+        "bucket": hour_bucket(at or datetime.utcnow()),
+        "model": model or "",
+        "api_key_id": api_key_id or "",
+    }
+    await writer.increment(UsageRollup, ROLLUP_KEYS, {
+        **key,
+        "requests": 1,
+        "prompt_tokens": prompt_tokens or 0,
+        "completion_tokens": completion_tokens or 0,
+        "total_tokens": (prompt_tokens or 0) + (completion_tokens or 0),
+        "latency_count": 1 if response_time_ms is not None else 0,
+        "latency_ms_sum": response_time_ms or 0,
+    })
+    if response_time_ms is not None:
+        await writer.increment(LatencyHistogram, HISTOGRAM_KEYS, {
+            **key,
+            "le_ms": latency_bucket(response_time_ms),
+            "count": 1,
+        })
+
+def _rollup_filters(table, start: Optional[datetime], end: Optional[datetime], model: Optional[str], api_key_id: Optional[str]) -> list:
+    conditions = []
+    if start:
+        conditions.append(table.bucket >= hour_bucket(start))
+    if end:
+        conditions.append(table.bucket < end)
+    if model:
+        conditions.append(table.model == model)
+    if api_key_id is not None:
+        conditions.append(table.api_key_id == api_key_id)
+    return conditions
+
+def _percentile(histogram: List[Tuple[int, int]], quantile: float) -> Optional[float]:
+    """
+    Оценивает перцентиль по гистограмме с линейной интерполяцией внутри корзины.
+
+    Для корзины переполнения возвращается ее нижняя граница.
+    """
+    total = sum(count for _, count in histogram)
+    if not total:
+        return None
+
+    target = quantile * total
+    cumulative = 0
+    lower = 0
+    for le_ms, count in histogram:
+        if count and cumulative + count >= target:
+            if le_ms == LATENCY_OVERFLOW_MS:
+                return float(lower)
+            return round(lower + (le_ms - lower) * (target - cumulative) / count, 1)
+        cumulative += count
+        lower = le_ms
+    return float(lower)
+
+async def get_statistics(
+    start: Optional[datetime] = None,
+    end: Optional[datetime] = None,
+    model: Optional[str] = None,
+    api_key_id: Optional[str] = None,
+    series: bool = False
+) -> dict:
+    """
+    Получает статистику использования чата из почасовых агрегатов.
+
+    Аргументы:
+        start: datetime - Начало диапазона (UTC, округляется вниз до часа, опционально)
+        end: datetime - Конец диапазона (UTC, не включительно, опционально)
+        model: str - Фильтр по модели (опционально)
+        api_key_id: str - Фильтр по отпечатку API-ключа (опционально)
+        series: bool - Добавить разбивку по часам
+
+    Возвращает:
+        dict - Словарь со статистикой:
+            - total_requests: Общее количество запросов
+            - requests_by_model: Количество запросов по каждой модели
+            - requests_by_api_key: Количество запросов по отпечаткам API-ключей
+            - total_tokens, prompt_tokens, completion_tokens: Количество токенов
+            - average_response_time: Среднее время ответа в миллисекундах
+            - response_time_percentiles: p50, p90, p95 и p99 времени ответа в миллисекундах
+            - series: Разбивка по часам (если series=True)
+    """
+    async with AsyncSessionLocal() as session:
+        conditions = _rollup_filters(UsageRollup, start, end, model, api_key_id)
+        result = await session.execute(
+            select(
+                UsageRollup.model,
+                UsageRollup.api_key_id,
+                func.sum(UsageRollup.requests),
+                func.sum(UsageRollup.prompt_tokens),
+                func.sum(UsageRollup.completion_tokens),
+                func.sum(UsageRollup.total_tokens),
+                func.sum(UsageRollup.latency_count),
+                func.sum(UsageRollup.latency_ms_sum),
+            )
+            .where(*conditions)
+            .group_by(UsageRollup.model, UsageRollup.api_key_id)
+        )
+
+        stats = {
+            "total_requests": 0,
+            "requests_by_model": {},
+            "requests_by_api_key": {},
+            "total_tokens": 0,
+            "prompt_tokens": 0,
+            "completion_tokens": 0,
+        }
+        latency_count = latency_sum = 0
+        for row_model, row_key, requests, prompt, completion, total, count, latency in result:
+            stats["total_requests"] += requests or 0
+            stats["requests_by_model"][row_model] = stats["requests_by_model"].get(row_model, 0) + (requests or 0)
+            stats["requests_by_api_key"][row_key] = stats["requests_by_api_key"].get(row_key, 0) + (requests or 0)
+            stats["prompt_tokens"] += prompt or 0
+            stats["completion_tokens"] += completion or 0
+            stats["total_tokens"] += total or 0
+            latency_count += count or 0
+            latency_sum += latency or 0
+        stats["average_response_time"] = round(latency_sum / latency_count, 1) if latency_count else 0.0
+
+        result = await session.execute(
+            select(LatencyHistogram.le_ms, func.sum(LatencyHistogram.count))
+            .where(*_rollup_filters(LatencyHistogram, start, end, model, api_key_id))
+            .group_by(LatencyHistogram.le_ms)
+            .order_by(LatencyHistogram.le_ms)
+        )
+        histogram = [(le_ms, count or 0) for le_ms, count in result]
+        stats["response_time_percentiles"] = {
+            f"p{int(quantile * 100)}": _percentile(histogram, quantile) for quantile in PERCENTILES
+        }
+
+        if series:
+            result = await session.execute(
+                select(
+                    UsageRollup.bucket,
+                    func.sum(UsageRollup.requests),
+                    func.sum(UsageRollup.total_tokens),
+                    func.sum(UsageRollup.latency_count),
+                    func.sum(UsageRollup.latency_ms_sum),
+                )
+                .where(*conditions)
+                .group_by(UsageRollup.bucket)
+                .order_by(UsageRollup.bucket)
+            )
+            stats["series"] = [
+                {
+                    "bucket": bucket,
+                    "requests": requests or 0,
+                    "total_tokens": total or 0,
+                    "average_response_time": round(latency / count, 1) if count else 0.0,
+                }
+                for bucket, requests, total, count, latency in result
+            ]
+
+        return stats
+
+async def backfill_usage_rollups(start: Optional[datetime] = None, end: Optional[datetime] = None, chunk: timedelta = timedelta(days=1)) -> dict:
+    """
+    Пересчитывает агрегаты по записям chat_history.
+
+    Нужна для истории, накопленной до появления агрегатов: в chat_history хранится
+    одна строка на чат (последнее завершение), поэтому пересчитанные агрегаты
+    приблизительны. По умолчанию пересчитывается период до первой часовой корзины,
+    уже заполненной в реальном времени, чтобы не затереть точные данные.
+
+    Диапазон обрабатывается окнами по chunk: агрегаты окна удаляются и
+    записываются заново в одной транзакции, поэтому повторный запуск безопасен.
+
+    Аргументы:
+        start: datetime - Начало диапазона (по умолчанию самая ранняя запись chat_history)
+        end: datetime - Конец диапазона, не включительно (по умолчанию первая
+                        существующая корзина агрегатов или начало текущего часа)
+        chunk: timedelta - Размер окна пересчета
+
+    Возвращает:
+        dict: Границы диапазона, количество обработанных записей и созданных строк агрегатов
+    """
+    async with AsyncSessionLocal() as session:
+        if end is None:
+            end = await session.scalar(select(func.min(UsageRollup.bucket))) or hour_bucket(datetime.utcnow())
+        if start is None:
+            start = await session.scalar(select(func.min(ChatHistory.created_at)))
+
+    report = {"start": start, "end": end, "rows": 0, "rollups": 0, "histogram": 0}
+    if start is None or start >= end:
+        return report
+
+    start = hour_bucket(start)
+    end = hour_bucket(end)
+    window_start = start
+    while window_start < end:
+        window_end = min(window_start + chunk, end)
+        rollups: Dict[tuple, dict] = {}
+        histogram: Dict[tuple, dict] = {}
+
+        async with AsyncSessionLocal() as session:
+            result = await session.stream(
+                select(
+                    ChatHistory.created_at,
+                    ChatHistory.model_gpt,
+                    ChatHistory.api_key_id,
+                    ChatHistory.token,
+                    ChatHistory.prompt_tokens,
+                    ChatHistory.completion_tokens,
+                    ChatHistory.response_time_ms,
+                )
+                .where(ChatHistory.created_at >= window_start, ChatHistory.created_at < window_end)
+                .execution_options(yield_per=5000)
+            )
+            async for created_at, row_model, row_key, token, prompt, completion, response_time_ms in result:
+                report["rows"] += 1
+                key = (hour_bucket(created_at), row_model or "", row_key or "")
+                rollup = rollups.setdefault(key, {
+                    "bucket": key[0], "model": key[1], "api_key_id": key[2],
+                    "requests": 0, "prompt_tokens": 0, "completion_tokens": 0,
+                    "total_tokens": 0, "latency_count": 0, "latency_ms_sum": 0,
+                })
+                rollup["requests"] += 1
+                rollup["prompt_tokens"] += prompt or 0
+                rollup["completion_tokens"] += completion or 0
+                rollup["total_tokens"] += token or ((prompt or 0) + (completion or 0))
+                if response_time_ms is not None:
+                    rollup["latency_count"] += 1
+                    rollup["latency_ms_sum"] += response_time_ms
+                    le_ms = latency_bucket(response_time_ms)
+                    histogram.setdefault(key + (le_ms,), {
+                        "bucket": key[0], "model": key[1], "api_key_id": key[2], "le_ms": le_ms, "count": 0,
+                    })["count"] += 1
+
+            for table in (UsageRollup, LatencyHistogram):
+                await session.execute(delete(table).where(table.bucket >= window_start, table.bucket < window_end))
+            await add_many(UsageRollup, list(rollups.values()), session=session, returning=False)
+            await add_many(LatencyHistogram, list(histogram.values()), session=session, returning=False)
+            await session.commit()
+
+        report["rollups"] += len(rollups)
+        report["histogram"] += len(histogram)
+        window_start = window_end
+
+    return report
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Пересчет почасовых агрегатов использования по chat_history")
+    parser.add_argument("--start", type=datetime.fromisoformat, help="Начало диапазона (ISO 8601)")
+    parser.add_argument("--end", type=datetime.fromisoformat, help="Конец диапазона, не включительно (ISO 8601)")
+    parser.add_argument("--chunk-hours", type=int, default=24, help="Размер окна пересчета в часах")
+    args = parser.parse_args()
+
+    from .database import init_db, engine
+    await init_db()
+    try:
+        report = await backfill_usage_rollups(args.start, args.end, timedelta(hours=args.chunk_hours))
+        print(report)
+    finally:
+        await engine.dispose()
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
@@ -0,0 +1,219 @@
+from typing import Any, Dict, List, Optional, Tuple
+from app.core.config import WRITER_QUEUE_SIZE, WRITER_BATCH_SIZE, WRITER_FLUSH_INTERVAL
+from .database import AsyncSessionLocal, add_many, upsert_many, increment_many, append_context_many
+from .models import Base, ContextSession, JsonData
+import asyncio
+
+
+class BackgroundWriter:
+    """
+    Фоновая пакетная запись в базу данных (write-behind).
+
+    Обработчики ставят записи в ограниченную очередь и сразу продолжают работу,
+    а фоновая задача сбрасывает накопленное одним пакетом - когда набралось
+    batch_size операций или прошло flush_interval секунд с первой операции пакета.
+
+    Поддерживаемые операции:
+        - insert: вставка строки (пакет - add_many, один многострочный INSERT на таблицу);
+        - upsert: вставка или обновление по ключевому столбцу (пакет - upsert_many,
+          INSERT ... ON CONFLICT на таблицу и набор столбцов);
+        - increment: прибавление счетчиков к строке агрегатов (пакет - increment_many,
+          строки с одинаковым ключом суммируются до записи);
+        - append_context: дописывание сообщений в контекст сессии (пакет - append_context_many,
+          сообщения добавляются к контексту, сохраненному в базе, а не к копии процесса).
+
+    Если очередь заполнена, постановка в очередь ждет освобождения места
+    (backpressure). При остановке очередь выгружается полностью. Если пакет
+    не записался, группы и строки пакета записываются по отдельности: теряются
+    (счетчик failed) только строки, которые не удается записать и поодиночке.
+    Ошибки записываются в лог сервиса (logs_bot) без содержимого строк - только
+    таблица и ключ (chat_id, session_id). Потерянные строки самих логов не логируются.
+    Пока писатель не запущен (скрипты, отдельные вызовы), операции выполняются сразу.
+    """
+
+    def __init__(self, max_queue: int = WRITER_QUEUE_SIZE, batch_size: int = WRITER_BATCH_SIZE, flush_interval: float = WRITER_FLUSH_INTERVAL):
+        self.max_queue = max_queue
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._queue: Optional[asyncio.Queue] = None
+        self._task: Optional[asyncio.Task] = None
+        self.flushed = 0
+        self.failed = 0
+        self._reports: set = set()
+
+    @property
+    def running(self) -> bool:
+        return self._task is not None and not self._task.done()
+
+    async def start(self) -> None:
+        """Запускает фоновую задачу записи в текущем event loop."""
+        if self.running:
+            return
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._task = asyncio.create_task(self._run())
+
+    async def stop(self) -> None:
+        """Дожидается записи всех поставленных в очередь операций и останавливает задачу."""
+        if not self.running:
+            return
+        # Сообщения об ошибках сами ставятся в очередь, поэтому ждем и их
+        await self._queue.join()
+        while self._reports:
+            await asyncio.gather(*self._reports, return_exceptions=True)
+            await self._queue.join()
+        self._task.cancel()
+        try:
+            await self._task
+        except asyncio.CancelledError:
+            pass
+        self._task = None
+
+    async def insert(self, table_class: Base, row: dict) -> None:
+        """
+        Ставит в очередь вставку строки.
+
+        Аргументы:
+            table_class: Base - Класс модели SQLAlchemy
+            row: dict - Значения столбцов
+        """
+        await self._submit(("insert", table_class, None, row))
+
+    async def upsert(self, table_class: Base, key: str, row: dict, owner_key: Optional[str] = None) -> None:
+        """
+        Ставит в очередь обновление строки по ключевому столбцу (или вставку, если ее нет).
+
+        Аргументы:
+            table_class: Base - Класс модели SQLAlchemy
+            key: str - Имя ключевого столбца (например, "chat_id")
+            row: dict - Значения столбцов, включая ключевой
+            owner_key: str - Столбец владельца: чужая строка не обновляется (см. upsert_many)
+        """
+        await self._submit(("upsert", table_class, (key, owner_key), row))
+
+    async def increment(self, table_class: Base, keys: Tuple[str, ...], row: dict) -> None:
+        """
+        Ставит в очередь прибавление счетчиков к строке агрегатов.
+
+        Аргументы:
+            table_class: Base - Класс модели SQLAlchemy
+            keys: Tuple[str, ...] - Ключевые столбцы строки агрегатов
+            row: dict - Значения ключевых столбцов и приращения счетчиков
+        """
+        await self._submit(("increment", table_class, tuple(keys), row))
+
+    async def append_context(self, row: dict) -> None:
+        """
+        Ставит в очередь дописывание сообщений в контекст сессии.
+
+        Аргументы:
+            row: dict - session_id, messages, context_length и updated_at (см. append_context_many)
+        """
+        await self._submit(("append_context", ContextSession, "session_id", row))
+
+    def qsize(self) -> int:
+        return self._queue.qsize() if self._queue is not None else 0
+
+    async def _submit(self, op: Tuple[str, Base, Any, dict]) -> None:
+        if not self.running:
+            await self._flush([op])
+            return
+        await self._queue.put(op)
+
+    async def _run(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self._queue.get()]
+            deadline = loop.time() + self.flush_interval
+            while len(batch) < self.batch_size:
+                timeout = deadline - loop.time()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(await asyncio.wait_for(self._queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            try:
+                await self._flush(batch)
+            finally:
+                for _ in batch:
+                    self._queue.task_done()
+
+    async def _flush(self, batch: List[Tuple[str, Base, Any, dict]]) -> None:
+        # Группируем операции по виду, таблице и ключу, сохраняя порядок операций внутри группы
+        groups: Dict[Tuple[str, Any, Any], List[dict]] = {}
+        for kind, table_class, key, row in batch:
+            groups.setdefault((kind, table_class, key), []).append(row)
+
+        try:
+            await self._write(groups)
+            self.flushed += len(batch)
+            return
+        except Exception as e:
+            self._report(f"Ошибка записи пакета фонового писателя, запись по группам: {_describe(e)}")
+
+        # Одна ошибочная строка не должна отменять запись остальных: транзакция пакета
+        # откатилась, поэтому группы (а внутри упавшей группы - строки) пишутся заново по отдельности
+        for group, rows in groups.items():
+            try:
+                await self._write({group: rows})
+                self.flushed += len(rows)
+                continue
+            except Exception:
+                pass
+            for row in rows:
+                try:
+                    await self._write({group: [row]})
+                    self.flushed += 1
+                except Exception as e:
+                    self.failed += 1
+                    kind, table_class, key = group
+                    if table_class is not JsonData:
+                        self._report(
+                            f"Строка фонового писателя потеряна: {kind} в {table_class.__tablename__}, "
+                            f"ключ {_row_key(kind, key, row)}: {_describe(e)}"
+                        )
+
+    def _report(self, message: str) -> None:
+        # logs_bot пишет через этот же писатель: отдельная задача, чтобы задача записи
+        # не ждала места в собственной очереди
+        from app.core.logging import logs_bot
+
+        task = asyncio.create_task(logs_bot("error", message))
+        self._reports.add(task)
+        task.add_done_callback(self._reports.discard)
+
+    @staticmethod
+    async def _write(groups: Dict[Tuple[str, Any, Any], List[dict]]) -> None:
+        """Записывает группы операций в одной транзакции."""
+        async with AsyncSessionLocal() as session:
+            for (kind, table_class, key), rows in groups.items():
+                if kind == "insert":
+                    await add_many(table_class, rows, session=session, returning=False)
+                elif kind == "upsert":
+                    conflict_key, owner_key = key
+                    await upsert_many(table_class, rows, (conflict_key,), session=session, owner_key=owner_key)
+                elif kind == "append_context":
+                    await append_context_many(rows, session=session)
+                else:
+                    await increment_many(table_class, rows, key, session=session)
+            await session.commit()
+
+
+def _row_key(kind: str, key: Any, row: dict) -> Any:
+    """Ключ строки для сообщения об ошибке (значения столбцов в лог не попадают)."""
+    if kind == "upsert":
+        return row.get(key[0])
+    if kind in ("increment", "append_context") and key:
+        names = (key,) if isinstance(key, str) else key
+        return {name: row.get(name) for name in names}
+    return row.get("id")
+
+def _describe(error: Exception) -> str:
+    # Текст ошибки SQLAlchemy содержит параметры запроса (ответы, контекст), поэтому
+    # берется сообщение драйвера базы данных
+    return f"{type(error).__name__}: {getattr(error, 'orig', None) or error}"
+
+
+# Общий писатель для логов и истории чатов, запускается при старте приложения
+writer = BackgroundWriter()
@@ -1,5 +1,21 @@
-from pydantic import BaseModel
+from pydantic import BaseModel, Field, field_validator
 from typing import List, Optional, Union
+from app.core.config import CHAT_BATCH_MAX_ITEMS
+import uuid
+
+
+def validate_chat_id(value: str) -> str:
+    """
+    Проверяет, что идентификатор чата - UUID (столбец chat_history.chat_id).
+
+    Ответ сохраняется в историю фоновым писателем уже после ответа клиенту, поэтому
+    неверный идентификатор отклоняется при разборе запроса (422), а не при записи.
+    """
+    try:
+        uuid.UUID(value)
+    except ValueError:
+        raise ValueError("chat_id must be a UUID")
+    return value
 
 
 class ChatCreate(BaseModel):
@@ -22,12 +38,15 @@ class Message(BaseModel):
     content: str  
 
 class ChatCompletion(BaseModel):
-    """Класс для завершения чата. Включает в себя идентификатор чата, модель, сообщения (опционально), URL изображения (опционально) и URL аудиофайла (опционально)."""
+    """Класс для завершения чата. Включает в себя идентификатор чата, модель, сообщения (опционально), URL изображения (опционально), URL аудиофайла (опционально) и флаг потоковой отдачи ответа (SSE)."""
     chat_id: str  
     model: str  
     messages: Optional[List[dict]] = None  
     image_url: Optional[str] = None  
     audio_file: Optional[str] = None  
+    stream: Optional[bool] = False  
+
+    _check_chat_id = field_validator("chat_id")(validate_chat_id)
 
 class ChatRequest(BaseModel):
     """Класс для запроса в чате. Включает в себя идентификатор чата, модель и сообщения."""
@@ -36,16 +55,31 @@ class ChatRequest(BaseModel):
     messages: List[Message]  
 
 class ChatResponse(BaseModel):
-    """Класс для ответа из чата. Включает в себя идентификатор, модель, время создания, ответ и количество использованных токенов."""
+    """Класс для ответа из чата. Включает в себя идентификатор, модель, время создания, ответ и количество использованных токенов (всего, промпта и ответа)."""
     id: str  
     model: str  
     created: int  
     response: str  
     tokens_used: int  
+    prompt_tokens: int = 0  
+    completion_tokens: int = 0  
     
     class Config:
         from_attributes = True
 
+class ChatBatchRequest(BaseModel):
+    """Класс для пакетного запроса chat completions. Включает в себя запросы и необязательный лимит одновременных запросов."""
+    items: List[ChatRequest] = Field(..., min_length=1, max_length=CHAT_BATCH_MAX_ITEMS)
+    concurrency: Optional[int] = Field(None, ge=1)
+
+    @field_validator("items")
+    @classmethod
+    def _check_chat_ids(cls, items: List[ChatRequest]) -> List[ChatRequest]:
+        # История пакета пишется одним INSERT: неверный chat_id отклоняется до запросов к OpenAI
+        for item in items:
+            validate_chat_id(item.chat_id)
+        return items
+
 class ChatWithContextRequest(ChatRequest):
     """Класс для запроса в чате с контекстом. Включает в себя идентификатор чата, модель, сообщения и идентификатор сессии."""
     session_id: str  
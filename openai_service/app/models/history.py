@@ -11,8 +11,26 @@ class HistoryResponse(BaseModel):
     created_at: datetime
     session_id: Optional[str] = None
 
+class HistoryPage(BaseModel):
+    items: List[HistoryResponse]
+    next_cursor: Optional[str] = None
+    prev_cursor: Optional[str] = None
+    total: Optional[int] = None
+    total_is_estimate: bool = False
+
+class StatisticsBucket(BaseModel):
+    bucket: datetime
+    requests: int
+    total_tokens: int
+    average_response_time: float
+
 class StatisticsResponse(BaseModel):
     total_requests: int
     requests_by_model: dict
     total_tokens: int
-    average_response_time: float 
\ No newline at end of file
+    average_response_time: float
+    requests_by_api_key: dict = {}
+    prompt_tokens: int = 0
+    completion_tokens: int = 0
+    response_time_percentiles: dict = {}
+    series: Optional[List[StatisticsBucket]] = None
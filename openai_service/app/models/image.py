@@ -1,5 +1,6 @@
-from pydantic import BaseModel
-from typing import Optional
+from pydantic import BaseModel, Field
+from typing import List, Optional
+from app.core.config import IMAGE_BATCH_MAX_ITEMS
 
 class ImageGeneration(BaseModel):
     """Класс для генерации изображений, включает идентификатор чата, текст запроса, размер, качество и количество изображений."""
@@ -7,4 +8,17 @@ class ImageGeneration(BaseModel):
     prompt: str
     size: Optional[str] = "1024x1024"
     quality: Optional[str] = "standard"
-    n: Optional[int] = 1 
\ No newline at end of file
+    n: Optional[int] = 1
+
+class ImageBatchItem(BaseModel):
+    """Класс для элемента пакетной генерации: описание, размер, качество, количество изображений и необязательный идентификатор клиента."""
+    id: Optional[str] = None
+    prompt: str
+    size: Optional[str] = "1024x1024"
+    quality: Optional[str] = "standard"
+    n: int = Field(1, ge=1, le=10)
+
+class ImageBatchRequest(BaseModel):
+    """Класс для запроса пакетной генерации изображений: элементы и необязательный лимит одновременных запросов."""
+    items: List[ImageBatchItem] = Field(..., min_length=1, max_length=IMAGE_BATCH_MAX_ITEMS)
+    concurrency: Optional[int] = Field(None, ge=1)
@@ -0,0 +1,21 @@
+from pydantic import BaseModel
+from typing import Optional
+from datetime import datetime
+
+class JobAccepted(BaseModel):
+    """Класс для ответа на постановку фоновой задачи: идентификатор, статус и адрес для опроса."""
+    job_id: str
+    status: str
+    status_url: str
+
+class JobInfo(BaseModel):
+    """Класс для состояния фоновой задачи: тип, статус, время создания, начала, завершения и удаления, результат или ошибка."""
+    job_id: str
+    kind: str
+    status: str
+    created_at: datetime
+    started_at: Optional[datetime] = None
+    finished_at: Optional[datetime] = None
+    expires_at: Optional[datetime] = None
+    result: Optional[dict] = None
+    error: Optional[dict] = None
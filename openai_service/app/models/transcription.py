@@ -1,8 +1,21 @@
 from pydantic import BaseModel
-from typing import Optional
+from typing import List, Optional
 
 class TranscriptionOptions(BaseModel):
     """Класс для опций транскрипции, включает идентификатор чата, язык и формат ответа."""
     chat_id: str
     language: Optional[str] = None
-    response_format: Optional[str] = "text" 
\ No newline at end of file
+    response_format: Optional[str] = "text"
+
+class TranscriptionSegment(BaseModel):
+    """Класс для сегмента транскрипции: номер, границы в записи (секунды) и текст без повтора перекрытия."""
+    index: int
+    start: float
+    end: Optional[float] = None
+    text: str
+
+class TranscriptionResult(BaseModel):
+    """Класс для результата транскрипции загруженного файла: полный текст, длительность и сегменты."""
+    text: str
+    duration: Optional[float] = None
+    segments: List[TranscriptionSegment]
@@ -0,0 +1,275 @@
+from typing import List, Optional, Sequence
+from fastapi import UploadFile
+from app.core.config import (
+    AUDIO_TMP_DIR,
+    AUDIO_MAX_UPLOAD_BYTES,
+    AUDIO_SPOOL_CHUNK_SIZE,
+    FFMPEG_BINARY,
+    FFPROBE_BINARY,
+)
+import asyncio
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+
+# Сколько слов на стыке сегментов сравнивается при склейке (перекрытие в пару секунд - это единицы слов)
+STITCH_MAX_OVERLAP_WORDS = 40
+
+_NORMALIZE_RE = re.compile(r"[^\w]+", re.UNICODE)
+
+
+class UploadTooLarge(ValueError):
+    """Загружаемый файл больше AUDIO_MAX_UPLOAD_BYTES."""
+
+
+class AudioSegment:
+    """
+    Фрагмент записи для отдельного запроса к Whisper.
+
+    Атрибуты:
+        index: int - Порядковый номер сегмента
+        start: float - Начало в исходной записи (секунды)
+        end: float - Конец в исходной записи (секунды, включая перекрытие со следующим сегментом)
+    """
+    __slots__ = ("index", "start", "end")
+
+    def __init__(self, index: int, start: float, end: float):
+        self.index = index
+        self.start = start
+        self.end = end
+
+    @property
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+async def make_workdir() -> str:
+    """Создает временный каталог для файлов одного запроса (в AUDIO_TMP_DIR, если задан)."""
+    return await asyncio.to_thread(tempfile.mkdtemp, prefix="transcribe-", dir=AUDIO_TMP_DIR)
+
+async def remove_workdir(path: str) -> None:
+    """Удаляет временный каталог запроса вместе с содержимым."""
+    await asyncio.to_thread(shutil.rmtree, path, True)
+
+async def spool_upload(
+    upload: UploadFile,
+    directory: str,
+    max_bytes: int = AUDIO_MAX_UPLOAD_BYTES,
+    chunk_size: int = AUDIO_SPOOL_CHUNK_SIZE,
+    hasher=None
+) -> str:
+    """
+    Сохраняет загруженный файл во временный каталог кусками по chunk_size байт.
+
+    Файл не читается в память целиком, а запись на диск выполняется в пуле потоков,
+    поэтому большие записи не блокируют event loop.
+
+    Аргументы:
+        upload: UploadFile - Загруженный файл
+        directory: str - Каталог для файла (см. make_workdir)
+        max_bytes: int - Максимальный размер файла
+        chunk_size: int - Размер куска чтения
+        hasher: Объект hashlib (например, hashlib.sha256()), обновляемый каждым куском
+            по ходу записи - хэш содержимого получается без повторного чтения файла (опционально)
+
+    Возвращает:
+        str: Путь к сохраненному файлу (расширение сохраняется: по нему Whisper определяет формат)
+
+    Исключения:
+        UploadTooLarge: Файл больше max_bytes
+    """
+    _, extension = os.path.splitext(upload.filename or "")
+    path = os.path.join(directory, f"upload{extension.lower() or '.bin'}")
+    size = 0
+    out = await asyncio.to_thread(open, path, "wb")
+    try:
+        while True:
+            chunk = await upload.read(chunk_size)
+            if not chunk:
+                break
+            size += len(chunk)
+            if size > max_bytes:
+                raise UploadTooLarge(f"Audio file is larger than {max_bytes} bytes")
+            await asyncio.to_thread(_write_chunk, out, chunk, hasher)
+    finally:
+        await asyncio.to_thread(out.close)
+    return path
+
+def _write_chunk(out, chunk: bytes, hasher) -> None:
+    # hashlib отпускает GIL на больших буферах: хэширование идет в том же потоке, что и запись
+    if hasher is not None:
+        hasher.update(chunk)
+    out.write(chunk)
+
+async def file_sha256(path: str, chunk_size: int = AUDIO_SPOOL_CHUNK_SIZE) -> str:
+    """Вычисляет SHA-256 файла (hex) в пуле потоков, читая его кусками."""
+    def _hash() -> str:
+        hasher = hashlib.sha256()
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(chunk_size), b""):
+                hasher.update(chunk)
+        return hasher.hexdigest()
+
+    return await asyncio.to_thread(_hash)
+
+def transcription_cache_key(audio_sha256: str, model: str, language: Optional[str], response_format: str) -> str:
+    """
+    Вычисляет ключ кэша транскрипции.
+
+    Параметры:
+        audio_sha256: str - SHA-256 содержимого аудиофайла (hex)
+        model: str - Модель распознавания
+        language: str - Язык записи (None - автоопределение)
+        response_format: str - Формат ответа Whisper
+
+    Возвращает:
+        str: SHA-256 (hex) от канонического JSON-представления параметров
+    """
+    payload = {"audio": audio_sha256, "model": model, "language": language, "response_format": response_format}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+def speech_cache_key(text: str, voice: str, model: str, response_format: str) -> str:
+    """
+    Вычисляет ключ кэша синтезированной речи.
+
+    Возвращает:
+        str: SHA-256 (hex) от канонического JSON-представления (text, voice, model, response_format)
+    """
+    payload = {"text": text, "voice": voice, "model": model, "response_format": response_format}
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+async def read_file(path: str) -> bytes:
+    """Читает файл целиком в пуле потоков."""
+    def _read() -> bytes:
+        with open(path, "rb") as f:
+            return f.read()
+
+    return await asyncio.to_thread(_read)
+
+def ffmpeg_available() -> bool:
+    """True, если в PATH есть ffmpeg и ffprobe (без них запись отправляется одним запросом)."""
+    return shutil.which(FFMPEG_BINARY) is not None and shutil.which(FFPROBE_BINARY) is not None
+
+async def _run(*args: str) -> bytes:
+    process = await asyncio.create_subprocess_exec(
+        *args,
+        stdin=asyncio.subprocess.DEVNULL,
+        stdout=asyncio.subprocess.PIPE,
+        stderr=asyncio.subprocess.PIPE
+    )
+    try:
+        stdout, stderr = await process.communicate()
+    except asyncio.CancelledError:
+        if process.returncode is None:
+            process.kill()
+            await process.wait()
+        raise
+    if process.returncode != 0:
+        raise RuntimeError(f"{args[0]} failed: {stderr.decode(errors='replace').strip()[-500:]}")
+    return stdout
+
+async def probe_duration(path: str) -> Optional[float]:
+    """
+    Определяет длительность записи через ffprobe.
+
+    Возвращает:
+        float: Длительность в секундах (None, если ffprobe недоступен или не распознал файл)
+    """
+    if not ffmpeg_available():
+        return None
+    try:
+        output = await _run(
+            FFPROBE_BINARY, "-v", "error",
+            "-show_entries", "format=duration",
+            "-of", "default=noprint_wrappers=1:nokey=1",
+            path
+        )
+        return float(output.strip())
+    except (RuntimeError, ValueError):
+        return None
+
+def plan_segments(duration: float, segment_seconds: float, overlap: float) -> List[AudioSegment]:
+    """
+    Делит запись на сегменты длиной segment_seconds, каждый следующий начинается
+    на overlap секунд раньше конца предыдущего.
+
+    Перекрытие нужно, чтобы слово на границе целиком попало хотя бы в один сегмент;
+    повторы на стыке убирает stitch_transcripts.
+
+    Возвращает:
+        List[AudioSegment]: Сегменты по порядку (один, если запись не длиннее сегмента)
+    """
+    overlap = min(max(overlap, 0.0), segment_seconds / 2)
+    if duration <= segment_seconds + overlap:
+        return [AudioSegment(0, 0.0, duration)]
+
+    segments = []
+    start = 0.0
+    while start < duration:
+        end = min(start + segment_seconds + overlap, duration)
+        segments.append(AudioSegment(len(segments), start, end))
+        if end >= duration:
+            break
+        start += segment_seconds
+    return segments
+
+async def cut_segment(path: str, segment: AudioSegment, directory: str) -> str:
+    """
+    Вырезает сегмент записи в отдельный файл (моно, 16 кГц, MP3 64 кбит/с).
+
+    Такой формат достаточен для распознавания речи и держит размер сегмента
+    далеко от лимита Whisper на размер файла (5 минут - около 2.4 МБ).
+
+    Возвращает:
+        str: Путь к файлу сегмента
+    """
+    out = os.path.join(directory, f"segment-{segment.index:05d}.mp3")
+    await _run(
+        FFMPEG_BINARY, "-nostdin", "-v", "error", "-y",
+        "-ss", f"{segment.start:.3f}",
+        "-t", f"{segment.duration:.3f}",
+        "-i", path,
+        "-vn", "-ac", "1", "-ar", "16000",
+        "-c:a", "libmp3lame", "-b:a", "64k",
+        out
+    )
+    return out
+
+def _normalize_word(word: str) -> str:
+    return _NORMALIZE_RE.sub("", word).lower()
+
+def _overlap_length(previous: Sequence[str], current: Sequence[str], max_words: int) -> int:
+    # Самый длинный суффикс previous, совпадающий с префиксом current (без учета регистра и пунктуации)
+    tail = [_normalize_word(word) for word in previous[-max_words:]]
+    head = [_normalize_word(word) for word in current[:max_words]]
+    for length in range(min(len(tail), len(head)), 0, -1):
+        if tail[-length:] == head[:length]:
+            return length
+    return 0
+
+def stitch_segment(previous_text: str, text: str, max_words: int = STITCH_MAX_OVERLAP_WORDS) -> str:
+    """
+    Убирает из начала text слова, повторяющие конец previous_text (перекрытие сегментов).
+
+    Возвращает:
+        str: Новая часть текста, которую нужно дописать к previous_text
+    """
+    words = text.split()
+    skip = _overlap_length(previous_text.split(), words, max_words)
+    return " ".join(words[skip:])
+
+def stitch_transcripts(parts: Sequence[str], max_words: int = STITCH_MAX_OVERLAP_WORDS) -> str:
+    """
+    Склеивает транскрипции перекрывающихся сегментов в один текст без повторов на стыках.
+    """
+    text = ""
+    for part in parts:
+        addition = stitch_segment(text, part, max_words)
+        if addition:
+            text = f"{text} {addition}" if text else addition
+    return text
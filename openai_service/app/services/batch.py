@@ -0,0 +1,73 @@
+from typing import Any, AsyncIterator, Awaitable, Callable, Iterable, Optional, Tuple, TypeVar
+from app.core.errors import UpstreamError
+from app.core.rate_limit import RateLimitExceeded
+import asyncio
+
+T = TypeVar("T")
+
+
+async def bounded_map(
+    items: Iterable[T],
+    handler: Callable[[T], Awaitable[Any]],
+    concurrency: int
+) -> AsyncIterator[Tuple[int, Any, Optional[Exception]]]:
+    """
+    Обрабатывает элементы не более чем concurrency одновременными вызовами handler
+    и отдает результаты в порядке завершения.
+
+    Аргументы:
+        items: Iterable - Элементы (итерируются лениво, по мере освобождения воркеров)
+        handler: Callable - Корутина-обработчик одного элемента
+        concurrency: int - Количество воркеров
+
+    Возвращает:
+        AsyncIterator[Tuple[int, Any, Optional[Exception]]]: (индекс элемента, результат,
+            исключение). Исключение обработчика не прерывает остальные элементы.
+
+    Описание:
+        Если вызывающий код прекращает чтение (например, клиент отключился),
+        выполняющиеся вызовы отменяются, а необработанные элементы пропускаются.
+    """
+    results: asyncio.Queue = asyncio.Queue()
+    pending = iter(enumerate(items))
+    done = object()
+
+    async def _worker() -> None:
+        try:
+            for index, item in pending:
+                try:
+                    await results.put((index, await handler(item), None))
+                except Exception as e:
+                    await results.put((index, None, e))
+        finally:
+            await results.put(done)
+
+    workers = [asyncio.create_task(_worker()) for _ in range(max(concurrency, 1))]
+    try:
+        running = len(workers)
+        while running:
+            result = await results.get()
+            if result is done:
+                running -= 1
+                continue
+            yield result
+    finally:
+        for worker in workers:
+            worker.cancel()
+        await asyncio.gather(*workers, return_exceptions=True)
+
+def error_fields(error: Exception) -> dict:
+    """
+    Описание ошибки элемента пакета для ответа клиенту.
+
+    Возвращает:
+        dict: error (класс исключения), detail, status_code и retry_after (для UpstreamError и RateLimitExceeded)
+    """
+    if isinstance(error, (UpstreamError, RateLimitExceeded)):
+        return {
+            "error": type(error).__name__,
+            "detail": str(error),
+            "status_code": error.status_code,
+            "retry_after": error.retry_after,
+        }
+    return {"error": type(error).__name__, "detail": str(error), "status_code": 500}
@@ -0,0 +1,224 @@
+from collections import OrderedDict
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, Optional
+from app.core.config import (
+    CHAT_CACHE_ENABLED,
+    CHAT_CACHE_MAX_ENTRIES,
+    CHAT_CACHE_TTL,
+    CHAT_CACHE_PERSISTENT,
+    CHAT_CACHE_PERSISTENT_TTL,
+)
+from app.core.logging import logs_bot
+from app.db.database import get_cached_response, save_cached_response
+import asyncio
+import hashlib
+import json
+import time
+
+
+def _normalize_message(message: Any) -> Any:
+    """Приводит сообщение (pydantic-модель или dict) к обычному dict для сериализации."""
+    if hasattr(message, "model_dump"):
+        return message.model_dump()
+    return message
+
+def request_cache_key(model: str, messages: Iterable[Any]) -> str:
+    """
+    Вычисляет канонический хэш запроса на завершение чата.
+
+    Параметры:
+        model: str - Модель GPT
+        messages: Iterable - Сообщения запроса (Message или dict)
+
+    Возвращает:
+        str: SHA-256 (hex) от канонического JSON-представления (model, messages).
+             Порядок ключей и пробелы не влияют на результат.
+    """
+    payload = {
+        "model": model,
+        "messages": [_normalize_message(message) for message in messages],
+    }
+    canonical = json.dumps(payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode("utf-8")).hexdigest()
+
+
+class TTLCache:
+    """
+    Ограниченный по количеству записей LRU-кэш с временем жизни записей.
+
+    Не потокобезопасен: рассчитан на использование из одного event loop.
+    """
+
+    def __init__(self, max_entries: int, ttl: float):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data: "OrderedDict[Hashable, tuple]" = OrderedDict()
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        item = self._data.get(key)
+        if item is None:
+            return None
+
+        expires_at, value = item
+        if expires_at < time.monotonic():
+            del self._data[key]
+            return None
+
+        self._data.move_to_end(key)
+        return value
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._data[key] = (time.monotonic() + self.ttl, value)
+        self._data.move_to_end(key)
+        while len(self._data) > self.max_entries:
+            self._data.popitem(last=False)
+
+    def pop(self, key: Hashable) -> None:
+        self._data.pop(key, None)
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+
+class ResponseCache:
+    """
+    Кэш ответов с объединением одновременных одинаковых запросов (singleflight).
+
+    Уровни:
+        - in-memory LRU с TTL (всегда);
+        - таблица response_cache в базе данных (если persistent=True).
+
+    Одновременные промахи по одному ключу выполняют только один вызов factory,
+    остальные запросы ждут его результата. Сохраняются только ответы, отличные от None
+    (в постоянном слое - в виде JSON); исключение factory получают все ожидающие запросы,
+    и оно не кэшируется.
+    """
+
+    def __init__(self, max_entries: int, ttl: float, persistent: bool = False, persistent_ttl: float = 86400, enabled: bool = True):
+        self.enabled = enabled
+        self.persistent = persistent
+        self.persistent_ttl = persistent_ttl
+        self._memory = TTLCache(max_entries, ttl)
+        self._inflight: Dict[str, asyncio.Future] = {}
+        self.hits = 0
+        self.misses = 0
+        self.coalesced = 0
+        self.bypassed = 0
+
+    async def get_or_create(self, key: str, factory: Callable[[], Awaitable[Optional[Any]]], model: str = None, bypass: bool = False) -> Optional[Any]:
+        """
+        Возвращает ответ из кэша или вычисляет его через factory.
+
+        Параметры:
+            key: str - Хэш запроса (см. request_cache_key)
+            factory: Callable - Корутина-фабрика, выполняющая запрос к upstream
+            model: str - Модель (сохраняется в постоянном слое)
+            bypass: bool - Не читать кэш и не присоединяться к выполняющемуся запросу;
+                           свежий ответ все равно обновляет кэш
+
+        Возвращает:
+            Ответ, сериализуемый в JSON (или None, если factory не вернула ответ)
+        """
+        if not self.enabled:
+            return await factory()
+
+        if bypass:
+            self.bypassed += 1
+            value = await factory()
+            await self._store(key, value, model)
+            return value
+
+        while True:
+            value = self._memory.get(key)
+            if value is not None:
+                self.hits += 1
+                return value
+
+            inflight = self._inflight.get(key)
+            if inflight is None:
+                break
+
+            self.coalesced += 1
+            try:
+                return await asyncio.shield(inflight)
+            except asyncio.CancelledError:
+                # Отменен лидер, а не текущий запрос: пробуем выполнить запрос заново
+                if not inflight.cancelled():
+                    raise
+                self.coalesced -= 1
+
+        future = asyncio.get_running_loop().create_future()
+        self._inflight[key] = future
+        try:
+            value = None
+            if self.persistent:
+                value = await self._load_persistent(key)
+
+            if value is not None:
+                self.hits += 1
+                self._memory.set(key, value)
+            else:
+                self.misses += 1
+                value = await factory()
+                await self._store(key, value, model)
+
+            future.set_result(value)
+            return value
+
+        except asyncio.CancelledError:
+            future.cancel()
+            raise
+
+        except Exception as e:
+            future.set_exception(e)
+            # Помечаем исключение как полученное, даже если ожидающих запросов нет
+            future.exception()
+            raise
+
+        finally:
+            if self._inflight.get(key) is future:
+                del self._inflight[key]
+
+    async def _load_persistent(self, key: str) -> Optional[Any]:
+        try:
+            value = await get_cached_response(key)
+            return json.loads(value) if value is not None else None
+        except Exception as e:
+            await logs_bot("warning", f"Response cache read failed: {str(e)}")
+            return None
+
+    async def _store(self, key: str, value: Optional[Any], model: Optional[str]) -> None:
+        if value is None:
+            return
+
+        self._memory.set(key, value)
+        if self.persistent:
+            try:
+                await save_cached_response(key, model, json.dumps(value, ensure_ascii=False), self.persistent_ttl)
+            except Exception as e:
+                await logs_bot("warning", f"Response cache write failed: {str(e)}")
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики кэша.
+
+        Возвращает:
+            dict: hits, misses, coalesced, bypassed, size, inflight
+        """
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "coalesced": self.coalesced,
+            "bypassed": self.bypassed,
+            "size": len(self._memory),
+            "inflight": len(self._inflight),
+        }
+
+
+# Общий кэш ответов chat completions для всех экземпляров OpenAIService
+chat_cache = ResponseCache(
+    max_entries=CHAT_CACHE_MAX_ENTRIES,
+    ttl=CHAT_CACHE_TTL,
+    persistent=CHAT_CACHE_PERSISTENT,
+    persistent_ttl=CHAT_CACHE_PERSISTENT_TTL,
+    enabled=CHAT_CACHE_ENABLED,
+)
@@ -0,0 +1,154 @@
+from collections import OrderedDict
+from typing import Any, Iterable, List, Optional
+from sqlalchemy import select
+from weakref import WeakValueDictionary
+from datetime import datetime
+from app.core.config import SESSION_MEMORY_BUDGET, SESSION_CACHE_TTL, SESSION_CONTEXT_LENGTH
+from app.db.database import AsyncSessionLocal
+from app.db.models import ContextSession
+from app.db.writer import writer
+import asyncio
+import json
+import time
+import uuid
+
+
+class _SessionEntry:
+    __slots__ = ("messages", "context_length", "size", "loaded_at", "updated_at")
+
+    def __init__(self, messages: List[dict], context_length: int, loaded_at: float, updated_at: Optional[datetime] = None):
+        self.messages = messages
+        self.context_length = context_length
+        self.size = len(json.dumps(messages, ensure_ascii=False))
+        self.loaded_at = loaded_at
+        self.updated_at = updated_at
+
+
+class SessionStore:
+    """
+    Хранилище контекста диалогов поверх таблицы context_sessions.
+
+    - Контекст загружается из базы лениво, при первом обращении к сессии.
+    - В памяти держится LRU с бюджетом по объему (приблизительно, по размеру JSON):
+      при превышении вытесняются давно не использованные сессии.
+    - Запись новых сообщений выполняется фоновым писателем (write-behind): в базе
+      сообщения дописываются к сохраненному контексту (append_context_many), а не
+      заменяют его копией процесса, поэтому одновременные реплики одной сессии
+      в разных процессах не теряются.
+    - Записи в памяти старше ttl секунд перечитываются из базы, поэтому разные
+      процессы uvicorn видят изменения друг друга с задержкой не более ttl
+      (плюс интервал сброса фонового писателя).
+    - В контексте хранятся только последние context_length сообщений сессии.
+    """
+
+    def __init__(self, memory_budget: int = SESSION_MEMORY_BUDGET, ttl: float = SESSION_CACHE_TTL, default_context_length: int = SESSION_CONTEXT_LENGTH):
+        self.memory_budget = memory_budget
+        self.ttl = ttl
+        self.default_context_length = default_context_length
+        self._entries: "OrderedDict[uuid.UUID, _SessionEntry]" = OrderedDict()
+        self._locks: "WeakValueDictionary[uuid.UUID, asyncio.Lock]" = WeakValueDictionary()
+        self.memory_used = 0
+
+    async def get(self, session_id: str) -> List[dict]:
+        """
+        Возвращает контекст сессии.
+
+        Параметры:
+            session_id: str - Идентификатор сессии (UUID)
+
+        Возвращает:
+            List[dict]: Сообщения контекста (пустой список для новой сессии)
+        """
+        key = uuid.UUID(str(session_id))
+        async with self._lock(key):
+            entry = await self._load(key)
+            return list(entry.messages)
+
+    async def append(self, session_id: str, messages: Iterable[Any]) -> List[dict]:
+        """
+        Добавляет сообщения в контекст сессии и возвращает обновленный контекст.
+
+        Параметры:
+            session_id: str - Идентификатор сессии (UUID)
+            messages: Iterable - Новые сообщения (Message или dict)
+
+        Возвращает:
+            List[dict]: Контекст после добавления, обрезанный до context_length сообщений
+        """
+        key = uuid.UUID(str(session_id))
+        new_messages = [m.model_dump() if hasattr(m, "model_dump") else dict(m) for m in messages]
+
+        async with self._lock(key):
+            entry = await self._load(key)
+            context = (entry.messages + new_messages)[-entry.context_length:]
+            now = datetime.utcnow()
+            self._put(key, _SessionEntry(context, entry.context_length, entry.loaded_at, now))
+
+            # В базу уходят только новые сообщения: они дописываются к сохраненному контексту,
+            # поэтому реплики, добавленные другими процессами, не теряются
+            await writer.append_context({
+                "session_id": key,
+                "messages": new_messages,
+                "context_length": entry.context_length,
+                "updated_at": now,
+            })
+            return list(context)
+
+    def _lock(self, key: uuid.UUID) -> asyncio.Lock:
+        # Блокировка живет, пока ее кто-то держит или ждет
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = asyncio.Lock()
+            self._locks[key] = lock
+        return lock
+
+    async def _load(self, key: uuid.UUID) -> _SessionEntry:
+        entry = self._entries.get(key)
+        if entry is not None and time.monotonic() - entry.loaded_at < self.ttl:
+            self._entries.move_to_end(key)
+            return entry
+
+        async with AsyncSessionLocal() as session:
+            row: Optional[ContextSession] = await session.scalar(
+                select(ContextSession).where(
+                    ContextSession.session_id == key,
+                    ContextSession.is_active.is_(True)
+                )
+            )
+
+        # Локальные изменения, которые фоновый писатель еще не сохранил, новее строки в базе
+        pending = entry is not None and entry.updated_at is not None and (
+            row is None or row.updated_at is None or row.updated_at < entry.updated_at
+        )
+
+        if pending:
+            context_length, messages, updated_at = entry.context_length, entry.messages, entry.updated_at
+        elif row is not None:
+            context_length = row.context_length or self.default_context_length
+            messages = list(row.context or [])[-context_length:]
+            updated_at = row.updated_at
+        else:
+            context_length, messages, updated_at = self.default_context_length, [], None
+
+        entry = _SessionEntry(messages, context_length, time.monotonic(), updated_at)
+        self._put(key, entry)
+        return entry
+
+    def _put(self, key: uuid.UUID, entry: _SessionEntry) -> None:
+        previous = self._entries.pop(key, None)
+        if previous is not None:
+            self.memory_used -= previous.size
+
+        self._entries[key] = entry
+        self.memory_used += entry.size
+
+        while self.memory_used > self.memory_budget and len(self._entries) > 1:
+            _, evicted = self._entries.popitem(last=False)
+            self.memory_used -= evicted.size
+
+    def stats(self) -> dict:
+        return {"sessions": len(self._entries), "memory_used": self.memory_used, "memory_budget": self.memory_budget}
+
+
+# Общее хранилище контекста для всех экземпляров OpenAIService
+session_store = SessionStore()
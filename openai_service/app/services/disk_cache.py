@@ -0,0 +1,333 @@
+from collections import OrderedDict
+from typing import List, Optional, Tuple
+from app.core.config import (
+    DISK_CACHE_DIR,
+    TRANSCRIPTION_CACHE_ENABLED,
+    TRANSCRIPTION_CACHE_MAX_BYTES,
+    SPEECH_CACHE_ENABLED,
+    SPEECH_CACHE_MAX_BYTES,
+)
+from app.core.metrics import DISK_CACHE_BYTES, DISK_CACHE_EVICTIONS, DISK_CACHE_REQUESTS
+import asyncio
+import os
+import time
+import uuid
+
+_TMP_SUFFIX = ".tmp"
+# Временные файлы старше этого возраста (секунды) считаются брошенными и удаляются при сканировании
+_STALE_TMP_AGE = 3600
+
+
+class DiskCache:
+    """
+    Кэш значений в файлах с ограничением общего объема и вытеснением LRU.
+
+    Ключ - hex-строка (обычно SHA-256), значение - файл directory/<первые 2 символа>/<ключ><suffix>.
+    Запись атомарна: данные пишутся во временный файл и переименовываются, поэтому
+    читатель никогда не видит файл наполовину.
+
+    Порядок LRU держится в памяти процесса, а на диске отражается временем изменения
+    файла (обновляется при чтении): при старте индекс восстанавливается сканированием
+    каталога. Несколько процессов могут делить один каталог: запись, которой нет
+    в индексе процесса, ищется на диске, а исчезнувший файл считается промахом.
+
+    Весь файловый ввод-вывод выполняется в пуле потоков.
+    """
+
+    def __init__(self, name: str, directory: str, max_bytes: int, enabled: bool = True, suffix: str = ""):
+        self.name = name
+        self.directory = directory
+        self.max_bytes = max_bytes
+        self.enabled = enabled
+        self.suffix = suffix
+        self._index: "OrderedDict[str, int]" = OrderedDict()  # ключ -> размер, от давно не читанных к свежим
+        self._size = 0
+        self._loaded = False
+        self._load_lock: Optional[asyncio.Lock] = None
+        self.hits = 0
+        self.misses = 0
+        self.bypassed = 0
+        self.evictions = 0
+
+    def path(self, key: str) -> str:
+        """Путь к файлу записи (файла может не быть)."""
+        return os.path.join(self.directory, key[:2], f"{key}{self.suffix}")
+
+    async def get(self, key: str) -> Optional[bytes]:
+        """
+        Возвращает значение по ключу.
+
+        Возвращает:
+            bytes: Содержимое записи (None - промах или кэш выключен)
+        """
+        if not self.enabled:
+            return None
+        path = await self._lookup(key)
+        data = None
+        if path is not None:
+            try:
+                data = await asyncio.to_thread(_read_file, path)
+            except FileNotFoundError:
+                # Запись вытеснена другим процессом между проверкой и чтением
+                self._forget(key)
+        self._count("hit" if data is not None else "miss")
+        return data
+
+    async def lookup(self, key: str) -> Optional[str]:
+        """
+        Ищет запись и отмечает ее как недавно использованную.
+
+        Возвращает:
+            str: Путь к файлу записи (None - промах или кэш выключен)
+        """
+        if not self.enabled:
+            return None
+        path = await self._lookup(key)
+        self._count("hit" if path is not None else "miss")
+        return path
+
+    async def _lookup(self, key: str) -> Optional[str]:
+        await self._ensure_loaded()
+        path = self.path(key)
+        if key not in self._index:
+            size = await asyncio.to_thread(_file_size, path)
+            if size is None:
+                return None
+            self._add(key, size)
+
+        self._index.move_to_end(key)
+        try:
+            await asyncio.to_thread(os.utime, path)
+        except FileNotFoundError:
+            self._forget(key)
+            return None
+        return path
+
+    async def put(self, key: str, data: bytes) -> None:
+        """
+        Сохраняет значение и вытесняет старые записи, если объем превышен.
+
+        Значения больше всего лимита не сохраняются.
+        """
+        if not self.enabled or len(data) > self.max_bytes:
+            return
+        await self._ensure_loaded()
+
+        path = self.path(key)
+        await asyncio.to_thread(_write_atomic, path, data)
+        await self._publish(key, len(data))
+
+    def writer(self, key: str) -> "DiskCacheWriter":
+        """
+        Начинает потоковую запись значения (например, при ретрансляции ответа upstream).
+
+        Возвращает:
+            DiskCacheWriter: write() по мере получения кусков, затем commit() или abort()
+        """
+        return DiskCacheWriter(self, key)
+
+    async def _publish(self, key: str, size: int) -> None:
+        await self._ensure_loaded()
+        self._add(key, size)
+        await self._evict()
+
+    def bypass(self) -> None:
+        """Учитывает запрос, который не читал кэш (например, с X-Cache-Bypass)."""
+        self._count("bypass")
+
+    def _count(self, result: str) -> None:
+        if result == "hit":
+            self.hits += 1
+        elif result == "miss":
+            self.misses += 1
+        else:
+            self.bypassed += 1
+        DISK_CACHE_REQUESTS.labels(self.name, result).inc()
+
+    def _add(self, key: str, size: int) -> None:
+        self._size += size - self._index.get(key, 0)
+        self._index[key] = size
+        self._index.move_to_end(key)
+        DISK_CACHE_BYTES.labels(self.name).set(self._size)
+
+    def _forget(self, key: str) -> None:
+        self._size -= self._index.pop(key, 0)
+        DISK_CACHE_BYTES.labels(self.name).set(self._size)
+
+    async def _evict(self) -> None:
+        victims = []
+        while self._size > self.max_bytes and len(self._index) > 1:
+            key, size = self._index.popitem(last=False)
+            self._size -= size
+            victims.append(self.path(key))
+        if not victims:
+            return
+        self.evictions += len(victims)
+        DISK_CACHE_EVICTIONS.labels(self.name).inc(len(victims))
+        DISK_CACHE_BYTES.labels(self.name).set(self._size)
+        await asyncio.to_thread(_remove_files, victims)
+
+    async def _ensure_loaded(self) -> None:
+        if self._loaded:
+            return
+        if self._load_lock is None:
+            self._load_lock = asyncio.Lock()
+        async with self._load_lock:
+            if self._loaded:
+                return
+            for key, size in await asyncio.to_thread(_scan, self.directory, self.suffix):
+                self._add(key, size)
+            self._loaded = True
+            await self._evict()
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики кэша.
+
+        Возвращает:
+            dict: enabled, hits, misses, bypassed, evictions, entries, bytes, max_bytes
+        """
+        return {
+            "enabled": self.enabled,
+            "hits": self.hits,
+            "misses": self.misses,
+            "bypassed": self.bypassed,
+            "evictions": self.evictions,
+            "entries": len(self._index),
+            "bytes": self._size,
+            "max_bytes": self.max_bytes,
+        }
+
+
+class DiskCacheWriter:
+    """
+    Потоковая запись значения в DiskCache.
+
+    Куски пишутся во временный файл по мере поступления (в пуле потоков), commit()
+    атомарно публикует запись, abort() удаляет временный файл. Если значение превысило
+    лимит кэша или кэш выключен, куски просто пропускаются.
+    """
+
+    def __init__(self, cache: DiskCache, key: str):
+        self.cache = cache
+        self.key = key
+        self.size = 0
+        self._file = None
+        self._tmp: Optional[str] = None
+        self._closed = not cache.enabled
+
+    async def write(self, chunk: bytes) -> None:
+        if self._closed:
+            return
+        self.size += len(chunk)
+        if self.size > self.cache.max_bytes:
+            await self.abort()
+            return
+        if self._file is None:
+            self._tmp = _tmp_path(self.cache.path(self.key))
+            self._file = await asyncio.to_thread(_open_tmp, self._tmp)
+        await asyncio.to_thread(self._file.write, chunk)
+
+    async def commit(self) -> None:
+        """Публикует записанное значение (пустое значение не сохраняется)."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is None:
+            return
+        await asyncio.to_thread(_finish_tmp, self._file, self._tmp, self.cache.path(self.key))
+        await self.cache._publish(self.key, self.size)
+
+    async def abort(self) -> None:
+        """Отменяет запись (например, поток upstream оборвался)."""
+        if self._closed:
+            return
+        self._closed = True
+        if self._file is not None:
+            await asyncio.to_thread(_discard_tmp, self._file, self._tmp)
+
+
+def _read_file(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def _file_size(path: str) -> Optional[int]:
+    try:
+        return os.path.getsize(path)
+    except OSError:
+        return None
+
+def _tmp_path(path: str) -> str:
+    return f"{path}.{uuid.uuid4().hex}{_TMP_SUFFIX}"
+
+def _open_tmp(tmp: str):
+    os.makedirs(os.path.dirname(tmp), exist_ok=True)
+    return open(tmp, "wb")
+
+def _finish_tmp(f, tmp: str, path: str) -> None:
+    try:
+        f.close()
+        os.replace(tmp, path)
+    except BaseException:
+        _remove_files([tmp])
+        raise
+
+def _discard_tmp(f, tmp: str) -> None:
+    f.close()
+    _remove_files([tmp])
+
+def _write_atomic(path: str, data: bytes) -> None:
+    tmp = _tmp_path(path)
+    f = _open_tmp(tmp)
+    try:
+        f.write(data)
+    except BaseException:
+        _discard_tmp(f, tmp)
+        raise
+    _finish_tmp(f, tmp, path)
+
+def _remove_files(paths: List[str]) -> None:
+    for path in paths:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+def _scan(directory: str, suffix: str) -> List[Tuple[str, int]]:
+    # Записи каталога от давно не читанных к свежим; брошенные временные файлы удаляются
+    os.makedirs(directory, exist_ok=True)
+    stale_before = time.time() - _STALE_TMP_AGE
+    entries = []
+    for shard in os.scandir(directory):
+        if not shard.is_dir():
+            continue
+        for entry in os.scandir(shard.path):
+            if entry.name.endswith(_TMP_SUFFIX):
+                if entry.stat().st_mtime < stale_before:
+                    _remove_files([entry.path])
+                continue
+            if not entry.is_file() or not entry.name.endswith(suffix):
+                continue
+            stat = entry.stat()
+            key = entry.name[:len(entry.name) - len(suffix)] if suffix else entry.name
+            entries.append((stat.st_mtime, key, stat.st_size))
+    entries.sort()
+    return [(key, size) for _, key, size in entries]
+
+
+# Кэш транскрипций Whisper по содержимому аудио (см. OpenAIService.stream_transcription)
+transcription_cache = DiskCache(
+    "transcriptions",
+    os.path.join(DISK_CACHE_DIR, "transcriptions"),
+    max_bytes=TRANSCRIPTION_CACHE_MAX_BYTES,
+    enabled=TRANSCRIPTION_CACHE_ENABLED,
+    suffix=".json",
+)
+
+# Кэш синтезированной речи по (текст, голос, модель, формат), см. /api/v1/speech/create
+speech_cache = DiskCache(
+    "speech",
+    os.path.join(DISK_CACHE_DIR, "speech"),
+    max_bytes=SPEECH_CACHE_MAX_BYTES,
+    enabled=SPEECH_CACHE_ENABLED,
+)
@@ -0,0 +1,349 @@
+from datetime import datetime, timedelta
+from typing import Awaitable, Callable, Dict, List, Optional, Tuple
+from apscheduler.schedulers.asyncio import AsyncIOScheduler
+from app.core.config import (
+    JOBS_WORKERS,
+    JOBS_QUEUE_SIZE,
+    JOBS_RESULT_TTL,
+    JOBS_CLEANUP_INTERVAL,
+    JOBS_MAX_RUNTIME,
+    JOBS_POLL_INTERVAL,
+)
+from app.core.logging import logs_bot
+from app.core.metrics import JOBS, JOBS_QUEUE_DEPTH, JOBS_RUNNING
+from app.db.database import create_job, delete_expired_jobs, fail_stale_jobs, get_job, get_job_statuses, update_job
+from app.db.models import Job
+from app.services.batch import error_fields
+import asyncio
+import time
+import uuid
+
+JOB_QUEUED = "queued"
+JOB_RUNNING = "running"
+JOB_SUCCEEDED = "succeeded"
+JOB_FAILED = "failed"
+JOB_CANCELLED = "cancelled"
+
+ACTIVE_STATUSES = (JOB_QUEUED, JOB_RUNNING)
+
+# Обработчик задачи: (OpenAIService, параметры задачи) -> результат (JSON)
+JobHandler = Callable[[object, dict], Awaitable[dict]]
+# Освобождение локальных ресурсов задачи (например, временного каталога с загруженным файлом)
+JobCleanup = Callable[[], Awaitable[None]]
+
+
+class JobQueueFull(RuntimeError):
+    """Очередь фоновых задач процесса заполнена."""
+
+
+class _Waiter:
+    __slots__ = ("event", "count")
+
+    def __init__(self):
+        self.event = asyncio.Event()
+        self.count = 0
+
+
+class JobManager:
+    """
+    Фоновые задачи: долгие вызовы OpenAI API (генерация изображений, транскрипция)
+    выполняются вне HTTP-запроса, клиент получает идентификатор задачи и опрашивает ее.
+
+    Состояние задач хранится в базе данных (таблица jobs), поэтому опрос и отмена
+    работают через любой процесс сервиса. Выполнение - в процессе, принявшем задачу:
+    ограниченная очередь и JOBS_WORKERS воркеров asyncio.
+
+    Переходы состояния выполняются условными UPDATE (см. update_job):
+        queued -> running (воркер), queued/running -> cancelled (отмена),
+        running -> succeeded/failed (воркер). Результат задачи, отмененной во время
+        выполнения, не перезаписывает отмену.
+
+    APScheduler раз в JOBS_CLEANUP_INTERVAL секунд:
+        - удаляет задачи с истекшим сроком хранения результата (JOBS_RESULT_TTL);
+        - помечает failed задачи, не завершившиеся за JOBS_MAX_RUNTIME
+          (например, процесс, выполнявший их, был остановлен);
+        - останавливает выполнение задач, отмененных через другой процесс.
+    """
+
+    def __init__(
+        self,
+        workers: int = JOBS_WORKERS,
+        max_queue: int = JOBS_QUEUE_SIZE,
+        result_ttl: float = JOBS_RESULT_TTL,
+        cleanup_interval: float = JOBS_CLEANUP_INTERVAL,
+        max_runtime: float = JOBS_MAX_RUNTIME,
+        poll_interval: float = JOBS_POLL_INTERVAL
+    ):
+        self.workers = max(workers, 1)
+        self.max_queue = max_queue
+        self.result_ttl = result_ttl
+        self.cleanup_interval = cleanup_interval
+        self.max_runtime = max_runtime
+        self.poll_interval = poll_interval
+        self._handlers: Dict[str, JobHandler] = {}
+        self._service = None
+        self._queue: Optional[asyncio.Queue] = None
+        self._worker_tasks: List[asyncio.Task] = []
+        self._running: Dict[uuid.UUID, asyncio.Task] = {}
+        self._waiters: Dict[uuid.UUID, _Waiter] = {}
+        self._scheduler: Optional[AsyncIOScheduler] = None
+
+    def register(self, kind: str, handler: JobHandler) -> None:
+        """Регистрирует обработчик задач типа kind."""
+        self._handlers[kind] = handler
+
+    @property
+    def running(self) -> bool:
+        return bool(self._worker_tasks)
+
+    async def start(self, service) -> None:
+        """
+        Запускает воркеры и периодическую очистку (вызывается при старте приложения).
+
+        Аргументы:
+            service: OpenAIService - Сервис, через который выполняются задачи
+        """
+        if self.running:
+            return
+        self._service = service
+        self._queue = asyncio.Queue(maxsize=self.max_queue)
+        self._worker_tasks = [asyncio.create_task(self._worker()) for _ in range(self.workers)]
+        self._scheduler = AsyncIOScheduler()
+        self._scheduler.add_job(
+            self.cleanup,
+            "interval",
+            seconds=self.cleanup_interval,
+            max_instances=1,
+            coalesce=True,
+            next_run_time=datetime.now()
+        )
+        self._scheduler.start()
+
+    async def stop(self) -> None:
+        """
+        Останавливает воркеры (вызывается при остановке приложения).
+
+        Выполняющиеся и ожидающие в очереди задачи помечаются failed:
+        клиент увидит это при опросе и сможет отправить задачу повторно.
+        """
+        if not self.running:
+            return
+        self._scheduler.shutdown(wait=False)
+        self._scheduler = None
+        for task in self._worker_tasks:
+            task.cancel()
+        await asyncio.gather(*self._worker_tasks, return_exceptions=True)
+        self._worker_tasks = []
+
+        while not self._queue.empty():
+            job_id, kind, _, _, cleanup = self._queue.get_nowait()
+            await self._finish(job_id, kind, JOB_FAILED, error=_interrupted(), statuses=(JOB_QUEUED,))
+            if cleanup is not None:
+                await cleanup()
+        JOBS_QUEUE_DEPTH.set(0)
+
+    async def submit(self, kind: str, params: dict, api_key_id: Optional[str], cleanup: Optional[JobCleanup] = None) -> Job:
+        """
+        Создает задачу и ставит ее в очередь.
+
+        Аргументы:
+            kind: str - Тип задачи (зарегистрированный обработчик)
+            params: dict - Параметры задачи (JSON, передаются обработчику)
+            api_key_id: str - Отпечаток API-ключа владельца (только он видит и отменяет задачу)
+            cleanup: JobCleanup - Освобождение ресурсов задачи после выполнения или отмены (опционально)
+
+        Возвращает:
+            Job: Созданная задача в статусе queued
+
+        Исключения:
+            JobQueueFull: Очередь процесса заполнена (cleanup в этом случае не вызывается)
+        """
+        if kind not in self._handlers:
+            raise ValueError(f"Unknown job kind: {kind}")
+        if not self.running:
+            raise RuntimeError("Job manager is not running")
+        if self._queue.full():
+            raise JobQueueFull(f"Job queue is full ({self.max_queue} jobs)")
+
+        job = await create_job(kind, params, api_key_id)
+        try:
+            self._queue.put_nowait((job.id, kind, params, job.created_at, cleanup))
+        except asyncio.QueueFull:
+            # Очередь заполнилась, пока задача создавалась в базе данных
+            await self._finish(job.id, kind, JOB_FAILED, error={"error": "JobQueueFull", "detail": "Job queue is full", "status_code": 503}, statuses=(JOB_QUEUED,))
+            raise JobQueueFull(f"Job queue is full ({self.max_queue} jobs)") from None
+        JOBS_QUEUE_DEPTH.set(self._queue.qsize())
+        return job
+
+    async def cancel(self, job: Job) -> bool:
+        """
+        Отменяет задачу в статусе queued или running.
+
+        Задача, выполняющаяся в этом процессе, останавливается сразу,
+        в другом процессе - при ближайшей периодической очистке.
+
+        Возвращает:
+            bool: True, если задача отменена (False - она уже завершена)
+        """
+        cancelled = await self._finish(job.id, job.kind, JOB_CANCELLED, statuses=ACTIVE_STATUSES)
+        if cancelled:
+            task = self._running.get(job.id)
+            if task is not None:
+                task.cancel()
+        return cancelled
+
+    async def wait(self, job_id: uuid.UUID, timeout: float) -> Optional[Job]:
+        """
+        Возвращает задачу, дождавшись ее завершения, но не дольше timeout секунд (long-poll).
+
+        Завершение задачи этого процесса будит ожидающих сразу, задачи другого
+        процесса проверяются в базе данных раз в JOBS_POLL_INTERVAL секунд.
+
+        Возвращает:
+            Job: Задача (возможно, еще не завершенная); None, если задачи нет
+        """
+        deadline = time.monotonic() + timeout
+        waiter = self._waiters.get(job_id)
+        if waiter is None:
+            waiter = self._waiters[job_id] = _Waiter()
+        waiter.count += 1
+        try:
+            while True:
+                job = await get_job(job_id)
+                remaining = deadline - time.monotonic()
+                if job is None or job.status not in ACTIVE_STATUSES or remaining <= 0:
+                    return job
+                try:
+                    await asyncio.wait_for(waiter.event.wait(), min(remaining, self.poll_interval))
+                except asyncio.TimeoutError:
+                    pass
+        finally:
+            waiter.count -= 1
+            if not waiter.count and self._waiters.get(job_id) is waiter:
+                del self._waiters[job_id]
+
+    async def cleanup(self) -> None:
+        """Периодическая очистка (см. описание класса); вызывается APScheduler."""
+        now = datetime.utcnow()
+        try:
+            deleted = await delete_expired_jobs(now)
+            stale = await fail_stale_jobs(
+                now - timedelta(seconds=self.max_runtime + self.cleanup_interval),
+                now + timedelta(seconds=self.result_ttl)
+            )
+            if self._running:
+                statuses = await get_job_statuses(list(self._running))
+                for job_id, status in statuses.items():
+                    task = self._running.get(job_id)
+                    if status != JOB_RUNNING and task is not None:
+                        task.cancel()
+            if deleted or stale:
+                await logs_bot("info", f"Фоновые задачи: удалено {deleted} устаревших, {stale} помечено как прерванные")
+        except Exception as e:
+            await logs_bot("error", f"Ошибка очистки фоновых задач: {str(e)}")
+
+    async def _worker(self) -> None:
+        while True:
+            job_id, kind, params, created_at, cleanup = await self._queue.get()
+            JOBS_QUEUE_DEPTH.set(self._queue.qsize())
+            try:
+                await self._execute(job_id, kind, params, created_at)
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                await logs_bot("error", f"Ошибка выполнения фоновой задачи {job_id}: {str(e)}")
+            finally:
+                if cleanup is not None:
+                    await asyncio.shield(cleanup())
+                self._queue.task_done()
+
+    async def _execute(self, job_id: uuid.UUID, kind: str, params: dict, created_at: datetime) -> None:
+        claimed = await update_job(job_id, {"status": JOB_RUNNING, "started_at": datetime.utcnow()}, (JOB_QUEUED,))
+        if not claimed:
+            return  # Отменена, пока ждала в очереди
+
+        timeout = self.max_runtime - (datetime.utcnow() - created_at).total_seconds()
+        task = asyncio.create_task(self._handlers[kind](self._service, params))
+        self._running[job_id] = task
+        JOBS_RUNNING.inc()
+        try:
+            await asyncio.wait({task}, timeout=max(timeout, 0))
+        except asyncio.CancelledError:
+            # Остановка приложения
+            task.cancel()
+            await asyncio.shield(self._finish(job_id, kind, JOB_FAILED, error=_interrupted(), statuses=(JOB_RUNNING,)))
+            raise
+        finally:
+            del self._running[job_id]
+            JOBS_RUNNING.dec()
+
+        if not task.done():
+            task.cancel()
+            error = {"error": "JobTimeout", "detail": f"Job did not finish in {self.max_runtime:.0f} seconds", "status_code": 504}
+            await self._finish(job_id, kind, JOB_FAILED, error=error, statuses=(JOB_RUNNING,))
+        elif task.cancelled():
+            pass  # Отменена клиентом: статус уже записан в cancel()
+        elif task.exception() is not None:
+            await self._finish(job_id, kind, JOB_FAILED, error=error_fields(task.exception()), statuses=(JOB_RUNNING,))
+        else:
+            await self._finish(job_id, kind, JOB_SUCCEEDED, result=task.result(), statuses=(JOB_RUNNING,))
+
+    async def _finish(
+        self,
+        job_id: uuid.UUID,
+        kind: str,
+        status: str,
+        statuses: Tuple[str, ...],
+        result: Optional[dict] = None,
+        error: Optional[dict] = None
+    ) -> bool:
+        now = datetime.utcnow()
+        finished = await update_job(job_id, {
+            "status": status,
+            "result": result,
+            "error": error,
+            "finished_at": now,
+            "expires_at": now + timedelta(seconds=self.result_ttl),
+        }, statuses)
+        if finished:
+            JOBS.labels(kind, status).inc()
+            waiter = self._waiters.get(job_id)
+            if waiter is not None:
+                waiter.event.set()
+        return finished
+
+    def stats(self) -> dict:
+        """
+        Возвращает состояние воркеров процесса.
+
+        Возвращает:
+            dict: workers, queued, running
+        """
+        return {
+            "workers": len(self._worker_tasks),
+            "queued": self._queue.qsize() if self._queue is not None else 0,
+            "running": len(self._running),
+        }
+
+
+def _interrupted() -> dict:
+    return {"error": "JobInterrupted", "detail": "Service stopped while the job was pending", "status_code": 503}
+
+
+async def _generate_image(service, params: dict) -> dict:
+    return {"image_url": await service.generate_image(params["prompt"], params["size"])}
+
+async def _transcribe(service, params: dict) -> dict:
+    result = await service.transcribe_file(
+        params["path"],
+        params.get("language"),
+        params.get("audio_sha256"),
+        params.get("bypass_cache", False)
+    )
+    return result.model_dump()
+
+
+# Общий менеджер фоновых задач процесса (запускается в lifespan приложения)
+job_manager = JobManager()
+job_manager.register("image", _generate_image)
+job_manager.register("transcription", _transcribe)
@@ -1,97 +1,520 @@
 from openai import AsyncOpenAI
+from typing import AsyncIterator, List, Optional, Sequence
+from fastapi import Request
 from app.models.chat import ChatRequest, ChatResponse, ChatWithContextRequest
+from app.models.image import ImageBatchItem
+from app.models.transcription import TranscriptionResult, TranscriptionSegment
+from app.core.config import (
+    OPENAI_MAX_CONNECTIONS,
+    OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+    OPENAI_KEEPALIVE_EXPIRY,
+    OPENAI_HTTP2,
+    OPENAI_CONNECT_TIMEOUT,
+    OPENAI_READ_TIMEOUT,
+    OPENAI_WRITE_TIMEOUT,
+    OPENAI_POOL_TIMEOUT,
+    OPENAI_WARMUP_CONNECTIONS,
+    TRANSCRIPTION_SEGMENT_SECONDS,
+    TRANSCRIPTION_SEGMENT_OVERLAP,
+    TRANSCRIPTION_CONCURRENCY,
+    SPEECH_STREAM_CHUNK_SIZE,
+    IMAGE_MODEL,
+    IMAGE_BATCH_CONCURRENCY,
+    VISION_MODEL,
+    VISION_DETAIL,
+    VISION_MAX_IMAGE_BYTES,
+    RATE_LIMIT_MAX_WAIT,
+)
 from app.core.logging import logs_bot
+from app.core.errors import UpstreamError
+from app.core.metrics import model_label, record_tokens, UPSTREAM_RETRIES as UPSTREAM_RETRIES_TOTAL
+from app.core.rate_limit import rate_limiter
+from app.core.security import Tenant
+from app.services.audio import (
+    cut_segment,
+    file_sha256,
+    make_workdir,
+    plan_segments,
+    probe_duration,
+    read_file,
+    remove_workdir,
+    stitch_segment,
+    transcription_cache_key,
+)
+from app.services.batch import bounded_map, error_fields
+from app.services.cache import chat_cache, request_cache_key
+from app.services.context import session_store
+from app.services.disk_cache import transcription_cache
+from app.services.resilience import resilience
+from app.services.vision import (
+    InvalidImage,
+    PreparedImage,
+    decode_data_url,
+    image_preprocessor,
+    preprocessing_available,
+    vision_answers,
+)
+from app.services.tokens import fit_messages, count_messages_tokens, count_text_tokens
+import asyncio
+import base64
+import importlib.util
+import httpx
+import json
 import os
+import time
+
+
+def create_openai_client() -> AsyncOpenAI:
+    """
+    Создает клиент OpenAI API с настроенным пулом HTTP-соединений.
+
+    Клиент один на приложение (см. lifespan в main.py): все эндпоинты используют
+    общий пул keep-alive соединений, поэтому TCP и TLS-рукопожатия не повторяются
+    на каждый запрос. HTTP/2 включается, только если установлен пакет h2.
+
+    Возвращает:
+        AsyncOpenAI: Клиент; закрывается через await client.close()
+    """
+    http2 = OPENAI_HTTP2 and importlib.util.find_spec("h2") is not None
+    http_client = httpx.AsyncClient(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=OPENAI_MAX_CONNECTIONS,
+            max_keepalive_connections=OPENAI_MAX_KEEPALIVE_CONNECTIONS,
+            keepalive_expiry=OPENAI_KEEPALIVE_EXPIRY
+        ),
+        timeout=httpx.Timeout(
+            connect=OPENAI_CONNECT_TIMEOUT,
+            read=OPENAI_READ_TIMEOUT,
+            write=OPENAI_WRITE_TIMEOUT,
+            pool=OPENAI_POOL_TIMEOUT
+        ),
+        follow_redirects=True
+    )
+    # Повторы выполняет слой устойчивости (app.services.resilience): встроенные
+    # повторы клиента скрывали бы 429 от планировщика и предохранителя
+    return AsyncOpenAI(
+        api_key=os.getenv("PROXY_API_KEY"),
+        base_url=os.getenv("PROXY_API_URL"),
+        max_retries=0,
+        http_client=http_client
+    )
+
 
 class OpenAIService:
-    def __init__(self):
-        self.sessions = {}
-        self.proxy_api_url = os.getenv("PROXY_API_URL")
-        self.proxy_api_key = os.getenv("PROXY_API_KEY")
-        self.client = AsyncOpenAI(
-            api_key=self.proxy_api_key,
-            base_url=self.proxy_api_url
+    def __init__(self, client: Optional[AsyncOpenAI] = None):
+        self.sessions = session_store
+        self.cache = chat_cache
+        self.transcriptions = transcription_cache
+        self.resilience = resilience
+        self.client = client or create_openai_client()
+
+    async def warmup(self, connections: int = OPENAI_WARMUP_CONNECTIONS) -> None:
+        """
+        Заранее открывает соединения с OpenAI API, чтобы первые запросы
+        не ждали TCP и TLS-рукопожатий.
+
+        Ответ не важен (это может быть и 404), ошибки соединения только логгируются:
+        недоступный при старте upstream не должен мешать запуску сервиса.
+
+        Аргументы:
+            connections: int - Сколько соединений открыть одновременно
+        """
+        if connections <= 0:
+            return
+        url = str(self.client.base_url)
+        results = await asyncio.gather(
+            *(self.client._client.head(url) for _ in range(connections)),
+            return_exceptions=True
         )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            await logs_bot("warning", f"OpenAI API warmup failed: {errors[0]!r}")
 
-    async def create_chat_completion(self, request: ChatRequest) -> str:
+    async def close(self) -> None:
+        """Закрывает пул HTTP-соединений клиента."""
+        await self.client.close()
+
+    async def create_chat_completion(self, request: ChatRequest, bypass_cache: bool = False) -> ChatResponse:
         """
         Функция для создания завершения чата, отправляя запрос через ProxyAPI.
         
         Аргументы:
             request: ChatRequest - Объект с данными для завершения чата, 
                       содержащий модель и сообщения.
+            bypass_cache: bool - Не использовать сохраненный ответ (свежий ответ все равно попадет в кэш).
         
         Возвращает:
-            str: Текст ответа от OpenAI API или сообщение об ошибке.
+            ChatResponse: Ответ от OpenAI API с количеством токенов промпта и ответа из usage.
+        
+        Исключения:
+            UpstreamError: Ответ не получен (после повторов), пустой ответ, разомкнутый
+                           предохранитель или запрос не допущен планировщиком.
         
         Описание:
             Эта функция создает завершение чата, отправляя запрос через ProxyAPI. 
             Она принимает запрос от пользователя, содержащий модель и сообщения, 
             отправляет запрос на OpenAI API, ожидает ответ и возвращает текст ответа.
-            
-            Если ответ от OpenAI API пустой, функция возвращает сообщение об ошибке.
-            Если во время выполнения функции возникает исключение, функция логгирует ошибку 
-            и возвращает сообщение об ошибке.
+
+            Перед отправкой история сообщений обрезается под контекстное окно модели
+            (см. app.services.tokens.fit_messages).
+
+            Ответы кэшируются по каноническому хэшу (model, messages), а одновременные
+            одинаковые запросы объединяются в один вызов OpenAI API (см. app.services.cache).
+
+            Вызов выполняется через слой устойчивости (app.services.resilience): повторы
+            с джиттером, предохранитель модели, хеджирование и планировщик с адаптивным
+            лимитом одновременных запросов (app.services.scheduler). Ошибки логгируются
+            и пробрасываются как UpstreamError; они не кэшируются.
         """
         try:
-            # Отправляем запрос на завершение чата
-            response = await self.client.chat.completions.create(
+            messages = fit_messages(request.messages, request.model)
+            key = request_cache_key(request.model, messages)
+            result = await self.cache.get_or_create(
+                key,
+                lambda: self._request_chat_completion(request.model, messages),
                 model=request.model,
-                messages=request.messages
+                bypass=bypass_cache
             )
+
+            # Возвращаем ответ
+            return ChatResponse(**result)
             
-            # Проверяем, получен ли ответ от OpenAI API
-            if not response or not response.choices:
-                await logs_bot("error", "Empty response from OpenAI API")
-                return "No response received"
-                
-            # Возвращаем текст ответа
-            return response.choices[0].message.content
-            
-        except Exception as e:
+        except UpstreamError as e:
             await logs_bot("error", f"Error in create_chat_completion: {str(e)}")
-            return f"Error occurred: {str(e)}"
+            raise
+
+    async def _request_chat_completion(self, model: str, messages: list) -> dict:
+        """
+        Выполняет запрос на завершение чата к OpenAI API без кэширования.
+
+        Возвращает:
+            dict: Поля ChatResponse
+
+        Исключения:
+            UpstreamError: Ошибка вызова или пустой ответ
+        """
+        # Отправляем запрос на завершение чата (с повторами и хеджированием)
+        response = await self.resilience.call(
+            "chat",
+            model,
+            lambda: self.client.chat.completions.create(model=model, messages=messages),
+            hedge=True
+        )
+
+        if not response or not response.choices:
+            raise UpstreamError("chat", model, "Empty response from OpenAI API")
+
+        result = self._chat_response(response, model)
+        record_tokens(model, result.prompt_tokens, result.completion_tokens)
+        return result.model_dump()
+
+    @staticmethod
+    def _chat_response(response, model: str) -> ChatResponse:
+        """Собирает ChatResponse из ответа chat completions, включая usage."""
+        usage = response.usage
+        prompt_tokens = usage.prompt_tokens if usage else 0
+        completion_tokens = usage.completion_tokens if usage else 0
+        return ChatResponse(
+            id=response.id or "",
+            model=response.model or model,
+            created=response.created or int(time.time()),
+            response=response.choices[0].message.content or "",
+            tokens_used=prompt_tokens + completion_tokens,
+            prompt_tokens=prompt_tokens,
+            completion_tokens=completion_tokens
+        )
+
+    async def stream_chat_completion(self, request: ChatRequest, usage: Optional[dict] = None) -> AsyncIterator[str]:
+        """
+        Потоковое создание завершения чата через ProxyAPI.
+
+        Аргументы:
+            request: ChatRequest - Объект с данными для завершения чата,
+                      содержащий модель и сообщения.
+            usage: dict - Если передан, после окончания потока в него записываются
+                   prompt_tokens и completion_tokens (опционально).
+
+        Возвращает:
+            AsyncIterator[str]: Фрагменты (дельты) текста ответа по мере их получения от OpenAI API.
+
+        Исключения:
+            UpstreamError: Поток не удалось начать (после повторов) или он оборвался.
 
-    async def process_image(self, image_url: str) -> str:
+        Описание:
+            В отличие от create_chat_completion, функция не ждет полного ответа:
+            запрос отправляется с stream=True, и каждый непустой фрагмент отдается
+            вызывающему коду сразу после получения. Ошибки логгируются и пробрасываются
+            дальше, чтобы вызывающий код мог прервать поток и не сохранять неполный ответ.
+
+            Повтор возможен только до первого фрагмента: после него клиент уже получил
+            часть ответа, и обрыв потока завершается ошибкой.
+
+            usage запрашивается у OpenAI API через stream_options. Если upstream его
+            не прислал, количество токенов оценивается локально (app.services.tokens).
+        """
+        messages = fit_messages(request.messages, request.model)
+        parts = []
+        reported = None
+        attempt = 0
+        while True:
+            try:
+                async with self.resilience.attempt("chat_stream", request.model):
+                    stream = await self.client.chat.completions.create(
+                        model=request.model,
+                        messages=messages,
+                        stream=True,
+                        stream_options={"include_usage": True}
+                    )
+
+                    async for chunk in stream:
+                        if chunk.usage:
+                            reported = chunk.usage
+                        if not chunk.choices:
+                            continue
+                        delta = chunk.choices[0].delta.content
+                        if delta:
+                            parts.append(delta)
+                            yield delta
+                break
+
+            except Exception as e:
+                delay = None if parts or isinstance(e, UpstreamError) else self.resilience.retry_delay(e, attempt)
+                if delay is None:
+                    await logs_bot("error", f"Error in stream_chat_completion: {str(e)}")
+                    error = self.resilience.translate("chat_stream", request.model, e)
+                    if error is e:
+                        raise
+                    raise error from e
+                UPSTREAM_RETRIES_TOTAL.labels("chat_stream", model_label(request.model), type(e).__name__).inc()
+                attempt += 1
+                await asyncio.sleep(delay)
+
+        if reported:
+            prompt_tokens, completion_tokens = reported.prompt_tokens, reported.completion_tokens
+        else:
+            prompt_tokens = count_messages_tokens(messages, request.model)
+            completion_tokens = count_text_tokens("".join(parts), request.model)
+        record_tokens(request.model, prompt_tokens, completion_tokens)
+
+        if usage is not None:
+            usage["prompt_tokens"] = prompt_tokens
+            usage["completion_tokens"] = completion_tokens
+
+    async def process_image(self, image_url: str, prompt: str = "What's in this image?") -> ChatResponse:
         """
         Обрабатывает изображение с помощью OpenAI API.
         
         Аргументы:
-            image_url: URL изображения для обработки.
+            image_url: URL изображения (http(s) или data: URL с base64) для обработки.
+            prompt: вопрос к изображению (опционально).
         
         Возвращает:
-            str: Ответ от OpenAI API о содержимом изображения или сообщение об ошибке.
+            ChatResponse: Ответ от OpenAI API о содержимом изображения с расходом токенов.
+        
+        Исключения:
+            UpstreamError: Ответ не получен или пустой.
+            InvalidImage: Изображение в data: URL не удалось декодировать.
         
         Описание:
             Эта функция отправляет запрос на OpenAI API для анализа изображения по указанному URL.
             Она ожидает ответ и возвращает текстовое описание содержимого изображения.
-            Если ответ пустой или возникает ошибка, функция логгирует ошибку и возвращает сообщение об ошибке.
+            Если ответ пустой или возникает ошибка, функция логгирует ошибку и пробрасывает UpstreamError.
+
+            Изображение из data: URL (если установлен Pillow) уменьшается под модель
+            и пережимается в пуле процессов (app.services.vision) и передается в OpenAI
+            как base64, ответ на него кэшируется. http(s) URL передается в OpenAI как есть:
+            сервис не скачивает адреса, присланные клиентом, иначе через него можно было бы
+            обращаться к внутренним адресам сети (SSRF).
+        """
+        image = None
+        if preprocessing_available():
+            data = decode_data_url(image_url)
+            if data is not None:
+                image = await image_preprocessor.prepare(data)
+        return await self._describe_image(image.data_url() if image else image_url, prompt, image)
+
+    async def process_image_data(self, data: bytes, prompt: str = "What's in this image?") -> ChatResponse:
+        """
+        Обрабатывает загруженное изображение (байты файла) с помощью OpenAI API.
+
+        Исключения:
+            UpstreamError: Ответ не получен или пустой.
+            InvalidImage: Файл не является изображением или слишком большой.
+
+        Описание:
+            См. process_image. Без Pillow файл передается как есть (data: URL).
         """
+        if preprocessing_available():
+            image = await image_preprocessor.prepare(data)
+            return await self._describe_image(image.data_url(), prompt, image)
+        if len(data) > VISION_MAX_IMAGE_BYTES:
+            raise InvalidImage(f"Image is larger than {VISION_MAX_IMAGE_BYTES} bytes")
+        data_url = "data:image/jpeg;base64," + base64.b64encode(data).decode("ascii")
+        return await self._describe_image(data_url, prompt, None)
+
+    async def _describe_image(self, image_url: str, prompt: str, image: Optional[PreparedImage]) -> ChatResponse:
+        """Запрос к vision-модели; ответ кэшируется по SHA-256 исходного файла изображения."""
+        answer_key = (image.sha256, VISION_MODEL, prompt, VISION_DETAIL) if image else None
+        if answer_key is not None:
+            cached = vision_answers.get(answer_key)
+            if cached is not None:
+                return ChatResponse(**cached)
+
         try:
-            response = await self.client.chat.completions.create(
-                model="gpt-4-vision-preview",
-                messages=[
-                    {
-                        "role": "user",
-                        "content": [
-                            {"type": "text", "text": "What's in this image?"},
-                            {"type": "image_url", "image_url": image_url}
-                        ]
-                    }
-                ]
+            response = await self.resilience.call(
+                "vision",
+                VISION_MODEL,
+                lambda: self.client.chat.completions.create(
+                    model=VISION_MODEL,
+                    messages=[
+                        {
+                            "role": "user",
+                            "content": [
+                                {"type": "text", "text": prompt},
+                                {"type": "image_url", "image_url": {"url": image_url, "detail": VISION_DETAIL}}
+                            ]
+                        }
+                    ]
+                ),
+                hedge=True
             )
 
             if not response or not response.choices:
-                await logs_bot("error", "Empty response from OpenAI Vision API")
-                return "No response received"
+                raise UpstreamError("vision", VISION_MODEL, "Empty response from OpenAI Vision API")
 
-            return response.choices[0].message.content
+            result = self._chat_response(response, VISION_MODEL)
+            record_tokens(result.model, result.prompt_tokens, result.completion_tokens)
+            if answer_key is not None:
+                vision_answers.set(answer_key, result.model_dump())
+            return result
 
-        except Exception as e:
+        except UpstreamError as e:
             await logs_bot("error", f"Error in process_image: {str(e)}")
-            return f"Error occurred: {str(e)}"
+            raise
+
+    async def _transcribe(self, audio_file: str, language: Optional[str] = None) -> str:
+        """
+        Отправляет аудиофайл в Whisper одним запросом.
+
+        Файл читается в пуле потоков (не блокируя event loop) один раз,
+        повторные попытки отправляют уже прочитанные байты.
+        """
+        data = await read_file(audio_file)
+        options = {"language": language} if language else {}
+
+        async def _request() -> str:
+            return await self.client.audio.transcriptions.create(
+                model="whisper-1",
+                file=(os.path.basename(audio_file), data),
+                response_format="text",
+                **options
+            )
+
+        text = await self.resilience.call("whisper", "whisper-1", _request)
+        return text.strip()
+
+    async def stream_transcription(
+        self,
+        audio_file: str,
+        language: Optional[str] = None,
+        concurrency: int = TRANSCRIPTION_CONCURRENCY,
+        audio_sha256: Optional[str] = None,
+        bypass_cache: bool = False
+    ) -> AsyncIterator[dict]:
+        """
+        Транскрибирует аудиофайл по сегментам, отдавая результаты по порядку.
+
+        Аргументы:
+            audio_file: str - Путь к аудиофайлу
+            language: str - Язык записи в формате ISO-639-1 (опционально)
+            concurrency: int - Сколько сегментов обрабатывать одновременно
+            audio_sha256: str - SHA-256 содержимого файла, если уже известен (например,
+                посчитан при загрузке); иначе файл хэшируется отдельным проходом (опционально)
+            bypass_cache: bool - Не читать кэш транскрипций (свежий результат все равно
+                попадет в кэш)
+
+        Возвращает:
+            AsyncIterator[dict]: Сегменты {"index", "start", "end", "text"} по порядку;
+                text - новая часть транскрипции без повтора перекрытия с предыдущим сегментом,
+                поэтому склейка text через пробел дает полный текст.
+
+        Исключения:
+            UpstreamError: Транскрипция сегмента не получена.
+
+        Описание:
+            Запись длиннее TRANSCRIPTION_SEGMENT_SECONDS делится ffmpeg на сегменты
+            с перекрытием TRANSCRIPTION_SEGMENT_OVERLAP секунд (app.services.audio).
+            Сегменты вырезаются и отправляются в Whisper параллельно, не более concurrency
+            одновременно (общий лимит вызовов Whisper задает планировщик), а отдаются
+            в исходном порядке, как только готовы все предыдущие. Часовая запись
+            обрабатывается примерно за время нескольких запросов вместо двенадцати подряд.
+
+            Без ffmpeg/ffprobe или для короткой записи файл отправляется одним запросом.
+
+            Результат кэшируется на диске (app.services.disk_cache) по SHA-256 аудио,
+            модели, языку и формату ответа: повторно присланная запись отдается из кэша
+            без обращения к Whisper. В кэш попадает только полностью полученная транскрипция.
+        """
+        key = None
+        if self.transcriptions.enabled:
+            key = transcription_cache_key(audio_sha256 or await file_sha256(audio_file), "whisper-1", language, "text")
+            if bypass_cache:
+                self.transcriptions.bypass()
+            else:
+                cached = await self.transcriptions.get(key)
+                if cached is not None:
+                    for segment in json.loads(cached)["segments"]:
+                        yield segment
+                    return
+
+        segments = []
+        async for segment in self._transcribe_segments(audio_file, language, concurrency):
+            segments.append(segment)
+            yield segment
+
+        if key is not None:
+            await self.transcriptions.put(key, json.dumps({"segments": segments}, ensure_ascii=False).encode("utf-8"))
+
+    async def _transcribe_segments(self, audio_file: str, language: Optional[str], concurrency: int) -> AsyncIterator[dict]:
+        """Транскрибирует файл по сегментам без кэша (см. stream_transcription)."""
+        try:
+            duration = await probe_duration(audio_file)
+            segments = plan_segments(duration, TRANSCRIPTION_SEGMENT_SECONDS, TRANSCRIPTION_SEGMENT_OVERLAP) if duration else []
+            if len(segments) <= 1:
+                text = await self._transcribe(audio_file, language)
+                yield {"index": 0, "start": 0.0, "end": duration, "text": text}
+                return
+
+            workdir = await make_workdir()
+            semaphore = asyncio.Semaphore(max(concurrency, 1))
+
+            async def _segment(segment) -> str:
+                async with semaphore:
+                    path = await cut_segment(audio_file, segment, workdir)
+                    try:
+                        return await self._transcribe(path, language)
+                    finally:
+                        await asyncio.to_thread(os.remove, path)
+
+            tasks = [asyncio.create_task(_segment(segment)) for segment in segments]
+            try:
+                text = ""
+                for segment, task in zip(segments, tasks):
+                    addition = stitch_segment(text, await task)
+                    text = f"{text} {addition}" if text and addition else text or addition
+                    yield {"index": segment.index, "start": segment.start, "end": segment.end, "text": addition}
+            finally:
+                for task in tasks:
+                    task.cancel()
+                await asyncio.gather(*tasks, return_exceptions=True)
+                await remove_workdir(workdir)
+
+        except UpstreamError as e:
+            await logs_bot("error", f"Error in stream_transcription: {str(e)}")
+            raise
 
-    async def process_audio(self, audio_file: str) -> str:
+    async def process_audio(self, audio_file: str) -> ChatResponse:
         """
         Обрабатывает аудиофайл с помощью OpenAI API.
         
@@ -99,26 +522,19 @@ class OpenAIService:
             audio_file: путь к аудиофайлу для транскрипции.
         
         Возвращает:
-            str: Результат транскрипции аудиофайла или сообщение об ошибке.
+            ChatResponse: Результат транскрипции аудиофайла
+                          (Whisper не сообщает usage, поэтому токены равны 0).
+        
+        Исключения:
+            UpstreamError: Транскрипция не получена.
         
         Описание:
             Эта функция отправляет аудиофайл на OpenAI API для транскрипции.
             Она ожидает текстовый ответ и возвращает его. Если возникает ошибка, 
-            функция логгирует ошибку и возвращает сообщение об ошибке.
+            функция логгирует ошибку и пробрасывает UpstreamError.
         """
-        try:
-            with open(audio_file, "rb") as audio:
-                transcript = await self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio,
-                    response_format="text"
-                )
-
-            return transcript
-
-        except Exception as e:
-            await logs_bot("error", f"Error in process_audio: {str(e)}")
-            return f"Error occurred: {str(e)}"
+        transcript = await self.transcribe_audio(audio_file)
+        return ChatResponse(id="", model="whisper-1", created=int(time.time()), response=transcript, tokens_used=0)
 
     async def chat_with_context(self, request: ChatWithContextRequest) -> ChatResponse:
         """
@@ -134,43 +550,129 @@ class OpenAIService:
             Эта функция сохраняет сообщения чата в сессии, чтобы учитывать контекст 
             при создании ответа. Если сессия не существует, она создается. 
             Затем функция вызывает метод для создания завершения чата с учетом контекста.
-        """
-        if request.session_id not in self.sessions:
-            self.sessions[request.session_id] = []
 
-        self.sessions[request.session_id].extend(request.messages)
-        request.messages = self.sessions[request.session_id]
+            Контекст хранится в SessionStore (app.services.context): в памяти держится
+            ограниченный LRU, а сами сессии сохраняются в таблице context_sessions, поэтому
+            контекст переживает перезапуск и общий для всех процессов uvicorn.
+        """
+        request.messages = await self.sessions.append(request.session_id, request.messages)
 
         return await self.create_chat_completion(request)
 
-    async def transcribe_audio(self, audio_file: str) -> str:
+    async def transcribe_audio(
+        self,
+        audio_file: str,
+        language: Optional[str] = None,
+        audio_sha256: Optional[str] = None,
+        bypass_cache: bool = False
+    ) -> str:
         """
         Транскрибирует аудиофайл в текст с использованием OpenAI API.
         
         Параметры:
             audio_file: путь к аудиофайлу для транскрипции.
+            language: язык записи в формате ISO-639-1 (опционально).
+            audio_sha256: SHA-256 содержимого файла, если уже известен (опционально).
+            bypass_cache: не читать кэш транскрипций (опционально).
         
         Возвращает:
-            str: Результат транскрипции аудиофайла или сообщение об ошибке.
+            str: Результат транскрипции аудиофайла.
+        
+        Исключения:
+            UpstreamError: Транскрипция не получена.
         
         Описание:
             Эта функция отправляет аудиофайл на OpenAI API для транскрипции и 
-            возвращает текстовый результат. Если возникает ошибка, функция логгирует 
-            ошибку и возвращает сообщение об ошибке.
+            возвращает текстовый результат. Длинные записи обрабатываются по сегментам
+            параллельно, повторные записи отдаются из кэша (см. stream_transcription).
+            Ошибки логгируются и пробрасываются как UpstreamError.
         """
-        try:
-            with open(audio_file, "rb") as audio:
-                transcript = await self.client.audio.transcriptions.create(
-                    model="whisper-1",
-                    file=audio,
-                    response_format="text"
-                )
+        result = await self.transcribe_file(audio_file, language, audio_sha256, bypass_cache)
+        return result.text
+
+    async def transcribe_file(
+        self,
+        audio_file: str,
+        language: Optional[str] = None,
+        audio_sha256: Optional[str] = None,
+        bypass_cache: bool = False
+    ) -> TranscriptionResult:
+        """
+        Транскрибирует аудиофайл целиком (см. stream_transcription).
+
+        Возвращает:
+            TranscriptionResult: Полный текст, длительность записи и сегменты.
+
+        Исключения:
+            UpstreamError: Транскрипция не получена.
+        """
+        segments = [
+            TranscriptionSegment(**segment)
+            async for segment in self.stream_transcription(audio_file, language, audio_sha256=audio_sha256, bypass_cache=bypass_cache)
+        ]
+        return TranscriptionResult(
+            text=" ".join(segment.text for segment in segments if segment.text),
+            duration=segments[-1].end if segments else None,
+            segments=segments
+        )
+
+    async def stream_speech(
+        self,
+        text: str,
+        voice: str,
+        model: str,
+        response_format: str,
+        chunk_size: int = SPEECH_STREAM_CHUNK_SIZE
+    ) -> AsyncIterator[bytes]:
+        """
+        Потоковый синтез речи через ProxyAPI.
 
-            return transcript
+        Аргументы:
+            text: str - Текст для озвучивания
+            voice: str - Голос (alloy, echo, fable, onyx, nova, shimmer)
+            model: str - Модель (tts-1, tts-1-hd)
+            response_format: str - Формат аудио (mp3, opus, aac, flac, wav, pcm)
+            chunk_size: int - Размер отдаваемых фрагментов в байтах
+
+        Возвращает:
+            AsyncIterator[bytes]: Фрагменты аудио по мере получения от OpenAI API.
 
-        except Exception as e:
-            await logs_bot("error", f"Error in transcribe_audio: {str(e)}")
-            return f"Error occurred: {str(e)}"
+        Исключения:
+            UpstreamError: Синтез не удалось начать (после повторов) или поток оборвался.
+
+        Описание:
+            Ответ читается через with_streaming_response и не накапливается в памяти:
+            каждый фрагмент отдается вызывающему коду сразу. Как и в stream_chat_completion,
+            повтор возможен только до первого фрагмента.
+        """
+        sent = False
+        attempt = 0
+        while True:
+            try:
+                async with self.resilience.attempt("tts", model):
+                    async with self.client.audio.speech.with_streaming_response.create(
+                        model=model,
+                        voice=voice,
+                        input=text,
+                        response_format=response_format
+                    ) as response:
+                        async for chunk in response.iter_bytes(chunk_size):
+                            if chunk:
+                                sent = True
+                                yield chunk
+                break
+
+            except Exception as e:
+                delay = None if sent or isinstance(e, UpstreamError) else self.resilience.retry_delay(e, attempt)
+                if delay is None:
+                    await logs_bot("error", f"Error in stream_speech: {str(e)}")
+                    error = self.resilience.translate("tts", model, e)
+                    if error is e:
+                        raise
+                    raise error from e
+                UPSTREAM_RETRIES_TOTAL.labels("tts", model_label(model), type(e).__name__).inc()
+                attempt += 1
+                await asyncio.sleep(delay)
 
     async def generate_image(self, prompt: str, size: str) -> str:
         """
@@ -181,26 +683,123 @@ class OpenAIService:
             size: размер изображения.
         
         Возвращает:
-            str: URL сгенерированного изображения или сообщение об ошибке.
+            str: URL сгенерированного изображения.
+        
+        Исключения:
+            UpstreamError: Изображение не получено.
         
         Описание:
             Эта функция отправляет запрос на OpenAI API для генерации изображения 
             на основе заданного описания и размера. Она возвращает URL сгенерированного 
-            изображения или сообщение об ошибке, если что-то пошло не так.
+            изображения (см. generate_images).
+        """
+        urls = await self.generate_images(prompt, size)
+        return urls[0]
+
+    async def generate_images(
+        self,
+        prompt: str,
+        size: str = "1024x1024",
+        quality: str = "standard",
+        n: int = 1,
+        model: str = IMAGE_MODEL
+    ) -> List[str]:
+        """
+        Генерирует n изображений по описанию.
+
+        Параметры:
+            prompt: str - Описание для генерации
+            size: str - Размер изображения
+            quality: str - Качество (standard или hd; hd поддерживает только dall-e-3)
+            n: int - Количество изображений
+            model: str - Модель (по умолчанию IMAGE_MODEL)
+
+        Возвращает:
+            List[str]: URL сгенерированных изображений
+
+        Исключения:
+            UpstreamError: Изображения не получены.
+
+        Описание:
+            dall-e-2 возвращает n изображений одним запросом. dall-e-3 принимает только n=1,
+            поэтому для него выполняются n одновременных запросов.
+
+            Генерация не идемпотентна (каждый вызов оплачивается), поэтому повторяется
+            только после 429, когда запрос не был обработан.
         """
         try:
-            response = await self.client.images.create(
+            if model.startswith("dall-e-3") and n > 1:
+                results = await asyncio.gather(*(self._request_images(prompt, size, quality, 1, model) for _ in range(n)))
+                return [url for urls in results for url in urls]
+            return await self._request_images(prompt, size, quality, n, model)
+
+        except UpstreamError as e:
+            await logs_bot("error", f"Error in generate_images: {str(e)}")
+            raise
+
+    async def _request_images(self, prompt: str, size: str, quality: str, n: int, model: str) -> List[str]:
+        """Один запрос к Images API (images.generate)."""
+        options = {"quality": quality} if quality and quality != "standard" else {}
+        response = await self.resilience.call(
+            "images",
+            model,
+            lambda: self.client.images.generate(
+                model=model,
                 prompt=prompt,
-                n=1,
-                size=size
-            )
+                n=n,
+                size=size,
+                **options
+            ),
+            idempotent=False
+        )
+
+        if not response or not response.data:
+            raise UpstreamError("images", model, "Empty response from OpenAI Image API")
+
+        return [image.url for image in response.data]
+
+    async def generate_image_batch(
+        self,
+        items: Sequence[ImageBatchItem],
+        concurrency: int = IMAGE_BATCH_CONCURRENCY,
+        tenant: Optional[Tenant] = None
+    ) -> AsyncIterator[dict]:
+        """
+        Генерирует изображения для пакета описаний, отдавая результаты по мере готовности.
+
+        Аргументы:
+            items: Sequence[ImageBatchItem] - Элементы пакета
+            concurrency: int - Сколько элементов обрабатывать одновременно
+            tenant: Tenant - Клиент запроса: каждый элемент списывается с его лимита
+                (app.core.rate_limit) с ожиданием до RATE_LIMIT_MAX_WAIT секунд (None - без лимита)
+
+        Возвращает:
+            AsyncIterator[dict]: Результаты в порядке завершения, по одному на элемент:
+                {"index", "id", "status": "ok", "image_urls"} или
+                {"index", "id", "status": "error", "error", "detail", "status_code", "retry_after"}
+
+        Описание:
+            Элементы обрабатываются concurrency воркерами (общий лимит вызовов Images API
+            задает планировщик). Ошибка одного элемента попадает в его результат и не
+            прерывает пакет. Если вызывающий код прекращает чтение (клиент отключился),
+            незавершенные запросы отменяются.
+        """
+        async def _generate(item: ImageBatchItem) -> List[str]:
+            if tenant is not None:
+                await rate_limiter.acquire(tenant, "images_batch", IMAGE_MODEL, max_wait=RATE_LIMIT_MAX_WAIT)
+            return await self.generate_images(item.prompt, item.size, item.quality, item.n)
 
-            if not response or not response.data:
-                await logs_bot("error", "Empty response from OpenAI Image API")
-                return "No response received"
+        async for index, urls, error in bounded_map(items, _generate, min(concurrency, len(items))):
+            result = {"index": index, "id": items[index].id}
+            if error is None:
+                result.update(status="ok", image_urls=urls)
+            else:
+                result.update(status="error", **error_fields(error))
+            yield result
 
-            return response.data[0].url
 
-        except Exception as e:
-            await logs_bot("error", f"Error in generate_image: {str(e)}")
-            return f"Error occurred: {str(e)}"
\ No newline at end of file
+def get_openai_service(request: Request) -> OpenAIService:
+    """
+    Зависимость FastAPI: общий OpenAIService приложения (создается в lifespan, main.py).
+    """
+    return request.app.state.openai_service
@@ -0,0 +1,348 @@
+from collections import deque
+from contextlib import asynccontextmanager
+from typing import Any, AsyncIterator, Awaitable, Callable, Deque, Dict, Optional, Tuple
+from openai import (
+    APIConnectionError,
+    APIStatusError,
+    APITimeoutError,
+    InternalServerError,
+    RateLimitError,
+)
+from app.core.config import (
+    UPSTREAM_RETRIES,
+    UPSTREAM_RETRY_BASE_DELAY,
+    UPSTREAM_RETRY_MAX_DELAY,
+    CIRCUIT_FAILURE_THRESHOLD,
+    CIRCUIT_RESET_TIMEOUT,
+    UPSTREAM_HEDGING,
+    UPSTREAM_HEDGE_QUANTILE,
+    UPSTREAM_HEDGE_MIN_SAMPLES,
+)
+from app.core.errors import (
+    UpstreamError,
+    UpstreamOverloaded,
+    UpstreamRateLimited,
+    UpstreamRejected,
+    UpstreamTimeout,
+    UpstreamUnavailable,
+)
+from app.core.metrics import UPSTREAM_CIRCUIT_STATE, UPSTREAM_HEDGES, UPSTREAM_RETRIES as UPSTREAM_RETRIES_TOTAL, model_label, track_upstream
+from app.services.scheduler import UpstreamScheduler, current_deadline, upstream_scheduler
+import asyncio
+import random
+import time
+
+CLOSED = "closed"
+HALF_OPEN = "half_open"
+OPEN = "open"
+_CIRCUIT_STATES = {CLOSED: 0, HALF_OPEN: 1, OPEN: 2}
+
+
+def _is_outage(error: BaseException) -> bool:
+    """Ошибки, говорящие о недоступности upstream: их считает предохранитель."""
+    return isinstance(error, (APIConnectionError, InternalServerError))
+
+def _retry_after_header(error: BaseException) -> Optional[float]:
+    response = getattr(error, "response", None)
+    value = response.headers.get("retry-after") if response is not None else None
+    try:
+        return float(value) if value is not None else None
+    except ValueError:
+        return None
+
+
+class CircuitBreaker:
+    """
+    Предохранитель модели.
+
+    После failure_threshold подряд ошибок недоступности (соединение, таймаут, 5xx)
+    предохранитель размыкается, и вызовы сразу завершаются UpstreamUnavailable,
+    не занимая очередь и соединения. Через reset_timeout секунд пропускается один
+    пробный запрос: успех замыкает предохранитель, ошибка размыкает снова.
+    """
+
+    def __init__(self, model: str, failure_threshold: int = CIRCUIT_FAILURE_THRESHOLD, reset_timeout: float = CIRCUIT_RESET_TIMEOUT):
+        self.model = model
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.state = CLOSED
+        self.failures = 0
+        self.opened_at = 0.0
+        self._probe = False
+        UPSTREAM_CIRCUIT_STATE.labels(model_label(model)).set(0)
+
+    def _set_state(self, state: str) -> None:
+        self.state = state
+        UPSTREAM_CIRCUIT_STATE.labels(model_label(self.model)).set(_CIRCUIT_STATES[state])
+
+    def before_call(self, operation: str) -> bool:
+        """
+        Проверяет, можно ли отправить запрос.
+
+        Возвращает:
+            bool: True, если запрос пробный (после него нужно вызвать on_success/on_failure/on_abort)
+
+        Исключения:
+            UpstreamUnavailable: Предохранитель разомкнут
+        """
+        if self.state == CLOSED:
+            return False
+
+        remaining = self.opened_at + self.reset_timeout - time.monotonic()
+        if self.state == OPEN and remaining <= 0:
+            self._set_state(HALF_OPEN)
+        if self.state == HALF_OPEN and not self._probe:
+            self._probe = True
+            return True
+
+        raise UpstreamUnavailable(
+            operation,
+            self.model,
+            f"Upstream for {self.model} is unavailable (circuit {self.state})",
+            retry_after=max(remaining, 1.0)
+        )
+
+    def on_success(self) -> None:
+        self.failures = 0
+        self._probe = False
+        if self.state != CLOSED:
+            self._set_state(CLOSED)
+
+    def on_failure(self) -> None:
+        self.failures += 1
+        self._probe = False
+        if self.state == HALF_OPEN or self.failures >= self.failure_threshold:
+            self.opened_at = time.monotonic()
+            self._set_state(OPEN)
+
+    def on_abort(self) -> None:
+        # Пробный запрос отменен, не дав результата: следующий вызов станет пробным
+        self._probe = False
+
+
+class Resilience:
+    """
+    Общий слой устойчивости для вызовов OpenAI API.
+
+    Каждая попытка проходит через предохранитель модели, планировщик
+    (app.services.scheduler) и метрики upstream. Поверх попыток:
+        - повторы с экспоненциальной задержкой и полным джиттером: 429 - всегда
+          (запрос не был обработан), ошибки соединения, таймауты и 5xx - только
+          для идемпотентных операций; Retry-After из ответа 429 учитывается;
+          повтор не выполняется, если не укладывается в срок запроса;
+        - хеджирование (UPSTREAM_HEDGING): если ответ не пришел за p95 задержки
+          и у планировщика есть свободный слот, отправляется второй такой же
+          запрос, используется первый успешный ответ, второй отменяется.
+
+    Ошибки OpenAI API переводятся в типизированные UpstreamError (app.core.errors).
+
+    Предохранители и выборки задержки ведутся по model_label(модель): модели вне
+    KNOWN_MODELS делят предохранитель "other", а не создают новый на каждое имя от клиента.
+    """
+
+    def __init__(
+        self,
+        scheduler: UpstreamScheduler,
+        retries: int = UPSTREAM_RETRIES,
+        base_delay: float = UPSTREAM_RETRY_BASE_DELAY,
+        max_delay: float = UPSTREAM_RETRY_MAX_DELAY,
+        hedging: bool = UPSTREAM_HEDGING,
+        hedge_quantile: float = UPSTREAM_HEDGE_QUANTILE,
+        hedge_min_samples: int = UPSTREAM_HEDGE_MIN_SAMPLES
+    ):
+        self.scheduler = scheduler
+        self.retries = retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.hedging = hedging
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self._breakers: Dict[str, CircuitBreaker] = {}
+        self._latencies: Dict[Tuple[str, str], Deque[float]] = {}
+
+    def breaker(self, model: str) -> CircuitBreaker:
+        model = model_label(model)
+        breaker = self._breakers.get(model)
+        if breaker is None:
+            breaker = self._breakers[model] = CircuitBreaker(model)
+        return breaker
+
+    @asynccontextmanager
+    async def attempt(self, operation: str, model: str) -> AsyncIterator[None]:
+        """
+        Одна попытка вызова: предохранитель, слот планировщика и метрики upstream.
+
+        Исключения OpenAI API пробрасываются без перевода (см. translate), чтобы
+        вызывающий код мог решить, повторять ли попытку.
+        """
+        breaker = self.breaker(model)
+        probe = breaker.before_call(operation)
+        started = time.monotonic()
+        try:
+            async with self.scheduler.slot(operation, model):
+                with track_upstream(operation, model):
+                    yield
+        except UpstreamOverloaded:
+            if probe:
+                breaker.on_abort()
+            raise
+        except Exception as e:
+            if _is_outage(e):
+                breaker.on_failure()
+            else:
+                breaker.on_success()  # upstream ответил, пусть и ошибкой
+            raise
+        except BaseException:
+            if probe:
+                breaker.on_abort()
+            raise
+        else:
+            breaker.on_success()
+            self._latencies.setdefault((operation, model_label(model)), deque(maxlen=256)).append(time.monotonic() - started)
+
+    def translate(self, operation: str, model: str, error: BaseException) -> BaseException:
+        """
+        Переводит исключение OpenAI API в UpstreamError.
+
+        Исключения, не относящиеся к OpenAI API (ошибки в коде сервиса), возвращаются как есть.
+        """
+        if isinstance(error, UpstreamError):
+            return error
+        if isinstance(error, RateLimitError):
+            return UpstreamRateLimited(operation, model, str(error), retry_after=_retry_after_header(error) or 1.0, upstream_status=429)
+        if isinstance(error, APITimeoutError):
+            return UpstreamTimeout(operation, model, f"Upstream {operation} for {model} timed out")
+        if isinstance(error, APIConnectionError):
+            return UpstreamError(operation, model, f"Upstream {operation} for {model} is unreachable: {error}")
+        if isinstance(error, APIStatusError):
+            if error.status_code in (400, 404, 422):
+                return UpstreamRejected(operation, model, str(error), upstream_status=error.status_code)
+            return UpstreamError(operation, model, str(error), upstream_status=error.status_code)
+        return error
+
+    def retry_delay(self, error: BaseException, attempt: int, idempotent: bool = True) -> Optional[float]:
+        """
+        Возвращает задержку перед повтором или None, если повторять не нужно.
+
+        Аргументы:
+            error: BaseException - Исключение попытки
+            attempt: int - Номер выполненной попытки, начиная с 0
+            idempotent: bool - Операцию можно повторить после ошибки соединения или 5xx
+        """
+        if attempt >= self.retries:
+            return None
+        if isinstance(error, RateLimitError):
+            pass
+        elif not (idempotent and _is_outage(error)):
+            return None
+
+        delay = random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+        retry_after = _retry_after_header(error)
+        if retry_after is not None:
+            if retry_after > self.max_delay:
+                return None
+            delay = max(delay, retry_after)
+
+        deadline = current_deadline()
+        if deadline is not None and time.monotonic() + delay >= deadline:
+            return None
+        return delay
+
+    async def call(self, operation: str, model: str, request: Callable[[], Awaitable[Any]], idempotent: bool = True, hedge: bool = False) -> Any:
+        """
+        Выполняет вызов OpenAI API с повторами и (опционально) хеджированием.
+
+        Аргументы:
+            operation: str - Операция (chat, vision, whisper, tts, images)
+            model: str - Модель
+            request: Callable - Фабрика корутины запроса (вызывается заново на каждую попытку)
+            idempotent: bool - Повторять ли после ошибок соединения, таймаутов и 5xx
+            hedge: bool - Разрешить хеджирование (если включено UPSTREAM_HEDGING)
+
+        Возвращает:
+            Ответ OpenAI API
+
+        Исключения:
+            UpstreamError: Вызов не удался (после всех повторов)
+        """
+        attempt = 0
+        while True:
+            try:
+                if hedge and self.hedging:
+                    return await self._hedged(operation, model, request)
+                async with self.attempt(operation, model):
+                    return await request()
+
+            except UpstreamError:
+                raise
+
+            except Exception as e:
+                delay = self.retry_delay(e, attempt, idempotent)
+                if delay is None:
+                    raise self.translate(operation, model, e) from e
+                UPSTREAM_RETRIES_TOTAL.labels(operation, model_label(model), type(e).__name__).inc()
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def hedge_delay(self, operation: str, model: str) -> Optional[float]:
+        """Задержка хеджирующего запроса: квантиль hedge_quantile последних задержек (None - мало замеров)."""
+        samples = self._latencies.get((operation, model_label(model)))
+        if not samples or len(samples) < self.hedge_min_samples:
+            return None
+        ordered = sorted(samples)
+        return ordered[min(int(len(ordered) * self.hedge_quantile), len(ordered) - 1)]
+
+    async def _hedged(self, operation: str, model: str, request: Callable[[], Awaitable[Any]]) -> Any:
+        async def _attempt() -> Any:
+            async with self.attempt(operation, model):
+                return await request()
+
+        delay = self.hedge_delay(operation, model)
+        primary = asyncio.ensure_future(_attempt())
+        tasks = [primary]
+        try:
+            if delay is None:
+                return await primary
+
+            done, _ = await asyncio.wait(tasks, timeout=delay)
+            # Хеджируем только при свободном слоте: иначе второй запрос лишь усилит перегрузку
+            if done or not self.scheduler.limiter(operation, model).has_capacity():
+                return await primary
+
+            UPSTREAM_HEDGES.labels(operation, model_label(model), "fired").inc()
+            hedge = asyncio.ensure_future(_attempt())
+            tasks.append(hedge)
+            pending = set(tasks)
+            while pending:
+                done, pending = await asyncio.wait(pending, return_when=asyncio.FIRST_COMPLETED)
+                for task in done:
+                    if task.exception() is None:
+                        if task is hedge:
+                            UPSTREAM_HEDGES.labels(operation, model_label(model), "won").inc()
+                        return task.result()
+            return primary.result()  # Обе попытки завершились ошибкой
+
+        finally:
+            for task in tasks:
+                if not task.done():
+                    task.cancel()
+
+    def stats(self) -> dict:
+        """
+        Возвращает состояние предохранителей и порог хеджирования.
+
+        Возвращает:
+            dict: breakers - модель -> state, failures; hedge_delay_ms - "операция:модель" -> мс
+        """
+        return {
+            "breakers": {model: {"state": breaker.state, "failures": breaker.failures} for model, breaker in self._breakers.items()},
+            "hedge_delay_ms": {
+                f"{operation}:{model}": round(delay * 1000, 1)
+                for (operation, model) in self._latencies
+                if (delay := self.hedge_delay(operation, model)) is not None
+            },
+        }
+
+
+# Общий слой устойчивости для всех экземпляров OpenAIService
+resilience = Resilience(upstream_scheduler)
@@ -0,0 +1,315 @@
+from contextlib import asynccontextmanager
+from contextvars import ContextVar
+from typing import AsyncIterator, Dict, List, Optional, Tuple
+from fastapi import Header
+from openai import APITimeoutError, RateLimitError
+from app.core.config import (
+    UPSTREAM_INITIAL_CONCURRENCY,
+    UPSTREAM_MIN_CONCURRENCY,
+    UPSTREAM_MAX_CONCURRENCY,
+    UPSTREAM_QUEUE_SIZE,
+    UPSTREAM_QUEUE_TIMEOUT,
+    UPSTREAM_LATENCY_TOLERANCE,
+)
+from app.core.errors import UpstreamOverloaded
+from app.core.metrics import (
+    UPSTREAM_CONCURRENCY_LIMIT,
+    UPSTREAM_IN_FLIGHT,
+    UPSTREAM_QUEUE_DEPTH,
+    UPSTREAM_REJECTED,
+    model_label,
+)
+import asyncio
+import heapq
+import itertools
+import math
+import time
+
+PRIORITY_HIGH = 0
+PRIORITY_NORMAL = 1
+PRIORITY_LOW = 2
+PRIORITIES = {"high": PRIORITY_HIGH, "normal": PRIORITY_NORMAL, "low": PRIORITY_LOW}
+
+# Приоритет и срок ожидания текущего HTTP-запроса (см. request_scheduling)
+_request_priority: ContextVar[int] = ContextVar("upstream_priority", default=PRIORITY_NORMAL)
+_request_deadline: ContextVar[Optional[float]] = ContextVar("upstream_deadline", default=None)
+
+# Доли сглаживания задержки: быстрая - для оценки ожидания, медленная - базовая линия
+_LATENCY_ALPHA = 0.2
+_BASELINE_ALPHA = 0.02
+
+
+def _is_overload(error: Exception) -> bool:
+    """429 и таймауты - сигнал перегрузки upstream, остальные ошибки лимит не меняют."""
+    return isinstance(error, (RateLimitError, APITimeoutError, asyncio.TimeoutError))
+
+
+class AdaptiveLimiter:
+    """
+    Адаптивный лимит одновременных запросов для одной пары (операция, модель).
+
+    Лимит меняется по схеме AIMD:
+        - успешный запрос при полностью занятом лимите увеличивает его на 1/limit
+          (примерно +1 за "круг" запросов);
+        - 429 или таймаут уменьшает лимит вдвое, не чаще одного раза за время ответа,
+          чтобы пачка ошибок от одного всплеска не обрушила лимит до минимума;
+        - рост задержки (быстрое среднее выше медленного в tolerance раз) уменьшает
+          лимит на 10%.
+
+    Запросы сверх лимита ждут в ограниченной очереди с приоритетами (меньше - раньше,
+    при равном приоритете - в порядке поступления). Если ожидаемое время ожидания
+    не укладывается в срок запроса или очередь заполнена, запрос сразу отклоняется
+    с UpstreamOverloaded.
+    """
+
+    def __init__(
+        self,
+        operation: str,
+        model: str,
+        initial: float = UPSTREAM_INITIAL_CONCURRENCY,
+        minimum: float = UPSTREAM_MIN_CONCURRENCY,
+        maximum: float = UPSTREAM_MAX_CONCURRENCY,
+        max_queue: int = UPSTREAM_QUEUE_SIZE,
+        tolerance: float = UPSTREAM_LATENCY_TOLERANCE
+    ):
+        self.operation = operation
+        self.model = model
+        self.minimum = max(minimum, 1.0)
+        self.maximum = max(maximum, self.minimum)
+        self.limit = min(max(initial, self.minimum), self.maximum)
+        self.max_queue = max_queue
+        self.tolerance = tolerance
+        self.in_flight = 0
+        self.waiting = 0
+        self.latency: Optional[float] = None
+        self.baseline: Optional[float] = None
+        self._last_decrease = 0.0
+        self._queue: List[Tuple[int, int, asyncio.Future]] = []
+        self._counter = itertools.count()
+        self._labels = (operation, model_label(model))
+        UPSTREAM_CONCURRENCY_LIMIT.labels(*self._labels).set(self.limit)
+
+    def _capacity(self) -> int:
+        return max(int(self.limit), 1)
+
+    def has_capacity(self) -> bool:
+        """True, если новый запрос будет допущен без ожидания."""
+        return self.in_flight < self._capacity() and not self.waiting
+
+    def estimated_wait(self, priority: int) -> Optional[float]:
+        """
+        Оценивает ожидание допуска для нового запроса с данным приоритетом.
+
+        Возвращает:
+            float: Секунды (None, пока нет ни одного замера задержки)
+        """
+        if self.has_capacity():
+            return 0.0
+        if self.latency is None:
+            return None
+        ahead = sum(1 for item_priority, _, future in self._queue if item_priority <= priority and not future.done())
+        return math.ceil((ahead + 1) / self._capacity()) * self.latency
+
+    def _reject(self, reason: str, retry_after: Optional[float]) -> UpstreamOverloaded:
+        UPSTREAM_REJECTED.labels(*self._labels, reason).inc()
+        return UpstreamOverloaded(self.operation, self.model, max(math.ceil(retry_after or self.latency or 1.0), 1), reason)
+
+    async def acquire(self, priority: int = PRIORITY_NORMAL, deadline: Optional[float] = None) -> None:
+        """
+        Ждет допуска к upstream.
+
+        Аргументы:
+            priority: int - Приоритет (PRIORITY_HIGH, PRIORITY_NORMAL, PRIORITY_LOW)
+            deadline: float - Крайний момент допуска по time.monotonic() (None - без срока)
+
+        Исключения:
+            UpstreamOverloaded: Очередь заполнена или допуск не укладывается в срок
+        """
+        if self.has_capacity():
+            self._admit()
+            return
+
+        if self.waiting >= self.max_queue:
+            raise self._reject("queue_full", self.estimated_wait(priority))
+
+        timeout = None
+        if deadline is not None:
+            timeout = deadline - time.monotonic()
+            wait = self.estimated_wait(priority)
+            if timeout <= 0 or (wait is not None and wait > timeout):
+                raise self._reject("deadline", wait)
+
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self._queue, (priority, next(self._counter), future))
+        self._set_waiting(self.waiting + 1)
+        try:
+            await asyncio.wait_for(asyncio.shield(future), timeout)
+
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                return  # Допущен в последний момент
+            future.cancel()
+            self._set_waiting(self.waiting - 1)
+            raise self._reject("timeout", self.estimated_wait(priority))
+
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release(None)  # Слот уже выдан, но запрос отменен
+            else:
+                future.cancel()
+                self._set_waiting(self.waiting - 1)
+            raise
+
+    def release(self, latency: Optional[float], error: Optional[Exception] = None) -> None:
+        """
+        Освобождает слот и корректирует лимит по результату запроса.
+
+        Аргументы:
+            latency: float - Время выполнения запроса в секундах (None - не учитывать)
+            error: Exception - Исключение запроса (опционально)
+        """
+        saturated = self.in_flight >= self._capacity() or self.waiting > 0
+        self.in_flight -= 1
+        UPSTREAM_IN_FLIGHT.labels(*self._labels).set(self.in_flight)
+
+        now = time.monotonic()
+        if error is not None and _is_overload(error):
+            self._decrease(0.5, now)
+        elif error is None and latency is not None:
+            self.latency = latency if self.latency is None else self.latency + _LATENCY_ALPHA * (latency - self.latency)
+            self.baseline = latency if self.baseline is None else self.baseline + _BASELINE_ALPHA * (latency - self.baseline)
+            if self.latency > self.baseline * self.tolerance:
+                self._decrease(0.9, now)
+            elif saturated:
+                self.limit = min(self.limit + 1 / self.limit, self.maximum)
+                UPSTREAM_CONCURRENCY_LIMIT.labels(*self._labels).set(self.limit)
+
+        self._dispatch()
+
+    def _decrease(self, factor: float, now: float) -> None:
+        if now - self._last_decrease < (self.latency or 1.0):
+            return
+        self._last_decrease = now
+        self.limit = max(self.limit * factor, self.minimum)
+        UPSTREAM_CONCURRENCY_LIMIT.labels(*self._labels).set(self.limit)
+
+    def _admit(self) -> None:
+        self.in_flight += 1
+        UPSTREAM_IN_FLIGHT.labels(*self._labels).set(self.in_flight)
+
+    def _set_waiting(self, waiting: int) -> None:
+        self.waiting = waiting
+        UPSTREAM_QUEUE_DEPTH.labels(*self._labels).set(waiting)
+
+    def _dispatch(self) -> None:
+        while self._queue and self.in_flight < self._capacity():
+            _, _, future = heapq.heappop(self._queue)
+            if future.done():
+                continue  # Ожидание отменено или истекло
+            self._set_waiting(self.waiting - 1)
+            self._admit()
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        return {
+            "limit": round(self.limit, 2),
+            "in_flight": self.in_flight,
+            "waiting": self.waiting,
+            "latency_ms": round(self.latency * 1000, 1) if self.latency is not None else None,
+            "baseline_ms": round(self.baseline * 1000, 1) if self.baseline is not None else None,
+        }
+
+
+class UpstreamScheduler:
+    """
+    Планировщик вызовов OpenAI API: по одному AdaptiveLimiter на пару (операция, модель).
+
+    Перегрузка одной модели (429, рост задержки) снижает лимит только для нее,
+    остальные модели и операции продолжают работать со своими лимитами.
+    Модели, которых нет в KNOWN_MODELS, делят один лимит "other" (см. model_label):
+    имя модели приходит от клиента, и лимитеры не должны множиться без ограничения.
+    """
+
+    def __init__(self, **limiter_options):
+        self.limiter_options = limiter_options
+        self._limiters: Dict[Tuple[str, str], AdaptiveLimiter] = {}
+
+    def limiter(self, operation: str, model: str) -> AdaptiveLimiter:
+        key = (operation, model_label(model))
+        limiter = self._limiters.get(key)
+        if limiter is None:
+            limiter = self._limiters[key] = AdaptiveLimiter(*key, **self.limiter_options)
+        return limiter
+
+    @asynccontextmanager
+    async def slot(self, operation: str, model: str, priority: Optional[int] = None, deadline: Optional[float] = None) -> AsyncIterator[None]:
+        """
+        Занимает слот для вызова OpenAI API на время блока with.
+
+        Приоритет и срок по умолчанию берутся из текущего HTTP-запроса
+        (заголовки X-Priority и X-Request-Timeout, см. request_scheduling),
+        иначе - PRIORITY_NORMAL и UPSTREAM_QUEUE_TIMEOUT секунд.
+
+        Аргументы:
+            operation: str - Операция (chat, chat_stream, vision, whisper, tts, images)
+            model: str - Модель
+            priority: int - Приоритет (опционально)
+            deadline: float - Крайний момент допуска по time.monotonic() (опционально)
+
+        Исключения:
+            UpstreamOverloaded: Запрос не допущен
+        """
+        limiter = self.limiter(operation, model)
+        if priority is None:
+            priority = _request_priority.get()
+        if deadline is None:
+            deadline = _request_deadline.get() or time.monotonic() + UPSTREAM_QUEUE_TIMEOUT
+
+        await limiter.acquire(priority, deadline)
+        started = time.monotonic()
+        try:
+            yield
+        except Exception as e:
+            limiter.release(time.monotonic() - started, e)
+            raise
+        except BaseException:
+            limiter.release(None)
+            raise
+        else:
+            limiter.release(time.monotonic() - started)
+
+    def stats(self) -> dict:
+        """
+        Возвращает состояние лимитов.
+
+        Возвращает:
+            dict: "операция:модель" -> limit, in_flight, waiting, latency_ms, baseline_ms
+        """
+        return {f"{operation}:{model}": limiter.stats() for (operation, model), limiter in self._limiters.items()}
+
+
+def current_deadline() -> Optional[float]:
+    """Крайний момент, заданный текущим HTTP-запросом (X-Request-Timeout), по time.monotonic()."""
+    return _request_deadline.get()
+
+
+async def request_scheduling(
+    x_priority: Optional[str] = Header(None),
+    x_request_timeout: Optional[float] = Header(None)
+) -> None:
+    """
+    Зависимость FastAPI: задает приоритет и срок ожидания вызовов OpenAI API
+    для текущего запроса.
+
+    Параметры:
+        x_priority: str - Заголовок X-Priority: high, normal (по умолчанию) или low
+        x_request_timeout: float - Заголовок X-Request-Timeout: сколько секунд запрос
+            готов ждать допуска к upstream (по умолчанию UPSTREAM_QUEUE_TIMEOUT)
+    """
+    _request_priority.set(PRIORITIES.get((x_priority or "").lower(), PRIORITY_NORMAL))
+    if x_request_timeout is not None and x_request_timeout > 0:
+        _request_deadline.set(time.monotonic() + x_request_timeout)
+
+
+# Общий планировщик для всех экземпляров OpenAIService
+upstream_scheduler = UpstreamScheduler()
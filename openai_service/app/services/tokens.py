@@ -0,0 +1,185 @@
+from collections import OrderedDict
+from functools import lru_cache
+from typing import Any, List, Tuple
+from app.core.config import CHAT_COMPLETION_RESERVE, TOKEN_COUNT_CACHE_SIZE
+import hashlib
+import math
+import re
+
+try:
+    import tiktoken
+except ImportError:  # tiktoken не обязателен: без него используется оценка
+    tiktoken = None
+
+
+# Размер контекстного окна моделей (в токенах). Поиск идет по самому длинному префиксу.
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-3.5-turbo-instruct": 4096,
+    "gpt-4": 8192,
+    "gpt-4-32k": 32768,
+    "gpt-4-turbo": 128000,
+    "gpt-4-vision-preview": 128000,
+    "gpt-4-1106-preview": 128000,
+    "gpt-4-0125-preview": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+    "o1": 200000,
+    "o1-mini": 128000,
+    "o3-mini": 200000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+
+# Служебные токены формата сообщений chat completions
+TOKENS_PER_MESSAGE = 3
+TOKENS_PER_NAME = 1
+TOKENS_PER_REPLY = 3
+
+_WORD_RE = re.compile(r"\w+|[^\w\s]", re.UNICODE)
+
+# Кэш результатов count_text_tokens: (дайджест текста, токенизатор) -> количество токенов.
+# Ключ - 16-байтный BLAKE2b, а не сам текст, поэтому кэш не удерживает в памяти промпты
+# клиентов: TOKEN_COUNT_CACHE_SIZE записей занимают порядка сотни байт каждая
+_token_counts: "OrderedDict[Tuple[bytes, str], int]" = OrderedDict()
+
+
+def context_window(model: str) -> int:
+    """
+    Возвращает размер контекстного окна модели.
+
+    Параметры:
+        model: str - Название модели
+
+    Возвращает:
+        int: Количество токенов (DEFAULT_CONTEXT_WINDOW для неизвестных моделей)
+    """
+    best = None
+    for prefix in MODEL_CONTEXT_WINDOWS:
+        if model.startswith(prefix) and (best is None or len(prefix) > len(best)):
+            best = prefix
+    return MODEL_CONTEXT_WINDOWS[best] if best else DEFAULT_CONTEXT_WINDOW
+
+def _estimate_tokens(text: str) -> int:
+    # Оценка, откалиброванная по cl100k_base: латиница ~4 символа на токен,
+    # кириллица и прочие не-ASCII символы ~2.5 символа на токен, но не меньше
+    # одного токена на слово или знак препинания.
+    tokens = 0.0
+    for piece in _WORD_RE.findall(text):
+        tokens += max(1.0, len(piece) / (4 if piece.isascii() else 2.5))
+    return math.ceil(tokens)
+
+@lru_cache(maxsize=8)
+def _encoding(model: str):
+    try:
+        return tiktoken.encoding_for_model(model)
+    except KeyError:
+        return tiktoken.get_encoding("cl100k_base")
+
+def count_text_tokens(text: str, model: str = "gpt-3.5-turbo") -> int:
+    """
+    Считает токены в тексте (результаты кэшируются по дайджесту текста).
+
+    Параметры:
+        text: str - Текст
+        model: str - Модель, для которой выбирается токенизатор
+
+    Возвращает:
+        int: Количество токенов (точное при установленном tiktoken, иначе оценка)
+    """
+    if not text:
+        return 0
+    encoding = _encoding(model) if tiktoken is not None else None
+    key = (
+        hashlib.blake2b(text.encode("utf-8", "surrogatepass"), digest_size=16).digest(),
+        encoding.name if encoding is not None else "estimate",
+    )
+    tokens = _token_counts.get(key)
+    if tokens is not None:
+        try:
+            _token_counts.move_to_end(key)
+        except KeyError:
+            pass  # Запись вытеснена между get и move_to_end
+        return tokens
+
+    tokens = len(encoding.encode(text)) if encoding is not None else _estimate_tokens(text)
+    _token_counts[key] = tokens
+    while len(_token_counts) > TOKEN_COUNT_CACHE_SIZE:
+        _token_counts.popitem(last=False)
+    return tokens
+
+def _message_content(message: Any) -> tuple:
+    if hasattr(message, "model_dump"):
+        message = message.model_dump()
+    content = message.get("content") or ""
+    if not isinstance(content, str):
+        # Мультимодальные сообщения: учитываем только текстовые части
+        content = " ".join(part.get("text", "") for part in content if isinstance(part, dict))
+    return message.get("role") or "", content, message.get("name")
+
+def count_message_tokens(message: Any, model: str = "gpt-3.5-turbo") -> int:
+    """
+    Считает токены одного сообщения chat completions, включая служебные.
+
+    Параметры:
+        message: Message или dict - Сообщение с полями role, content (и опционально name)
+        model: str - Модель
+
+    Возвращает:
+        int: Количество токенов
+    """
+    role, content, name = _message_content(message)
+    tokens = TOKENS_PER_MESSAGE + count_text_tokens(role, model) + count_text_tokens(content, model)
+    if name:
+        tokens += TOKENS_PER_NAME + count_text_tokens(name, model)
+    return tokens
+
+def count_messages_tokens(messages: List[Any], model: str = "gpt-3.5-turbo") -> int:
+    """
+    Считает токены запроса (списка сообщений) так же, как их учитывает OpenAI API.
+
+    Возвращает:
+        int: Количество токенов промпта
+    """
+    return sum(count_message_tokens(message, model) for message in messages) + TOKENS_PER_REPLY
+
+def fit_messages(messages: List[Any], model: str, reserve: int = CHAT_COMPLETION_RESERVE) -> List[Any]:
+    """
+    Обрезает историю сообщений под контекстное окно модели.
+
+    Системные сообщения в начале списка сохраняются всегда, затем добавляются
+    сообщения от самых новых к старым, пока они помещаются в бюджет
+    (окно модели минус reserve токенов на ответ). Последнее сообщение
+    сохраняется в любом случае.
+
+    Параметры:
+        messages: List - Сообщения запроса
+        model: str - Модель
+        reserve: int - Количество токенов, оставляемых под ответ модели
+
+    Возвращает:
+        List: Сообщения, помещающиеся в бюджет, в исходном порядке
+    """
+    if not messages:
+        return messages
+
+    budget = max(context_window(model) - reserve, 0) - TOKENS_PER_REPLY
+
+    head = []
+    for message in messages:
+        role = message.role if hasattr(message, "role") else message.get("role")
+        if role != "system" or len(head) == len(messages) - 1:
+            break
+        head.append(message)
+    budget -= sum(count_message_tokens(message, model) for message in head)
+
+    tail = []
+    for message in reversed(messages[len(head):]):
+        tokens = count_message_tokens(message, model)
+        if tail and tokens > budget:
+            break
+        tail.append(message)
+        budget -= tokens
+
+    if len(head) + len(tail) == len(messages):
+        return messages
+    return head + tail[::-1]
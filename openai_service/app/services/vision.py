@@ -0,0 +1,218 @@
+from concurrent.futures import ProcessPoolExecutor
+from typing import Optional, Tuple
+from app.core.config import (
+    VISION_DETAIL,
+    VISION_JPEG_QUALITY,
+    VISION_WORKERS,
+    VISION_MAX_IMAGE_BYTES,
+    VISION_CACHE_MAX_ENTRIES,
+    VISION_CACHE_TTL,
+)
+from app.services.cache import TTLCache
+import asyncio
+import base64
+import binascii
+import hashlib
+import io
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Pillow не обязателен: без него изображение передается в OpenAI как есть
+    Image = None
+    ImageOps = None
+
+# Ограничения размера изображения для vision-моделей: при detail=high изображение вписывается
+# в 2048x2048, затем короткая сторона уменьшается до 768 (дальше токены не уменьшаются);
+# при detail=low модель видит 512x512
+HIGH_DETAIL_MAX_SIDE = 2048
+HIGH_DETAIL_SHORT_SIDE = 768
+LOW_DETAIL_SIDE = 512
+
+
+class InvalidImage(ValueError):
+    """Изображение не удалось получить или декодировать."""
+
+
+class PreparedImage:
+    """
+    Изображение, подготовленное для vision-модели.
+
+    Атрибуты:
+        data: bytes - JPEG после уменьшения и пережатия
+        sha256: str - SHA-256 исходного файла (hex)
+        width: int, height: int - Размер после уменьшения
+        original_bytes: int - Размер исходного файла
+    """
+    __slots__ = ("data", "sha256", "width", "height", "original_bytes")
+
+    def __init__(self, data: bytes, sha256: str, width: int, height: int, original_bytes: int):
+        self.data = data
+        self.sha256 = sha256
+        self.width = width
+        self.height = height
+        self.original_bytes = original_bytes
+
+    def data_url(self) -> str:
+        return "data:image/jpeg;base64," + base64.b64encode(self.data).decode("ascii")
+
+
+def preprocessing_available() -> bool:
+    """True, если установлен Pillow."""
+    return Image is not None
+
+def target_size(width: int, height: int, detail: str = VISION_DETAIL) -> Tuple[int, int]:
+    """
+    Вычисляет размер, до которого имеет смысл уменьшить изображение для vision-модели.
+
+    Больший размер не добавляет деталей, которые видит модель, но увеличивает
+    объем передаваемых данных (и число тайлов, то есть токенов).
+
+    Возвращает:
+        Tuple[int, int]: Ширина и высота (не больше исходных)
+    """
+    if detail == "low":
+        scale = min(LOW_DETAIL_SIDE / max(width, height), 1.0)
+    else:
+        scale = min(HIGH_DETAIL_MAX_SIDE / max(width, height), 1.0)
+        scale *= min(HIGH_DETAIL_SHORT_SIDE / (min(width, height) * scale), 1.0)
+    return max(round(width * scale), 1), max(round(height * scale), 1)
+
+def _prepare(data: bytes, detail: str, quality: int) -> Tuple[bytes, int, int]:
+    # Выполняется в отдельном процессе (ProcessPoolExecutor): декодирование,
+    # уменьшение и кодирование в JPEG - CPU-работа, которая не должна занимать event loop
+    try:
+        image = Image.open(io.BytesIO(data))
+        image = ImageOps.exif_transpose(image)
+    except Exception as e:
+        raise InvalidImage(f"Cannot decode image: {e}") from None
+
+    if image.mode in ("RGBA", "LA", "P"):
+        image = image.convert("RGBA")
+        background = Image.new("RGB", image.size, (255, 255, 255))
+        background.paste(image, mask=image.getchannel("A"))
+        image = background
+    elif image.mode != "RGB":
+        image = image.convert("RGB")
+
+    size = target_size(image.width, image.height, detail)
+    if size != image.size:
+        image = image.resize(size, Image.Resampling.LANCZOS)
+
+    out = io.BytesIO()
+    image.save(out, format="JPEG", quality=quality, optimize=True)
+    return out.getvalue(), image.width, image.height
+
+
+class ImagePreprocessor:
+    """
+    Подготовка изображений для vision-моделей в пуле процессов.
+
+    Подготовленные изображения кэшируются в памяти по SHA-256 содержимого,
+    поэтому повторное изображение не обрабатывается заново.
+    """
+
+    def __init__(
+        self,
+        workers: int = VISION_WORKERS,
+        detail: str = VISION_DETAIL,
+        quality: int = VISION_JPEG_QUALITY,
+        max_bytes: int = VISION_MAX_IMAGE_BYTES
+    ):
+        self.workers = workers or None
+        self.detail = detail
+        self.quality = quality
+        self.max_bytes = max_bytes
+        self.cache = TTLCache(VISION_CACHE_MAX_ENTRIES, VISION_CACHE_TTL)
+        self._executor: Optional[ProcessPoolExecutor] = None
+        self.processed = 0
+        self.reused = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+
+    def _pool(self) -> ProcessPoolExecutor:
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(max_workers=self.workers)
+        return self._executor
+
+    def shutdown(self) -> None:
+        """Останавливает пул процессов (вызывается при остановке приложения)."""
+        if self._executor is not None:
+            self._executor.shutdown(wait=False, cancel_futures=True)
+            self._executor = None
+
+    async def prepare(self, data: bytes) -> PreparedImage:
+        """
+        Уменьшает и пережимает изображение.
+
+        Аргументы:
+            data: bytes - Исходный файл изображения
+
+        Возвращает:
+            PreparedImage: Подготовленное изображение
+
+        Исключения:
+            InvalidImage: Файл слишком большой или не является изображением
+        """
+        if len(data) > self.max_bytes:
+            raise InvalidImage(f"Image is larger than {self.max_bytes} bytes")
+
+        sha256 = hashlib.sha256(data).hexdigest()
+        digest = "sha256:" + sha256
+        prepared = self.cache.get(digest)
+        if prepared is not None:
+            self.reused += 1
+        else:
+            loop = asyncio.get_running_loop()
+            jpeg, width, height = await loop.run_in_executor(self._pool(), _prepare, data, self.detail, self.quality)
+            prepared = PreparedImage(jpeg, sha256, width, height, len(data))
+            self.cache.set(digest, prepared)
+            self.processed += 1
+            self.bytes_in += len(data)
+            self.bytes_out += len(jpeg)
+        return prepared
+
+    def stats(self) -> dict:
+        """
+        Возвращает счетчики предобработки.
+
+        Возвращает:
+            dict: enabled, processed, reused, bytes_in, bytes_out, cached
+        """
+        return {
+            "enabled": preprocessing_available(),
+            "processed": self.processed,
+            "reused": self.reused,
+            "bytes_in": self.bytes_in,
+            "bytes_out": self.bytes_out,
+            "cached": len(self.cache),
+        }
+
+
+def decode_data_url(url: str) -> Optional[bytes]:
+    """
+    Декодирует data: URL с base64 (например, изображение, загруженное клиентом).
+
+    Возвращает:
+        bytes: Содержимое (None, если это не data: URL)
+
+    Исключения:
+        InvalidImage: Некорректный data: URL
+    """
+    if not url.startswith("data:"):
+        return None
+    header, _, payload = url.partition(",")
+    if ";base64" not in header:
+        raise InvalidImage("Only base64 data URLs are supported")
+    try:
+        return base64.b64decode(payload, validate=True)
+    except (binascii.Error, ValueError):
+        raise InvalidImage("Invalid base64 in data URL") from None
+
+
+# Общий препроцессор изображений; пул процессов создается при первом использовании
+image_preprocessor = ImagePreprocessor()
+
+# Ответы vision-модели по (SHA-256 исходного файла, модель, вопрос, detail): ответ
+# переиспользуется только для побайтно того же изображения, похожие картинки с другими
+# деталями (текстом, цифрами) отправляются в OpenAI API
+vision_answers = TTLCache(VISION_CACHE_MAX_ENTRIES, VISION_CACHE_TTL)
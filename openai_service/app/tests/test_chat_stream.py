@@ -0,0 +1,98 @@
+"""
+Потоковая отдача chat completions (stream=true) против локального fake OpenAI API
+(benchmarks/fake_openai.py): первый фрагмент ответа должен прийти клиенту раньше,
+чем upstream сгенерирует последний токен.
+
+Сервис и fake OpenAI API запускаются настоящими серверами uvicorn: транспорт ASGI
+в httpx отдает тело ответа только целиком и не показал бы потоковую отдачу.
+Окружение сервиса (ключ API, адрес fake OpenAI API, база) задает conftest.py.
+"""
+from contextlib import contextmanager
+import importlib
+import json
+import socket
+import threading
+import time
+import uuid
+
+import httpx
+import pytest
+import uvicorn
+
+from benchmarks import fake_openai
+
+COMPLETION_TOKENS = 20
+TOKEN_INTERVAL = 0.05
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+@contextmanager
+def _serve(app, port: int):
+    """Запускает приложение в uvicorn в отдельном потоке на время блока with."""
+    server = uvicorn.Server(uvicorn.Config(app, host="127.0.0.1", port=port, log_level="warning"))
+    thread = threading.Thread(target=server.run, daemon=True)
+    thread.start()
+    deadline = time.monotonic() + 30
+    while not server.started:
+        if not thread.is_alive() or time.monotonic() > deadline:
+            raise RuntimeError(f"uvicorn did not start on port {port}")
+        time.sleep(0.05)
+    try:
+        yield f"http://127.0.0.1:{port}"
+    finally:
+        server.should_exit = True
+        thread.join(30)
+
+
+@pytest.fixture(scope="module")
+def service_url(fake_openai_port):
+    fake_args = fake_openai.parse_args([
+        "--latency", "0.05",
+        "--token-interval", str(TOKEN_INTERVAL),
+        "--completion-tokens", str(COMPLETION_TOKENS),
+    ])
+    main = importlib.import_module("main")
+    with _serve(fake_openai.create_app(fake_args), fake_openai_port), _serve(main.app, _free_port()) as url:
+        yield url
+
+
+def test_first_event_arrives_before_last_token(service_url, api_key):
+    body = {
+        "chat_id": str(uuid.uuid4()),
+        "model": "gpt-3.5-turbo",
+        "messages": [{"role": "user", "content": "2+2=?"}],
+        "stream": True,
+    }
+    started = time.perf_counter()
+    deltas = []
+    events = []
+    with httpx.stream(
+        "POST", f"{service_url}/api/v1/chat/completions",
+        json=body, headers={"X-API-Key": api_key}, timeout=30
+    ) as response:
+        assert response.status_code == 200
+        assert response.headers["content-type"].startswith("text/event-stream")
+        for line in response.iter_lines():
+            if line.startswith("event: "):
+                events.append(line[len("event: "):])
+            elif line.startswith("data: {"):
+                payload = json.loads(line[len("data: "):])
+                if "delta" in payload:
+                    deltas.append((time.perf_counter() - started, payload["delta"]))
+            elif line == "data: [DONE]":
+                events.append("done")
+
+    assert "error" not in events
+    assert events[-2:] == ["usage", "done"]
+    assert len([delta for _, delta in deltas if delta]) == COMPLETION_TOKENS
+
+    # Upstream отдает токены с паузой TOKEN_INTERVAL: при буферизации ответа все фрагменты
+    # пришли бы одновременно, после последнего токена
+    first_at, last_at = deltas[0][0], deltas[-1][0]
+    generation = COMPLETION_TOKENS * TOKEN_INTERVAL
+    assert first_at < last_at - generation / 2
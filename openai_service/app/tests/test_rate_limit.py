@@ -0,0 +1,52 @@
+"""
+Лимиты запросов по API-ключу (app.core.rate_limit): корзины ведутся по ограниченному
+набору имен моделей, поэтому смена имени модели в запросе не дает обойти лимит ключа,
+а лимиты клиента берутся из самого клиента запроса (app.core.security.Tenant).
+"""
+import asyncio
+
+import pytest
+
+from app.core.rate_limit import MemoryBackend, RateLimiter, RateLimitExceeded
+from app.core.security import Tenant, hash_api_key
+
+
+def _tenant(name: str, rpm=None, tpm=None) -> Tenant:
+    return Tenant(None, name, hash_api_key(name), rpm, tpm)
+
+
+def _admitted(limiter: RateLimiter, tenant: Tenant, models) -> int:
+    async def run() -> int:
+        admitted = 0
+        for model in models:
+            try:
+                await limiter.acquire(tenant, "chat", model)
+                admitted += 1
+            except RateLimitExceeded:
+                pass
+        return admitted
+    return asyncio.run(run())
+
+
+def test_cycling_model_names_does_not_bypass_rpm():
+    limiter = RateLimiter(MemoryBackend(), rpm=2, tpm=0, enabled=True)
+    tenant = _tenant("key-a")
+    assert _admitted(limiter, tenant, [f"gpt-4-x{i}" for i in range(50)]) == 2
+    # Датированные снимки известной модели делят корзину базовой модели
+    assert _admitted(limiter, tenant, ["gpt-4o", "gpt-4o-2024-08-06", "gpt-4o-2024-11-20"]) == 2
+    # Лимит ведется по ключу: другой ключ не затронут
+    assert _admitted(limiter, _tenant("key-b"), ["gpt-4-y"]) == 1
+
+
+@pytest.mark.parametrize("model", ["gpt-4", "gpt-4-0613"])
+def test_model_override_applies_to_normalized_name(model):
+    limiter = RateLimiter(MemoryBackend(), rpm=100, tpm=0, model_limits={"gpt-4": {"rpm": 1}}, enabled=True)
+    tenant = _tenant("key-a")
+    assert limiter.limits_for(tenant, model) == (1, 0)
+    assert _admitted(limiter, tenant, [model] * 3) == 1
+
+
+def test_tenant_limits_replace_defaults():
+    limiter = RateLimiter(MemoryBackend(), rpm=100, tpm=1000, enabled=True)
+    assert limiter.limits_for(_tenant("key-a", rpm=3), "gpt-4o") == (3, 1000)
+    assert _admitted(limiter, _tenant("key-a", rpm=3), ["gpt-4o"] * 5) == 3
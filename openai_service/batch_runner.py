@@ -0,0 +1,462 @@
+"""
+Пакетная обработка JSONL-файла через OpenAIService без HTTP API.
+
+Каждая строка входного файла - JSON-объект с запросом chat completion:
+    {"id": "q1", "model": "gpt-4o-mini", "messages": [{"role": "user", "content": "..."}]}
+или с текстом запроса в одном поле (см. --prompt-field):
+    {"ticket": "T-1042", "question": "Как сменить тариф?"}
+
+Результаты пишутся в выходной JSONL-файл по одной строке на запрос - в порядке
+входного файла (--order input) или в порядке завершения (--order completion):
+    {"line": 1, "id": "q1", "status": "ok", "model": "...", "response": "...", "usage": {...}}
+    {"line": 2, "id": "q2", "status": "error", "error": "...", "detail": "...", "status_code": 400, "retry_after": null}
+
+Файл читается потоково, а число строк в обработке ограничено окном (--window),
+поэтому память не зависит от размера входного файла. Рядом с выходным файлом
+ведется контрольная точка (<output>.checkpoint): прерванный запуск (Ctrl+C, SIGTERM,
+падение) при повторном запуске с теми же аргументами продолжает с нее, не повторяя
+уже записанные строки.
+
+Запускается из каталога openai_service (настройки OpenAI API и базы данных для логов -
+из .env, как у сервиса). Примеры:
+    python batch_runner.py corpus.jsonl -o answers.jsonl --concurrency 32 --rpm 3000
+    python batch_runner.py support_questions.jsonl -o answers.jsonl --prompt-field question --id-field ticket --order completion
+"""
+import os
+from dotenv import load_dotenv
+
+# Загружаем переменные окружения из файла .env
+load_dotenv()
+
+from typing import Dict, List, Optional, Set, Tuple
+import argparse
+import asyncio
+import json
+import signal
+import sys
+import time
+
+from app.core.config import CHAT_BATCH_CONCURRENCY
+from app.db.database import init_db, engine
+from app.db.writer import writer
+from app.models.chat import ChatRequest
+from app.services.batch import error_fields
+from app.services.openai import OpenAIService
+
+# Сколько строк читается из файла за одно обращение к пулу потоков
+READ_BATCH_LINES = 256
+
+
+class RequestRateLimiter:
+    """
+    Ограничение частоты запросов (GCRA): не больше rate запросов в минуту
+    с допустимым всплеском burst запросов.
+
+    Каждый вызов acquire() резервирует следующий свободный интервал,
+    поэтому ожидающие воркеры получают допуск по очереди, без гонок.
+    """
+
+    def __init__(self, rate_per_minute: float, burst: int = 1):
+        self.interval = 60.0 / rate_per_minute
+        self.burst = max(burst, 1)
+        self._next = 0.0
+
+    async def acquire(self) -> None:
+        now = time.monotonic()
+        slot = max(self._next, now)
+        self._next = slot + self.interval
+        wait = slot - now - (self.burst - 1) * self.interval
+        if wait > 0:
+            await asyncio.sleep(wait)
+
+
+class Checkpoint:
+    """
+    Контрольная точка прогона.
+
+    Атрибуты:
+        line: int - Все строки до этой (не включая) обработаны и записаны
+        offset: int - Смещение начала строки line во входном файле (байты)
+        done: List[int] - Обработанные строки после line (при --order completion)
+        output_bytes: int - Размер выходного файла, соответствующий контрольной точке
+        complete: bool - Входной файл обработан целиком
+    """
+    __slots__ = ("path", "input", "order", "line", "offset", "done", "output_bytes", "complete")
+
+    def __init__(self, path: str, input_path: str, order: str):
+        self.path = path
+        self.input = input_path
+        self.order = order
+        self.line = 1
+        self.offset = 0
+        self.done: List[int] = []
+        self.output_bytes = 0
+        self.complete = False
+
+    @classmethod
+    def load(cls, path: str, input_path: str, order: str) -> Optional["Checkpoint"]:
+        """
+        Читает контрольную точку (None, если файла нет).
+
+        Исключения:
+            ValueError: Контрольная точка от другого входного файла или порядка вывода
+        """
+        try:
+            with open(path) as f:
+                data = json.load(f)
+        except FileNotFoundError:
+            return None
+        if data["input"] != input_path or data["order"] != order:
+            raise ValueError(
+                f"Checkpoint {path} belongs to a run of {data['input']} with --order {data['order']}; "
+                "use --restart to start over"
+            )
+        checkpoint = cls(path, input_path, order)
+        checkpoint.line = data["line"]
+        checkpoint.offset = data["offset"]
+        checkpoint.done = data["done"]
+        checkpoint.output_bytes = data["output_bytes"]
+        checkpoint.complete = data["complete"]
+        return checkpoint
+
+    def save(self) -> None:
+        # Атомарная замена: при падении во время записи остается предыдущая контрольная точка
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w") as f:
+            json.dump({
+                "input": self.input,
+                "order": self.order,
+                "line": self.line,
+                "offset": self.offset,
+                "done": self.done,
+                "output_bytes": self.output_bytes,
+                "complete": self.complete,
+            }, f)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp, self.path)
+
+
+def _read_lines(f, limit: int) -> List[Tuple[bytes, int]]:
+    # До limit строк вместе со смещением конца каждой строки
+    lines = []
+    for _ in range(limit):
+        raw = f.readline()
+        if not raw:
+            break
+        lines.append((raw, f.tell()))
+    return lines
+
+def _write_lines(f, lines: List[str]) -> int:
+    f.write("".join(lines).encode("utf-8"))
+    return f.tell()
+
+def _sync(f) -> None:
+    f.flush()
+    os.fsync(f.fileno())
+
+def parse_request(raw: bytes, line: int, args: argparse.Namespace) -> Tuple[Optional[str], ChatRequest]:
+    """
+    Собирает ChatRequest из строки входного файла.
+
+    Возвращает:
+        Tuple[Optional[str], ChatRequest]: Идентификатор запроса (поле --id-field) и запрос
+
+    Исключения:
+        ValueError: Строка не является JSON-объектом или в ней нет ни messages, ни --prompt-field
+    """
+    item = json.loads(raw)
+    if not isinstance(item, dict):
+        raise ValueError("Line is not a JSON object")
+    item_id = item.get(args.id_field)
+    messages = item.get("messages")
+    if messages is None:
+        prompt = item.get(args.prompt_field)
+        if not isinstance(prompt, str) or not prompt:
+            raise ValueError(f"Line has neither 'messages' nor '{args.prompt_field}'")
+        messages = [{"role": "user", "content": prompt}]
+        if args.system:
+            messages.insert(0, {"role": "system", "content": args.system})
+    chat_id = str(item_id) if item_id is not None else str(line)
+    return item_id, ChatRequest(chat_id=chat_id, model=item.get("model") or args.model, messages=messages)
+
+
+class BatchRunner:
+    """
+    Прогон JSONL-файла через OpenAIService.
+
+    Чтение, воркеры и запись связаны ограниченными очередями:
+        - читатель передает строки воркерам и не уходит дальше окна (--window строк)
+          от первой незаписанной строки;
+        - воркеры (--concurrency) выполняют запросы с ограничением частоты (--rpm);
+        - единственный писатель пишет результаты, двигает контрольную точку
+          и раз в --checkpoint-interval секунд сохраняет ее вместе с fsync выходного файла.
+    """
+
+    def __init__(self, service: OpenAIService, args: argparse.Namespace):
+        self.service = service
+        self.args = args
+        self.limiter = RequestRateLimiter(args.rpm, args.concurrency) if args.rpm else None
+        self.window = asyncio.Semaphore(args.window)
+        self.requests: asyncio.Queue = asyncio.Queue(maxsize=args.concurrency * 2)
+        self.results: asyncio.Queue = asyncio.Queue()
+        self.input_size = os.path.getsize(args.input)
+        self.input_offset = 0
+        self.in_flight = 0
+        self.succeeded = 0
+        self.failed = 0
+        self.skipped = 0
+        self.tokens = 0
+
+    async def run(self, checkpoint: Checkpoint) -> None:
+        self.input_offset = checkpoint.offset
+        started = time.monotonic()
+        reporter = asyncio.create_task(self._report(started))
+        workers = [asyncio.create_task(self._worker()) for _ in range(self.args.concurrency)]
+        reader = asyncio.create_task(self._read(checkpoint))
+        write = asyncio.create_task(self._write(checkpoint))
+        try:
+            # Ошибка чтения входного файла прерывает прогон (контрольная точка сохраняется)
+            await asyncio.wait({reader, write}, return_when=asyncio.FIRST_EXCEPTION)
+            if reader.done() and reader.exception() is not None:
+                raise reader.exception()
+            await write
+        finally:
+            for task in (write, reader, *workers, reporter):
+                task.cancel()
+            await asyncio.gather(write, reader, *workers, reporter, return_exceptions=True)
+            self._print_progress(started, final=True)
+
+    async def _read(self, checkpoint: Checkpoint) -> None:
+        resumed: Set[int] = set(checkpoint.done)
+        line = checkpoint.line
+        f = await asyncio.to_thread(open, self.args.input, "rb")
+        try:
+            await asyncio.to_thread(f.seek, checkpoint.offset)
+            while True:
+                lines = await asyncio.to_thread(_read_lines, f, READ_BATCH_LINES)
+                if not lines:
+                    break
+                for raw, end in lines:
+                    await self.window.acquire()
+                    self.input_offset = end
+                    if line in resumed or not raw.strip():
+                        # Уже записана предыдущим запуском или пустая строка
+                        resumed.discard(line)
+                        self.skipped += 1
+                        await self.results.put((line, end, None))
+                    else:
+                        await self.requests.put((line, end, raw))
+                    line += 1
+        finally:
+            await asyncio.to_thread(f.close)
+        # Сигнал писателю: больше строк не будет
+        await self.results.put((line, None, None))
+
+    async def _worker(self) -> None:
+        while True:
+            line, end, raw = await self.requests.get()
+            self.in_flight += 1
+            try:
+                record = await self._process(line, raw)
+            finally:
+                self.in_flight -= 1
+            await self.results.put((line, end, record))
+
+    async def _process(self, line: int, raw: bytes) -> dict:
+        try:
+            item_id, request = parse_request(raw, line, self.args)
+        except ValueError as e:
+            self.failed += 1
+            return {"line": line, "id": None, "status": "error", "error": "InvalidLine", "detail": str(e), "status_code": 400}
+
+        if self.limiter is not None:
+            await self.limiter.acquire()
+        try:
+            result = await self.service.create_chat_completion(request, bypass_cache=self.args.bypass_cache)
+        except Exception as e:
+            self.failed += 1
+            return {"line": line, "id": item_id, "status": "error", **error_fields(e)}
+
+        self.succeeded += 1
+        self.tokens += result.tokens_used
+        return {
+            "line": line,
+            "id": item_id,
+            "status": "ok",
+            "model": result.model,
+            "response": result.response,
+            "usage": {
+                "prompt_tokens": result.prompt_tokens,
+                "completion_tokens": result.completion_tokens,
+                "total_tokens": result.tokens_used,
+            },
+        }
+
+    async def _write(self, checkpoint: Checkpoint) -> None:
+        input_order = self.args.order == "input"
+        watermark = checkpoint.line
+        done: Set[int] = set(checkpoint.done)  # Записанные строки после watermark
+        ready: Dict[int, Optional[dict]] = {}  # Результаты, ждущие своей очереди (--order input)
+        ends: Dict[int, int] = {}  # Смещение конца строки во входном файле
+        last_line = None
+
+        mode = "r+b" if os.path.exists(self.args.output) else "wb"
+        out = await asyncio.to_thread(open, self.args.output, mode)
+        try:
+            # Строки, дописанные после сохранения контрольной точки, будут получены заново
+            await asyncio.to_thread(out.truncate, checkpoint.output_bytes)
+            await asyncio.to_thread(out.seek, checkpoint.output_bytes)
+            output_bytes = checkpoint.output_bytes
+            saved_at = time.monotonic()
+
+            while last_line is None or watermark < last_line:
+                batch = [await self.results.get()]
+                while not self.results.empty():
+                    batch.append(self.results.get_nowait())
+
+                lines = []
+                for line, end, record in batch:
+                    if end is None:
+                        last_line = line
+                        continue
+                    ends[line] = end
+                    if input_order:
+                        ready[line] = record
+                    else:
+                        if record is not None:
+                            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+                        done.add(line)
+
+                # Сдвигаем watermark по непрерывному префиксу обработанных строк
+                while True:
+                    if watermark in done:
+                        done.remove(watermark)
+                    elif watermark in ready:
+                        record = ready.pop(watermark)
+                        if record is not None:
+                            lines.append(json.dumps(record, ensure_ascii=False) + "\n")
+                    else:
+                        break
+                    checkpoint.offset = ends.pop(watermark)
+                    watermark += 1
+                    self.window.release()
+
+                if lines:
+                    output_bytes = await asyncio.to_thread(_write_lines, out, lines)
+
+                now = time.monotonic()
+                if now - saved_at >= self.args.checkpoint_interval:
+                    await self._save(checkpoint, out, watermark, done, output_bytes)
+                    saved_at = now
+
+            checkpoint.complete = True
+        finally:
+            # Сохраняем состояние и при прерывании: уже записанные строки не будут повторены
+            await asyncio.shield(self._save(checkpoint, out, watermark, done, output_bytes))
+            await asyncio.to_thread(out.close)
+
+    async def _save(self, checkpoint: Checkpoint, out, watermark: int, done: Set[int], output_bytes: int) -> None:
+        checkpoint.line = watermark
+        checkpoint.done = sorted(done)
+        checkpoint.output_bytes = output_bytes
+        await asyncio.to_thread(_sync, out)
+        await asyncio.to_thread(checkpoint.save)
+
+    async def _report(self, started: float) -> None:
+        while True:
+            await asyncio.sleep(self.args.report_interval)
+            self._print_progress(started)
+
+    def _print_progress(self, started: float, final: bool = False) -> None:
+        elapsed = max(time.monotonic() - started, 1e-9)
+        processed = self.succeeded + self.failed
+        percent = 100.0 * self.input_offset / self.input_size if self.input_size else 100.0
+        print(
+            f"{'done' if final else 'progress'}: {processed} requests ({self.succeeded} ok, {self.failed} errors, "
+            f"{self.skipped} skipped)  {processed / elapsed:.1f} req/s  {self.tokens / elapsed:.0f} tokens/s  "
+            f"in flight {self.in_flight}  input {percent:.1f}%  elapsed {elapsed:.0f}s",
+            file=sys.stderr,
+            flush=True
+        )
+
+
+def parse_args(argv: Optional[List[str]] = None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Пакетная обработка JSONL-файла запросов через OpenAI API")
+    parser.add_argument("input", help="Входной JSONL-файл")
+    parser.add_argument("-o", "--output", required=True, help="Выходной JSONL-файл с результатами")
+    parser.add_argument("--model", default="gpt-3.5-turbo", help="Модель для строк без поля model")
+    parser.add_argument("--prompt-field", default="prompt", help="Поле с текстом запроса для строк без messages")
+    parser.add_argument("--system", help="Системное сообщение для запросов из --prompt-field")
+    parser.add_argument("--id-field", default="id", help="Поле с идентификатором запроса (копируется в результат)")
+    parser.add_argument("--order", choices=("input", "completion"), default="input", help="Порядок строк в выходном файле")
+    parser.add_argument("--concurrency", type=int, default=CHAT_BATCH_CONCURRENCY, help="Количество одновременных запросов")
+    parser.add_argument("--rpm", type=float, help="Ограничение запросов в минуту (по умолчанию без ограничения)")
+    parser.add_argument("--window", type=int, help="Максимум строк между первой незаписанной и последней прочитанной (по умолчанию 8 x concurrency)")
+    parser.add_argument("--checkpoint-interval", type=float, default=5.0, help="Как часто сохранять контрольную точку, секунд")
+    parser.add_argument("--report-interval", type=float, default=10.0, help="Как часто выводить пропускную способность, секунд")
+    parser.add_argument("--bypass-cache", action="store_true", help="Не читать кэш ответов")
+    parser.add_argument("--restart", action="store_true", help="Начать заново, удалив контрольную точку и выходной файл")
+    args = parser.parse_args(argv)
+
+    if args.concurrency < 1:
+        parser.error("--concurrency must be positive")
+    if args.rpm is not None and args.rpm <= 0:
+        parser.error("--rpm must be positive")
+    args.window = max(args.window or args.concurrency * 8, args.concurrency)
+    args.input = os.path.abspath(args.input)
+    return args
+
+async def main(argv: Optional[List[str]] = None) -> int:
+    args = parse_args(argv)
+    checkpoint_path = f"{args.output}.checkpoint"
+    if args.restart:
+        for path in (checkpoint_path, args.output):
+            if os.path.exists(path):
+                os.remove(path)
+
+    try:
+        checkpoint = Checkpoint.load(checkpoint_path, args.input, args.order)
+    except ValueError as e:
+        print(str(e), file=sys.stderr)
+        return 2
+    if checkpoint is None:
+        if os.path.exists(args.output):
+            print(f"{args.output} exists but has no checkpoint; use --restart to overwrite it", file=sys.stderr)
+            return 2
+        checkpoint = Checkpoint(checkpoint_path, args.input, args.order)
+    elif checkpoint.complete:
+        print(f"{args.input} is already processed into {args.output}", file=sys.stderr)
+        return 0
+    else:
+        print(f"Resuming from line {checkpoint.line} ({len(checkpoint.done)} later lines already done)", file=sys.stderr)
+
+    # SIGTERM прерывает прогон так же, как Ctrl+C: с сохранением контрольной точки
+    task = asyncio.current_task()
+    loop = asyncio.get_running_loop()
+    try:
+        loop.add_signal_handler(signal.SIGTERM, task.cancel)
+    except NotImplementedError:
+        pass
+
+    service = OpenAIService()
+    try:
+        await init_db()
+        await writer.start()  # Логи ошибок OpenAI API пишутся в базу данных, как в сервисе
+        await service.warmup()
+        await BatchRunner(service, args).run(checkpoint)
+    except asyncio.CancelledError:
+        print(f"Interrupted; rerun the same command to resume from {checkpoint_path}", file=sys.stderr)
+        return 130
+    finally:
+        await service.close()
+        await writer.stop()
+        await engine.dispose()
+    return 0
+
+
+if __name__ == "__main__":
+    try:
+        sys.exit(asyncio.run(main()))
+    except KeyboardInterrupt:
+        sys.exit(130)
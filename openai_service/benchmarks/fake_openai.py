@@ -0,0 +1,282 @@
+"""
+Локальная замена OpenAI API для нагрузочных тестов без обращения к платному прокси.
+
+Отвечает на те же запросы, что отправляет сервис: chat completions (в том числе stream
+с usage в последнем фрагменте), vision, генерация изображений, транскрипция и синтез речи.
+Задержка ответа задается распределением, ошибки 500 и 429 (с Retry-After) - долей
+запросов или лимитом запросов в минуту.
+
+Запускается из каталога openai_service, сервис направляется на него через PROXY_API_URL:
+    python -m benchmarks.fake_openai --port 9100 --latency lognormal:0.4,0.5 --image-latency uniform:2,6
+    PROXY_API_URL=http://127.0.0.1:9100/v1 PROXY_API_KEY=fake RATE_LIMIT_ENABLED=false uvicorn main:app --workers 4
+
+Распределения задержки (секунды): 0.2 или fixed:0.2, uniform:0.1,0.5, normal:0.3,0.1,
+lognormal:0.3,0.6 (медиана, sigma), exp:0.3 (среднее).
+
+Счетчики запросов по эндпоинтам: GET /stats, сброс - POST /stats/reset.
+"""
+from fastapi import FastAPI, Request, UploadFile, File, Form
+from fastapi.responses import JSONResponse, PlainTextResponse, StreamingResponse
+from typing import Callable, Optional
+import argparse
+import asyncio
+import json
+import math
+import random
+import time
+import uuid
+
+LOREM = (
+    "lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor "
+    "incididunt ut labore et dolore magna aliqua ut enim ad minim veniam quis nostrud"
+).split()
+
+# Сколько токенов промпта добавляет изображение в vision-запросе (detail=high, 768x768)
+IMAGE_PROMPT_TOKENS = 765
+
+
+def parse_latency(spec: str) -> Callable[[], float]:
+    """
+    Разбирает описание распределения задержки.
+
+    Аргументы:
+        spec: str - fixed:S (или просто S), uniform:A,B, normal:MEAN,STDDEV,
+            lognormal:MEDIAN,SIGMA, exp:MEAN
+
+    Возвращает:
+        Callable[[], float]: Генератор задержки в секундах (не меньше 0)
+    """
+    kind, _, params = spec.partition(":")
+    if not params:
+        kind, params = "fixed", kind
+    values = [float(value) for value in params.split(",")]
+    if kind == "fixed":
+        return lambda: values[0]
+    if kind == "uniform":
+        return lambda: random.uniform(values[0], values[1])
+    if kind == "normal":
+        return lambda: max(random.gauss(values[0], values[1]), 0.0)
+    if kind == "lognormal":
+        return lambda: random.lognormvariate(math.log(values[0]), values[1])
+    if kind == "exp":
+        return lambda: random.expovariate(1.0 / values[0])
+    raise ValueError(f"Unknown latency distribution: {spec}")
+
+
+class Faults:
+    """
+    Внедрение ошибок: доля ответов 429 и 500 и лимит запросов в минуту (фиксированное окно).
+    """
+
+    def __init__(self, error_rate: float, rate_limit_rate: float, rpm: int, retry_after: float):
+        self.error_rate = error_rate
+        self.rate_limit_rate = rate_limit_rate
+        self.rpm = rpm
+        self.retry_after = retry_after
+        self._window = 0
+        self._count = 0
+
+    def rate_limited(self) -> Optional[JSONResponse]:
+        """Ответ 429 до обработки запроса (как у OpenAI: лимит проверяется сразу) или None."""
+        if self.rpm:
+            window = int(time.time() // 60)
+            if window != self._window:
+                self._window, self._count = window, 0
+            self._count += 1
+            if self._count > self.rpm:
+                return self._response(429, "rate_limit_error", "Rate limit reached for requests", (self._window + 1) * 60 - time.time())
+        if self.rate_limit_rate and random.random() < self.rate_limit_rate:
+            return self._response(429, "rate_limit_error", "Rate limit reached for requests", self.retry_after)
+        return None
+
+    def server_error(self) -> Optional[JSONResponse]:
+        """Ответ 500 после задержки обработки или None."""
+        if self.error_rate and random.random() < self.error_rate:
+            return self._response(500, "server_error", "The server had an error while processing your request", None)
+        return None
+
+    @staticmethod
+    def _response(status: int, kind: str, message: str, retry_after: Optional[float]) -> JSONResponse:
+        headers = {"Retry-After": str(max(round(retry_after), 1))} if retry_after else None
+        body = {"error": {"message": message, "type": kind, "param": None, "code": None}}
+        return JSONResponse(body, status_code=status, headers=headers)
+
+
+def _prompt_tokens(messages: list) -> int:
+    tokens = 0
+    for message in messages:
+        content = message.get("content")
+        if isinstance(content, list):
+            for part in content:
+                if part.get("type") == "image_url":
+                    tokens += IMAGE_PROMPT_TOKENS
+                else:
+                    tokens += len(part.get("text", "")) // 4 + 1
+        else:
+            tokens += len(content or "") // 4 + 1
+        tokens += 4
+    return tokens
+
+
+def create_app(args: argparse.Namespace) -> FastAPI:
+    """Создает приложение fake OpenAI API с параметрами командной строки."""
+    app = FastAPI(title="fake-openai")
+    chat_latency = parse_latency(args.chat_latency or args.latency)
+    image_latency = parse_latency(args.image_latency or args.latency)
+    audio_latency = parse_latency(args.audio_latency or args.latency)
+    speech_latency = parse_latency(args.speech_latency or args.latency)
+    faults = Faults(args.error_rate, args.rate_limit_rate, args.rpm, args.retry_after)
+    stats = {"requests": {}, "errors": {}, "in_flight": 0, "max_in_flight": 0}
+
+    def _begin(endpoint: str) -> Optional[JSONResponse]:
+        stats["requests"][endpoint] = stats["requests"].get(endpoint, 0) + 1
+        response = faults.rate_limited()
+        if response is not None:
+            stats["errors"]["429"] = stats["errors"].get("429", 0) + 1
+        return response
+
+    async def _process(latency: float) -> Optional[JSONResponse]:
+        stats["in_flight"] += 1
+        stats["max_in_flight"] = max(stats["max_in_flight"], stats["in_flight"])
+        try:
+            await asyncio.sleep(latency)
+        finally:
+            stats["in_flight"] -= 1
+        response = faults.server_error()
+        if response is not None:
+            stats["errors"]["500"] = stats["errors"].get("500", 0) + 1
+        return response
+
+    @app.get("/stats")
+    async def get_stats():
+        return stats
+
+    @app.post("/stats/reset")
+    async def reset_stats():
+        stats.update(requests={}, errors={}, in_flight=0, max_in_flight=0)
+        return stats
+
+    @app.post("/v1/chat/completions")
+    async def chat_completions(request: Request):
+        body = await request.json()
+        stream = bool(body.get("stream"))
+        error = _begin("chat_stream" if stream else "chat")
+        if error is not None:
+            return error
+        model = body.get("model", "gpt-3.5-turbo")
+        prompt_tokens = _prompt_tokens(body.get("messages", []))
+        completion_tokens = args.completion_tokens
+        words = [LOREM[i % len(LOREM)] for i in range(completion_tokens)]
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": completion_tokens, "total_tokens": prompt_tokens + completion_tokens}
+        completion_id = f"chatcmpl-{uuid.uuid4().hex[:24]}"
+        created = int(time.time())
+
+        if not stream:
+            # Без потока ответ приходит целиком: задержка первого токена плюс генерация
+            error = await _process(chat_latency() + completion_tokens * args.token_interval)
+            if error is not None:
+                return error
+            return {
+                "id": completion_id,
+                "object": "chat.completion",
+                "created": created,
+                "model": model,
+                "choices": [{"index": 0, "message": {"role": "assistant", "content": " ".join(words)}, "finish_reason": "stop"}],
+                "usage": usage,
+            }
+
+        error = await _process(chat_latency())
+        if error is not None:
+            return error
+        include_usage = bool((body.get("stream_options") or {}).get("include_usage"))
+
+        def _chunk(delta: dict, finish_reason: Optional[str] = None, chunk_usage: Optional[dict] = None) -> str:
+            choices = [] if chunk_usage else [{"index": 0, "delta": delta, "finish_reason": finish_reason}]
+            chunk = {"id": completion_id, "object": "chat.completion.chunk", "created": created, "model": model, "choices": choices}
+            if chunk_usage:
+                chunk["usage"] = chunk_usage
+            return f"data: {json.dumps(chunk)}\n\n"
+
+        async def _events():
+            yield _chunk({"role": "assistant", "content": ""})
+            for index, word in enumerate(words):
+                if args.token_interval:
+                    await asyncio.sleep(args.token_interval)
+                yield _chunk({"content": word if index == 0 else " " + word})
+            yield _chunk({}, "stop")
+            if include_usage:
+                yield _chunk({}, chunk_usage=usage)
+            yield "data: [DONE]\n\n"
+
+        return StreamingResponse(_events(), media_type="text/event-stream")
+
+    @app.post("/v1/images/generations")
+    async def images_generations(request: Request):
+        body = await request.json()
+        error = _begin("images") or await _process(image_latency())
+        if error is not None:
+            return error
+        data = [{"url": f"https://fake-openai.local/images/{uuid.uuid4().hex}.png"} for _ in range(body.get("n") or 1)]
+        return {"created": int(time.time()), "data": data}
+
+    @app.post("/v1/audio/transcriptions")
+    async def audio_transcriptions(
+        file: UploadFile = File(...),
+        model: str = Form("whisper-1"),
+        response_format: str = Form("json"),
+        language: Optional[str] = Form(None)
+    ):
+        size = len(await file.read())
+        error = _begin("transcription") or await _process(audio_latency())
+        if error is not None:
+            return error
+        text = " ".join(LOREM[i % len(LOREM)] for i in range(max(size // 4000, 1)))
+        if response_format == "text":
+            return PlainTextResponse(text + "\n")
+        if response_format == "verbose_json":
+            return {"task": "transcribe", "language": language or "en", "duration": size / 32000, "text": text, "segments": []}
+        return {"text": text}
+
+    @app.post("/v1/audio/speech")
+    async def audio_speech(request: Request):
+        await request.json()
+        error = _begin("speech") or await _process(speech_latency())
+        if error is not None:
+            return error
+
+        async def _audio():
+            chunk = b"\xff\xfb" + b"\x00" * (args.speech_chunk_bytes - 2)
+            for _ in range(max(args.speech_bytes // args.speech_chunk_bytes, 1)):
+                if args.token_interval:
+                    await asyncio.sleep(args.token_interval)
+                yield chunk
+
+        return StreamingResponse(_audio(), media_type="audio/mpeg")
+
+    return app
+
+
+def parse_args(argv=None) -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description="Fake OpenAI API для нагрузочных тестов")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=9100)
+    parser.add_argument("--latency", default="lognormal:0.4,0.5", help="Распределение задержки по умолчанию")
+    parser.add_argument("--chat-latency", help="Задержка до первого токена chat completions")
+    parser.add_argument("--image-latency", help="Задержка генерации изображений")
+    parser.add_argument("--audio-latency", help="Задержка транскрипции")
+    parser.add_argument("--speech-latency", help="Задержка до первого фрагмента синтеза речи")
+    parser.add_argument("--token-interval", type=float, default=0.01, help="Пауза между токенами (и фрагментами аудио), секунд")
+    parser.add_argument("--completion-tokens", type=int, default=40, help="Длина ответа chat completions в токенах")
+    parser.add_argument("--speech-bytes", type=int, default=64 * 1024, help="Размер синтезированного аудио")
+    parser.add_argument("--speech-chunk-bytes", type=int, default=4096, help="Размер фрагмента аудио")
+    parser.add_argument("--error-rate", type=float, default=0.0, help="Доля ответов 500")
+    parser.add_argument("--rate-limit-rate", type=float, default=0.0, help="Доля ответов 429")
+    parser.add_argument("--retry-after", type=float, default=1.0, help="Retry-After для внедренных 429, секунд")
+    parser.add_argument("--rpm", type=int, default=0, help="Лимит запросов в минуту, сверх него - 429 (0 - без лимита)")
+    return parser.parse_args(argv)
+
+
+if __name__ == "__main__":
+    import uvicorn
+    args = parse_args()
+    uvicorn.run(create_app(args), host=args.host, port=args.port, log_level="warning")
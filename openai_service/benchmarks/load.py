@@ -0,0 +1,458 @@
+"""
+Нагрузочный тест эндпоинтов /api/v1 запущенного сервиса.
+
+Сценарии (один сценарий - одна пользовательская операция, иногда из нескольких запросов):
+    chat, chat_stream, chat_batch, chat_lifecycle (completion, rename, delete), chat_create,
+    vision, images, images_batch, images_async (постановка задачи и long-poll /jobs),
+    speech, transcription, history, statistics.
+Не нагружаются /speech/transcribe (путь к файлу на сервере) и заглушка /images/edit.
+
+Нагрузка: --concurrency N клиентов подряд (closed loop) или --rate R операций в секунду
+(open loop, пуассоновский поток; задержка считается от запланированного времени отправки,
+поэтому очередь на стороне клиента тоже попадает в p99). По умолчанию сценарии
+прогоняются по очереди, с --mix - вместе, в пропорции весов (chat:8,images:1).
+
+Чтобы не платить за OpenAI API, сервис направляется на benchmarks.fake_openai,
+лимиты запросов сервиса на время теста отключаются. Из каталога openai_service:
+    python -m benchmarks.fake_openai --port 9100 &
+    PROXY_API_URL=http://127.0.0.1:9100/v1 PROXY_API_KEY=fake RATE_LIMIT_ENABLED=false uvicorn main:app --workers 4 &
+    python -m benchmarks.load --api-key $API_KEY --scenarios chat,chat_stream --concurrency 64 --output results/chat.json
+    python -m benchmarks.load --api-key $API_KEY --rate 200 --mix --scenarios chat:8,images:1 --compare results/chat.json
+"""
+from datetime import datetime, timezone
+from typing import Awaitable, Callable, Dict, List, Optional
+import argparse
+import asyncio
+import base64
+import io
+import json
+import os
+import random
+import statistics
+import subprocess
+import time
+import uuid
+import wave
+
+import httpx
+
+try:
+    from PIL import Image
+except ImportError:  # Без Pillow vision-сценарий отправляет одно и то же маленькое изображение
+    Image = None
+
+# PNG 1x1 на случай, если Pillow не установлен
+FALLBACK_PNG = base64.b64decode(
+    "iVBORw0KGgoAAAANSUhEUgAAAAEAAAABCAIAAACQd1PeAAAADElEQVR4nGP4z8AAAAMBAQDJ/pLvAAAAAElFTkSuQmCC"
+)
+
+TERMINAL_JOB_STATUSES = ("succeeded", "failed", "cancelled")
+
+# Сколько раз (через 50 мс) повторять rename, пока история чата не записана в базу
+HISTORY_VISIBLE_ATTEMPTS = 100
+
+
+class OperationFailed(Exception):
+    """Операция завершилась ошибкой: reason - HTTP-статус или описание."""
+
+    def __init__(self, reason: str):
+        super().__init__(reason)
+        self.reason = reason
+
+
+class Context:
+    """Общие для сценариев параметры и генераторы уникальных входных данных."""
+
+    def __init__(self, args: argparse.Namespace):
+        self.model = args.model
+        self.batch_size = args.batch_size
+        self.repeat = args.repeat_prompts
+        self.counter = 0
+        self._image = None
+        self._audio = None
+
+    def text(self, base: str) -> str:
+        # Уникальный текст в каждом запросе: иначе ответы берутся из кэшей сервиса
+        self.counter += 1
+        return base if self.repeat else f"{base} #{self.counter}-{random.getrandbits(32)}"
+
+    def image(self) -> bytes:
+        if Image is None:
+            return FALLBACK_PNG
+        if self.repeat and self._image is not None:
+            return self._image
+        # Шум, чтобы изображение (и ответ из кэша vision) отличалось от запроса к запросу
+        image = Image.frombytes("RGB", (256, 256), os.urandom(256 * 256 * 3))
+        out = io.BytesIO()
+        image.save(out, format="PNG")
+        self._image = out.getvalue()
+        return self._image
+
+    def audio(self, seconds: float = 2.0) -> bytes:
+        if self.repeat and self._audio is not None:
+            return self._audio
+        rate = 16000
+        out = io.BytesIO()
+        with wave.open(out, "wb") as wav:
+            wav.setnchannels(1)
+            wav.setsampwidth(2)
+            wav.setframerate(rate)
+            wav.writeframes(os.urandom(int(rate * seconds) * 2))
+        self._audio = out.getvalue()
+        return self._audio
+
+    def messages(self) -> list:
+        return [{"role": "user", "content": self.text("Tell me a short story about a lighthouse")}]
+
+
+def _check(response: httpx.Response, expected: int = 200) -> httpx.Response:
+    if response.status_code != expected:
+        raise OperationFailed(str(response.status_code))
+    return response
+
+
+async def _read_stream(client: httpx.AsyncClient, method: str, url: str, **kwargs) -> float:
+    """Читает потоковый ответ целиком и возвращает время до первого фрагмента (секунды)."""
+    started = time.perf_counter()
+    first = None
+    async with client.stream(method, url, **kwargs) as response:
+        _check(response)
+        async for _ in response.aiter_raw():
+            if first is None:
+                first = time.perf_counter() - started
+    return first if first is not None else time.perf_counter() - started
+
+
+async def _ndjson_failures(client: httpx.AsyncClient, url: str, payload: dict) -> None:
+    response = _check(await client.post(url, json=payload))
+    summary = json.loads(response.text.splitlines()[-1])
+    if summary.get("failed"):
+        raise OperationFailed("batch_items")
+
+
+async def scenario_chat(client: httpx.AsyncClient, ctx: Context) -> None:
+    payload = {"chat_id": str(uuid.uuid4()), "model": ctx.model, "messages": ctx.messages()}
+    _check(await client.post("/chat/completions", json=payload))
+
+async def scenario_chat_stream(client: httpx.AsyncClient, ctx: Context) -> float:
+    payload = {"chat_id": str(uuid.uuid4()), "model": ctx.model, "messages": ctx.messages(), "stream": True}
+    return await _read_stream(client, "POST", "/chat/completions", json=payload)
+
+async def scenario_chat_batch(client: httpx.AsyncClient, ctx: Context) -> None:
+    items = [
+        {"chat_id": str(uuid.uuid4()), "model": ctx.model, "messages": ctx.messages()}
+        for _ in range(ctx.batch_size)
+    ]
+    await _ndjson_failures(client, "/chat/completions/batch", {"items": items})
+
+async def scenario_chat_lifecycle(client: httpx.AsyncClient, ctx: Context) -> None:
+    chat_id = str(uuid.uuid4())
+    _check(await client.post("/chat/completions", json={"chat_id": chat_id, "model": ctx.model, "messages": ctx.messages()}))
+    # История пишется фоновым писателем (app.db.writer): ждем, пока чат появится в базе
+    rename = {"chat_id": chat_id, "new_name": ctx.text("renamed")}
+    for _ in range(HISTORY_VISIBLE_ATTEMPTS):
+        response = await client.put("/chat/rename", json=rename)
+        if response.status_code != 404:
+            break
+        await asyncio.sleep(0.05)
+    _check(response)
+    _check(await client.delete(f"/chat/delete/{chat_id}"))
+
+async def scenario_chat_create(client: httpx.AsyncClient, ctx: Context) -> None:
+    payload = {
+        "chat_name": ctx.text("load"),
+        "question": "q",
+        "model_gpt": ctx.model,
+        "answer": "{}",
+        "context": "{}",
+        "token": 0,
+    }
+    _check(await client.post("/chat/create", json=payload))
+
+async def scenario_vision(client: httpx.AsyncClient, ctx: Context) -> None:
+    files = {"file": ("image.png", ctx.image(), "image/png")}
+    _check(await client.post("/chat/vision", files=files, data={"prompt": ctx.text("What's in this image?")}))
+
+async def scenario_images(client: httpx.AsyncClient, ctx: Context) -> None:
+    _check(await client.post("/images/generate", json={"prompt": ctx.text("red sneakers"), "size": "256x256"}))
+
+async def scenario_images_batch(client: httpx.AsyncClient, ctx: Context) -> None:
+    items = [{"id": str(index), "prompt": ctx.text("blue backpack")} for index in range(ctx.batch_size)]
+    await _ndjson_failures(client, "/images/generate/batch", {"items": items})
+
+async def scenario_images_async(client: httpx.AsyncClient, ctx: Context) -> None:
+    response = _check(
+        await client.post("/images/generate", params={"async": "true"}, json={"prompt": ctx.text("green lamp"), "size": "256x256"}),
+        202
+    )
+    status_url = response.json()["status_url"].removeprefix("/api/v1")
+    while True:
+        job = _check(await client.get(status_url, params={"wait": 30})).json()
+        if job["status"] in TERMINAL_JOB_STATUSES:
+            if job["status"] != "succeeded":
+                raise OperationFailed(f"job_{job['status']}")
+            return
+
+async def scenario_speech(client: httpx.AsyncClient, ctx: Context) -> float:
+    payload = {"chat_id": "load", "text": ctx.text("Здравствуйте! Оставайтесь на линии."), "voice": "alloy"}
+    return await _read_stream(client, "POST", "/speech/create", json=payload)
+
+async def scenario_transcription(client: httpx.AsyncClient, ctx: Context) -> None:
+    files = {"file": ("audio.wav", ctx.audio(), "audio/wav")}
+    _check(await client.post("/listen/transcription", files=files))
+
+async def scenario_history(client: httpx.AsyncClient, ctx: Context) -> None:
+    _check(await client.get("/history", params={"page_size": 20}))
+
+async def scenario_statistics(client: httpx.AsyncClient, ctx: Context) -> None:
+    _check(await client.get("/statistics"))
+
+
+SCENARIOS: Dict[str, Callable[[httpx.AsyncClient, Context], Awaitable[Optional[float]]]] = {
+    "chat": scenario_chat,
+    "chat_stream": scenario_chat_stream,
+    "chat_batch": scenario_chat_batch,
+    "chat_lifecycle": scenario_chat_lifecycle,
+    "chat_create": scenario_chat_create,
+    "vision": scenario_vision,
+    "images": scenario_images,
+    "images_batch": scenario_images_batch,
+    "images_async": scenario_images_async,
+    "speech": scenario_speech,
+    "transcription": scenario_transcription,
+    "history": scenario_history,
+    "statistics": scenario_statistics,
+}
+
+
+class Recorder:
+    """Задержки, время до первого фрагмента и ошибки одного сценария."""
+
+    def __init__(self, name: str):
+        self.name = name
+        self.latencies: List[float] = []
+        self.first_byte: List[float] = []
+        self.errors: Dict[str, int] = {}
+
+    async def run(self, client: httpx.AsyncClient, ctx: Context, scheduled: Optional[float] = None) -> None:
+        started = scheduled if scheduled is not None else time.perf_counter()
+        try:
+            first_byte = await SCENARIOS[self.name](client, ctx)
+        except OperationFailed as e:
+            self.errors[e.reason] = self.errors.get(e.reason, 0) + 1
+            return
+        except Exception as e:
+            reason = type(e).__name__
+            self.errors[reason] = self.errors.get(reason, 0) + 1
+            return
+        self.latencies.append(time.perf_counter() - started)
+        if first_byte is not None:
+            self.first_byte.append(first_byte)
+
+    def summary(self, elapsed: float) -> dict:
+        latencies = sorted(self.latencies)
+        first_byte = sorted(self.first_byte)
+        result = {
+            "scenario": self.name,
+            "operations": len(latencies),
+            "errors": sum(self.errors.values()),
+            "errors_by_reason": self.errors,
+            "rps": round(len(latencies) / elapsed, 1) if elapsed else None,
+            **_percentiles(latencies),
+        }
+        if first_byte:
+            result["first_byte_p50_ms"] = round(first_byte[len(first_byte) // 2] * 1000, 3)
+            result["first_byte_p95_ms"] = round(first_byte[int(len(first_byte) * 0.95)] * 1000, 3)
+        return result
+
+
+def _percentiles(latencies: List[float]) -> dict:
+    return {
+        "p50_ms": round(latencies[len(latencies) // 2] * 1000, 3) if latencies else None,
+        "p95_ms": round(latencies[int(len(latencies) * 0.95)] * 1000, 3) if latencies else None,
+        "p99_ms": round(latencies[int(len(latencies) * 0.99)] * 1000, 3) if latencies else None,
+        "mean_ms": round(statistics.fmean(latencies) * 1000, 3) if latencies else None,
+        "max_ms": round(latencies[-1] * 1000, 3) if latencies else None,
+    }
+
+
+def parse_scenarios(spec: str) -> Dict[str, float]:
+    """Разбирает список сценариев с весами: chat:8,images:1 (вес по умолчанию 1)."""
+    weights = {}
+    for item in spec.split(","):
+        name, _, weight = item.strip().partition(":")
+        if name not in SCENARIOS:
+            raise SystemExit(f"Unknown scenario: {name} (available: {', '.join(SCENARIOS)})")
+        weights[name] = float(weight or 1)
+    return weights
+
+
+async def run_load(client: httpx.AsyncClient, ctx: Context, weights: Dict[str, float], args: argparse.Namespace) -> List[dict]:
+    """
+    Прогоняет нагрузку на сценарии weights в течение args.duration секунд.
+
+    Возвращает:
+        List[dict]: Итоги по сценариям (при нескольких сценариях - и строка "total")
+    """
+    recorders = {name: Recorder(name) for name in weights}
+    names, cumulative = list(weights), []
+    for weight in weights.values():
+        cumulative.append((cumulative[-1] if cumulative else 0) + weight)
+
+    def pick() -> Recorder:
+        return recorders[random.choices(names, cum_weights=cumulative)[0]]
+
+    started = time.perf_counter()
+    deadline = started + args.duration
+
+    if args.rate:
+        # Open loop: операции отправляются по расписанию независимо от того, успевает ли сервис
+        in_flight = asyncio.Semaphore(args.max_in_flight)
+        tasks = set()
+
+        async def _one(recorder: Recorder, scheduled: float) -> None:
+            async with in_flight:
+                await recorder.run(client, ctx, scheduled)
+
+        next_at = started
+        while next_at < deadline:
+            delay = next_at - time.perf_counter()
+            if delay > 0:
+                await asyncio.sleep(delay)
+            task = asyncio.create_task(_one(pick(), next_at))
+            tasks.add(task)
+            task.add_done_callback(tasks.discard)
+            next_at += random.expovariate(args.rate)
+        if tasks:
+            await asyncio.gather(*tasks)
+    else:
+        async def _worker() -> None:
+            while time.perf_counter() < deadline:
+                await pick().run(client, ctx)
+
+        await asyncio.gather(*(_worker() for _ in range(args.concurrency)))
+
+    elapsed = time.perf_counter() - started
+    results = [recorder.summary(elapsed) for recorder in recorders.values()]
+    if len(results) > 1:
+        latencies = sorted(latency for recorder in recorders.values() for latency in recorder.latencies)
+        results.append({
+            "scenario": "total",
+            "operations": len(latencies),
+            "errors": sum(result["errors"] for result in results),
+            "rps": round(len(latencies) / elapsed, 1),
+            **_percentiles(latencies),
+        })
+    return results
+
+
+def print_result(result: dict) -> None:
+    line = (
+        f"{result['scenario']:>15}: {result['rps']:>8} rps  "
+        f"p50 {result['p50_ms']} ms  p95 {result['p95_ms']} ms  p99 {result['p99_ms']} ms  "
+        f"errors {result['errors']}"
+    )
+    if result.get("errors_by_reason"):
+        line += f" {result['errors_by_reason']}"
+    if "first_byte_p50_ms" in result:
+        line += f"  first byte p50 {result['first_byte_p50_ms']} ms"
+    print(line)
+
+
+def compare(results: List[dict], baseline_path: str) -> None:
+    """Печатает изменение rps и p95 относительно сохраненного прогона."""
+    with open(baseline_path) as f:
+        baseline = {result["scenario"]: result for result in json.load(f)["results"]}
+
+    def _delta(new, old) -> str:
+        if not new or not old:
+            return "n/a"
+        return f"{(new - old) / old * 100:+.1f}%"
+
+    print(f"\ncompared with {baseline_path}:")
+    for result in results:
+        old = baseline.get(result["scenario"])
+        if old is None:
+            continue
+        print(
+            f"{result['scenario']:>15}: rps {old['rps']} -> {result['rps']} ({_delta(result['rps'], old['rps'])})  "
+            f"p95 {old['p95_ms']} -> {result['p95_ms']} ms ({_delta(result['p95_ms'], old['p95_ms'])})"
+        )
+
+
+def _git_commit() -> Optional[str]:
+    try:
+        return subprocess.run(["git", "rev-parse", "--short", "HEAD"], capture_output=True, text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+async def main() -> None:
+    parser = argparse.ArgumentParser(description="Нагрузочный тест эндпоинтов /api/v1")
+    parser.add_argument("--url", default="http://127.0.0.1:8000", help="Адрес сервиса")
+    parser.add_argument("--api-key", default=os.getenv("API_KEY"), help="API-ключ (по умолчанию API_KEY)")
+    parser.add_argument("--scenarios", default=",".join(SCENARIOS), help="Сценарии через запятую, с весами для --mix: chat:8,images:1")
+    parser.add_argument("--mix", action="store_true", help="Прогонять сценарии вместе, а не по очереди")
+    parser.add_argument("--concurrency", type=int, default=32, help="Количество одновременных клиентов (closed loop)")
+    parser.add_argument("--rate", type=float, help="Операций в секунду (open loop) вместо --concurrency")
+    parser.add_argument("--max-in-flight", type=int, default=1000, help="Предел одновременных операций при --rate")
+    parser.add_argument("--duration", type=float, default=30.0, help="Длительность прогона (одного сценария без --mix), секунд")
+    parser.add_argument("--model", default="gpt-3.5-turbo", help="Модель chat completions")
+    parser.add_argument("--batch-size", type=int, default=10, help="Элементов в пакетных сценариях")
+    parser.add_argument("--repeat-prompts", action="store_true", help="Повторять одни и те же входные данные (нагрузка на кэши)")
+    parser.add_argument("--timeout", type=float, default=120.0, help="Тайм-аут запроса, секунд")
+    parser.add_argument("--fake-url", help="Адрес benchmarks.fake_openai: добавить в результаты его счетчики запросов")
+    parser.add_argument("--output", help="Файл для сохранения результатов в JSON")
+    parser.add_argument("--compare", help="JSON прошлого прогона для сравнения")
+    args = parser.parse_args()
+
+    if not args.api_key:
+        parser.error("--api-key or API_KEY is required")
+
+    weights = parse_scenarios(args.scenarios)
+    ctx = Context(args)
+    connections = args.max_in_flight if args.rate else args.concurrency
+    client = httpx.AsyncClient(
+        base_url=args.url.rstrip("/") + "/api/v1",
+        headers={"X-API-Key": args.api_key},
+        timeout=args.timeout,
+        limits=httpx.Limits(max_connections=connections, max_keepalive_connections=connections)
+    )
+    if args.fake_url:
+        httpx.post(f"{args.fake_url}/stats/reset")
+
+    started_at = datetime.now(timezone.utc)
+    results = []
+    async with client:
+        groups = [weights] if args.mix else [{name: 1.0} for name in weights]
+        for group in groups:
+            for result in await run_load(client, ctx, group, args):
+                results.append(result)
+                print_result(result)
+
+    if args.compare:
+        compare(results, args.compare)
+
+    if args.output:
+        report = {
+            "started_at": started_at.isoformat(),
+            "git_commit": _git_commit(),
+            "url": args.url,
+            "mode": "open" if args.rate else "closed",
+            "concurrency": None if args.rate else args.concurrency,
+            "rate": args.rate,
+            "duration": args.duration,
+            "mix": args.mix,
+            "weights": weights,
+            "repeat_prompts": args.repeat_prompts,
+            "results": results,
+        }
+        if args.fake_url:
+            report["upstream"] = httpx.get(f"{args.fake_url}/stats").json()
+        os.makedirs(os.path.dirname(args.output) or ".", exist_ok=True)
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=2, ensure_ascii=False)
+
+
+if __name__ == "__main__":
+    asyncio.run(main())
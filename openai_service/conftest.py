@@ -0,0 +1,53 @@
+"""
+Общая настройка тестов (app/tests).
+
+- Каталог сервиса добавляется в sys.path, поэтому пакеты app и benchmarks и модуль main
+  импортируются и при запуске pytest из корня репозитория.
+- Настройки (app.core.config) читаются из окружения один раз, при первом импорте,
+  поэтому тестовое окружение задается здесь, до импорта тестовых модулей: общий ключ
+  API, fake OpenAI API (benchmarks/fake_openai.py) на свободном порту, отключенные
+  лимиты. Без DATABASE_URL используется временная база SQLite.
+"""
+import os
+import socket
+import sys
+import tempfile
+
+import pytest
+
+SERVICE_DIR = os.path.dirname(os.path.abspath(__file__))
+if SERVICE_DIR not in sys.path:
+    sys.path.insert(0, SERVICE_DIR)
+
+
+def _free_port() -> int:
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+
+API_KEY = "test-api-key"
+FAKE_OPENAI_PORT = _free_port()
+
+os.environ.update({
+    "API_KEY": API_KEY,
+    "PROXY_API_KEY": "fake",
+    "PROXY_API_URL": f"http://127.0.0.1:{FAKE_OPENAI_PORT}/v1",
+    "RATE_LIMIT_ENABLED": "false",
+    "OPENAI_WARMUP_CONNECTIONS": "0",
+    "DB_ECHO": "false",
+})
+if not os.getenv("DATABASE_URL"):
+    os.environ["DATABASE_URL"] = f"sqlite+aiosqlite:///{os.path.join(tempfile.mkdtemp(), 'test.db')}"
+
+
+@pytest.fixture(scope="session")
+def api_key() -> str:
+    """Ключ API сервиса в тестах."""
+    return API_KEY
+
+
+@pytest.fixture(scope="session")
+def fake_openai_port() -> int:
+    """Порт, на котором тесты запускают fake OpenAI API (см. PROXY_API_URL)."""
+    return FAKE_OPENAI_PORT
@@ -4,25 +4,86 @@ from dotenv import load_dotenv
 # Загружаем переменные окружения из файла .env
 load_dotenv()
 
-from fastapi import FastAPI
+from contextlib import asynccontextmanager
+import math
+from fastapi import FastAPI, Request
+from fastapi.responses import JSONResponse
 from app.core.logging import logs_bot
-from app.db.database import init_db
+from app.core.errors import UpstreamError
+from app.core.rate_limit import RateLimitExceeded
+from app.core.security import api_key_store
+from app.core.metrics import MetricsMiddleware, instrument_engine, loop_lag_monitor, mark_process_dead, metrics_endpoint
+from app.db.database import init_db, engine
+from app.db.writer import writer
+from app.services.jobs import job_manager
+from app.services.openai import OpenAIService
+from app.services.vision import image_preprocessor
 from app.api.v1.router import api_router
 
-app = FastAPI()
 
-# Подключаем роутер API v1
-app.include_router(api_router, prefix="/api/v1")
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """
+    Жизненный цикл приложения: общие ресурсы создаются при старте
+    и закрываются при остановке.
 
-@app.on_event("startup")
-async def startup_event():
+    app.state.openai_service - единственный на процесс OpenAIService с общим пулом
+    HTTP-соединений к OpenAI API (эндпоинты получают его через get_openai_service).
+    """
+    openai_service = OpenAIService()
     try:
         await init_db()  # Инициализация базы данных
+        await writer.start()  # Запуск фоновой записи логов и истории чатов
+        await api_key_store.refresh()  # API-ключи клиентов в память (дальше обновляются в фоне)
+        await loop_lag_monitor.start()  # Замер задержки event loop для метрик
+        await openai_service.warmup()  # Открываем соединения с OpenAI API заранее
+        await job_manager.start(openai_service)  # Воркеры фоновых задач и их периодическая очистка
+        app.state.openai_service = openai_service
         await logs_bot("info", "Сервис успешно запущен")  # Логируем успешный запуск сервиса
     except Exception as e:
         await logs_bot("error", f"Не удалось запустить сервис: {str(e)}")  # Логируем ошибку при запуске
+        await openai_service.close()
         raise
 
+    yield
+
+    await logs_bot("info", "Сервис остановлен")
+    await job_manager.stop()  # Незавершенные фоновые задачи помечаются failed
+    await openai_service.close()  # Закрываем пул соединений к OpenAI API
+    image_preprocessor.shutdown()  # Останавливаем пул процессов предобработки изображений
+    await writer.stop()  # Дописываем все накопленные записи перед выходом
+    await loop_lag_monitor.stop()
+    await engine.dispose()  # Закрываем соединения пула
+    mark_process_dead()  # Убираем live-метрики воркера (multiprocess-режим)
+
+
+app = FastAPI(lifespan=lifespan)
+
+# Метрики Prometheus: время обработки запросов, SQL-запросов и /metrics для сбора
+app.add_middleware(MetricsMiddleware)
+instrument_engine(engine)
+app.add_route("/metrics", metrics_endpoint, include_in_schema=False)
+
+@app.exception_handler(UpstreamError)
+async def upstream_error_handler(request: Request, exc: UpstreamError):
+    # Ошибки OpenAI API (app.core.errors): код ответа зависит от типа ошибки,
+    # Retry-After подсказывает клиенту, когда повторить запрос
+    content = {"detail": str(exc), "error": type(exc).__name__}
+    if getattr(exc, "reason", None):
+        content["reason"] = exc.reason
+    headers = {"Retry-After": str(max(int(exc.retry_after), 1))} if exc.retry_after else None
+    return JSONResponse(status_code=exc.status_code, content=content, headers=headers)
+
+@app.exception_handler(RateLimitExceeded)
+async def rate_limit_handler(request: Request, exc: RateLimitExceeded):
+    # Превышен лимит запросов или токенов ключа (app.core.rate_limit)
+    content = {"detail": str(exc), "error": type(exc).__name__, "limit": exc.limit}
+    headers = {"Retry-After": str(max(math.ceil(exc.retry_after), 1))}
+    return JSONResponse(status_code=exc.status_code, content=content, headers=headers)
+
+# Подключаем роутер API v1
+app.include_router(api_router, prefix="/api/v1")
+
 if __name__ == "__main__":
     import uvicorn
     uvicorn.run(